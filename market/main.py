@@ -1,5 +1,4 @@
-def main():
-    print("Hello from market!")
+from market.pipeline import main
 
 
 if __name__ == "__main__":
@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+from market.services.llm import BATCH_SYSTEM_PROMPT
+
+_ITEM = re.compile(r"^\[(\d+)\]$", re.MULTILINE)
+
+
+def _answer(content: str) -> Dict:
+    digest = hashlib.blake2b(content.encode("utf-8"), digest_size=4).digest()
+    sentiment = int.from_bytes(digest, "little") / 0xFFFFFFFF * 2 - 1
+    return {
+        "summary": content.strip()[:120],
+        "sentiment": round(sentiment, 3),
+        "risks": ["问询"] if "问询" in content else [],
+        "highlights": ["中标"] if "中标" in content else [],
+    }
+
+
+def _packed_items(content: str) -> List[Dict]:
+    markers = list(_ITEM.finditer(content))
+    items = []
+    for position, marker in enumerate(markers):
+        end = markers[position + 1].start() if position + 1 < len(markers) else len(content)
+        items.append({"id": int(marker.group(1)), **_answer(content[marker.end() : end])})
+    return items
+
+
+class StubLLMServer:
+    # OpenAI-compatible chat endpoint on localhost that answers instantly (or after a fixed
+    # latency), so enrichment runs through the real HTTP client, packing and cache.
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.requests = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self) -> None:  # noqa: N802
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)))
+                messages = payload.get("messages", [])
+                system = messages[0]["content"] if messages else ""
+                content = messages[-1]["content"] if messages else ""
+                with stub._lock:
+                    stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                answer = {"items": _packed_items(content)} if system == BATCH_SYSTEM_PROMPT else _answer(content)
+                body = json.dumps(
+                    {"choices": [{"message": {"role": "assistant", "content": json.dumps(answer, ensure_ascii=False)}}]},
+                    ensure_ascii=False,
+                ).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="llm-stub", daemon=True)
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def __enter__(self) -> "StubLLMServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._server.shutdown()
+        self._server.server_close()
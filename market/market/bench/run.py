@@ -0,0 +1,455 @@
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from market.bench.llm_stub import StubLLMServer
+from market.bench.synthetic import SCALES, Scale, SyntheticMarket, SyntheticTushareClient
+from market.services import metrics
+
+logger = logging.getLogger("bench")
+
+RESULTS_VERSION = 1
+BASELINE_PATH = Path(__file__).with_name("baseline.json")
+DEFAULT_TOLERANCE = 0.25
+# Regressions smaller than this in absolute time are treated as timer noise.
+MIN_REGRESSION_SECONDS = 0.05
+WINDOW = 60
+RAW_WRITE_DATES = 20
+DB_LOAD_DATES = 5
+NEWS_DAYS = 1
+TUSHARE_ENDPOINTS = ("daily", "fina_indicator", "news", "trade_cal", "stock_basic", "namechange")
+# Database benchmarks keep their own baseline per scale, so they can be recorded against a scratch
+# database without re-recording the in-process ones (and vice versa).
+DB_BASELINE_SUFFIX = "+db"
+
+
+@dataclass
+class BenchContext:
+    market: SyntheticMarket
+    client: SyntheticTushareClient
+    trade_date: str
+    database: bool
+    data: Dict[str, object] = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class Benchmark:
+    name: str
+    action: Callable[[BenchContext], int]
+    needs_db: bool = False
+
+
+def bench_price_features(ctx: BenchContext) -> int:
+    from market.jobs.calc_features import compute_price_features
+
+    history = ctx.data["history"]
+    compute_price_features(history, ctx.trade_date)
+    return len(history)
+
+
+def bench_price_feature_panel(ctx: BenchContext) -> int:
+    from market.jobs.calc_features import compute_price_feature_panel_from_pivots
+
+    close, volume = ctx.market.pivots()
+    compute_price_feature_panel_from_pivots(close, volume, ctx.market.date_strs[0], ctx.trade_date)
+    return close.size
+
+
+def bench_factor_panel(ctx: BenchContext) -> int:
+    from market.jobs.calc_features import compute_price_feature_panel_from_pivots
+
+    close, volume = ctx.market.pivots()
+    # Same units as the synthetic daily frames: vol in lots, amount in thousands of yuan.
+    amount = volume * close / 10
+    compute_price_feature_panel_from_pivots(close, volume, ctx.market.date_strs[0], ctx.trade_date, amount, "all")
+    return close.size
+
+
+def bench_factor_evaluation(ctx: BenchContext) -> int:
+    from market.services.evaluation import FactorPanel, evaluate
+    from market.services.factors import compute_panel
+
+    close, volume = ctx.market.pivots()
+    if "factor_panel" not in ctx.data:
+        # Built once; only the evaluation itself is timed on later repeats.
+        values = compute_panel(close.to_numpy(), volume.to_numpy(), names=["ret_5d", "ret_20d", "vol_ratio_5_20"])
+        ctx.data["factor_panel"] = FactorPanel(close.index, close.columns, values)
+    evaluate(ctx.data["factor_panel"], close)
+    return close.size
+
+
+def bench_raw_store_write(ctx: BenchContext) -> int:
+    from market.services.storage import save_dataframe
+
+    rows = 0
+    for trade_date, frame in ctx.data["daily_frames"][-RAW_WRITE_DATES:]:
+        save_dataframe(frame, "daily", trade_date)
+        rows += len(frame)
+    return rows
+
+
+def bench_raw_price_history(ctx: BenchContext) -> int:
+    from market.jobs.calc_features import fetch_price_history
+
+    return len(fetch_price_history(ctx.trade_date, WINDOW, source="raw"))
+
+
+def bench_financials_as_of_raw(ctx: BenchContext) -> int:
+    from market.jobs.calc_features import fetch_financial_history
+    from market.services.fundamentals import as_of_join
+
+    intervals = fetch_financial_history(ctx.trade_date, source="raw")
+    grid = pd.DataFrame({"security_id": ctx.market.security_ids})
+    grid["snapshot_date"] = pd.Timestamp(ctx.trade_date).as_unit("ns")
+    as_of_join(grid, intervals)
+    return len(intervals)
+
+
+def bench_db_load_prices(ctx: BenchContext) -> int:
+    from market.jobs.fetch_daily import load_dataframe
+
+    rows = 0
+    for trade_date, frame in ctx.data["daily_frames"][-DB_LOAD_DATES:]:
+        load_dataframe(frame.copy(), trade_date, replace=True)
+        rows += len(frame)
+    return rows
+
+
+def bench_db_load_financials(ctx: BenchContext) -> int:
+    from market.jobs.sync_financials import load_dataframe
+
+    period, frame = ctx.data["financial_frames"][-1]
+    load_dataframe(frame.copy(), period, replace=False)
+    return len(frame)
+
+
+def bench_fetch_financial_metrics(ctx: BenchContext) -> int:
+    from market.jobs.calc_features import fetch_financial_metrics
+
+    return len(fetch_financial_metrics(ctx.trade_date))
+
+
+def bench_calc_features(ctx: BenchContext) -> int:
+    from market.jobs import calc_features
+
+    return calc_features.run(ctx.trade_date, WINDOW, replace=True)
+
+
+def _no_stored_canonicals(start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+    return pd.DataFrame(columns=["news_id", "publish_time", "minhash", "summary", "sentiment", "risk_tags", "highlights"])
+
+
+def bench_news_enrich(ctx: BenchContext) -> int:
+    # fetch -> transform -> link -> dedup -> enrich through the real client and LLM code; the
+    # stub endpoint answers, and without a database no earlier canonicals are stored.
+    from market.jobs import sync_reports
+
+    last = pd.Timestamp(ctx.trade_date)
+    first = (last - pd.Timedelta(days=NEWS_DAYS - 1)).strftime("%Y%m%d")
+    slices = sync_reports.time_slices(first, ctx.trade_date, 6)
+    chunks = sync_reports.process_slices(
+        sync_reports.fetch_slices(ctx.client, slices, None),
+        limit=None,
+        concurrency=None,
+        use_cache=False,
+        fetch_canonicals=sync_reports.fetch_recent_canonicals if ctx.database else _no_stored_canonicals,
+    )
+    return sum(len(chunk.news) for chunk in chunks)
+
+
+BENCHMARKS: List[Benchmark] = [
+    Benchmark("price_features", bench_price_features),
+    Benchmark("price_feature_panel", bench_price_feature_panel),
+    Benchmark("factor_panel", bench_factor_panel),
+    Benchmark("factor_evaluation", bench_factor_evaluation),
+    Benchmark("raw_store_write", bench_raw_store_write),
+    Benchmark("raw_price_history", bench_raw_price_history),
+    Benchmark("financials_as_of_raw", bench_financials_as_of_raw),
+    Benchmark("news_enrich", bench_news_enrich),
+    Benchmark("db_load_prices", bench_db_load_prices, needs_db=True),
+    Benchmark("db_load_financials", bench_db_load_financials, needs_db=True),
+    Benchmark("fetch_financial_metrics", bench_fetch_financial_metrics, needs_db=True),
+    Benchmark("calc_features", bench_calc_features, needs_db=True),
+]
+
+
+def prepare(ctx: BenchContext) -> None:
+    from market.jobs import fetch_daily, sync_financials
+    from market.services import entity_linking
+    from market.services.storage import save_dataframe
+
+    started = time.perf_counter()
+    market = ctx.market
+    first_needed = pd.Timestamp(ctx.trade_date) - pd.Timedelta(days=WINDOW * 2)
+    window_dates = [day for day in market.date_strs if pd.Timestamp(day) >= first_needed]
+    ctx.data["history"] = market.price_history(ctx.trade_date, len(window_dates))
+    ctx.data["daily_frames"] = [(day, ctx.client.daily(day)) for day in window_dates]
+    for trade_date, frame in ctx.data["daily_frames"]:
+        save_dataframe(frame, "daily", trade_date)
+    financial_frames = []
+    for period in market.periods():
+        frame = sync_financials.transform(ctx.client.fina_indicator(period))
+        save_dataframe(frame, "financials", period)
+        financial_frames.append((period, frame))
+    ctx.data["financial_frames"] = financial_frames
+    entity_linking.load_linker(ctx.client)
+    entity_linking.get_linker.cache_clear()
+    if ctx.database:
+        from market.services.schema import migrate
+
+        migrate()
+        for trade_date, frame in ctx.data["daily_frames"]:
+            fetch_daily.load_dataframe(frame.copy(), trade_date, replace=True)
+        for period, frame in financial_frames:
+            sync_financials.load_dataframe(frame.copy(), period, replace=True)
+    logger.info("Prepared synthetic inputs in %.1fs.", time.perf_counter() - started)
+
+
+def calibrate(rounds: int = 7) -> float:
+    # A fixed numpy/pandas/interpreter workload; results are compared relative to it so a
+    # baseline recorded on one machine still means something on another.
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        values = np.random.default_rng(0).random(1_000_000)
+        np.sort(values)
+        pd.DataFrame({"key": (values * 97).astype("int64"), "value": values}).groupby("key")["value"].mean()
+        sum(index * index for index in range(300_000))
+        timings.append(time.perf_counter() - started)
+    # The fastest round is the least disturbed by other load on the machine.
+    return min(timings)
+
+
+def measure(benchmark: Benchmark, ctx: BenchContext, repeat: int) -> Dict:
+    wall, cpu = [], []
+    rows = 0
+    for _ in range(max(1, repeat)):
+        started, started_cpu = time.perf_counter(), time.process_time()
+        rows = int(benchmark.action(ctx) or 0)
+        wall.append(time.perf_counter() - started)
+        cpu.append(time.process_time() - started_cpu)
+    seconds = statistics.median(wall)
+    return {
+        "seconds": round(seconds, 4),
+        "min_seconds": round(min(wall), 4),
+        "cpu_seconds": round(statistics.median(cpu), 4),
+        "rows": rows,
+        "rows_per_second": round(rows / seconds, 1) if rows and seconds else None,
+        "peak_rss_mb": metrics.peak_rss_mb(),
+    }
+
+
+def baseline_groups(benchmarks: List[Benchmark], scale_name: str) -> Dict[str, List[str]]:
+    groups: Dict[str, List[str]] = {}
+    for benchmark in benchmarks:
+        key = scale_name + DB_BASELINE_SUFFIX if benchmark.needs_db else scale_name
+        groups.setdefault(key, []).append(benchmark.name)
+    return groups
+
+
+def compare(
+    results: Dict, key: str, names: List[str], baseline: Optional[Dict], tolerance: float
+) -> Tuple[List[Dict], List[str]]:
+    # Returns regressions and the benchmarks the baseline stored under key has no entry for.
+    if not baseline:
+        logger.warning("No baseline recorded for %s; not comparing.", key)
+        return [], []
+    if baseline.get("scale") != results["scale"]:
+        logger.warning("Baseline for %s was recorded at a different scale; not comparing.", key)
+        return [], []
+    factor = results["calibration_seconds"] / baseline["calibration_seconds"]
+    regressions = []
+    missing = []
+    for name in names:
+        current = results["benchmarks"][name]
+        previous = baseline["benchmarks"].get(name)
+        if not previous:
+            missing.append(name)
+            continue
+        expected = previous["seconds"] * factor
+        current["baseline_seconds"] = round(expected, 4)
+        current["change"] = round(current["seconds"] / expected - 1, 3) if expected else None
+        if current["seconds"] > expected * (1 + tolerance) and current["seconds"] - expected > MIN_REGRESSION_SECONDS:
+            regressions.append({"benchmark": name, "seconds": current["seconds"], "expected_seconds": round(expected, 4)})
+    return regressions, missing
+
+
+def load_baseline(path: Path, key: str) -> Optional[Dict]:
+    if not path.exists():
+        return None
+    return json.loads(path.read_text(encoding="utf-8")).get("runs", {}).get(key)
+
+
+def update_baseline(path: Path, results: Dict, groups: Dict[str, List[str]]) -> None:
+    # Only the benchmarks this run measured are replaced; the rest keep their recorded timings.
+    stored = json.loads(path.read_text(encoding="utf-8")) if path.exists() else {"version": RESULTS_VERSION, "runs": {}}
+    for key, names in groups.items():
+        entry = stored["runs"].get(key)
+        if not entry or entry.get("scale") != results["scale"]:
+            entry = stored["runs"][key] = {
+                "scale": results["scale"],
+                "calibration_seconds": results["calibration_seconds"],
+                "benchmarks": {},
+            }
+        # New timings are rescaled to the calibration the entry was recorded with.
+        factor = entry["calibration_seconds"] / results["calibration_seconds"]
+        for name in names:
+            current = results["benchmarks"][name]
+            entry["benchmarks"][name] = {"seconds": round(current["seconds"] * factor, 4), "rows": current["rows"]}
+        entry["recorded_at"] = results["started_at"]
+        logger.info("Baseline for %s written to %s.", key, path)
+    path.write_text(json.dumps(stored, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+
+
+def render_markdown(results: Dict) -> str:
+    lines = [
+        f"# Benchmark {results['started_at']} ({results['scale_name']}: {results['scale']})",
+        "",
+        "| Benchmark | Median s | CPU s | Rows | Rows/s | Baseline s | Change |",
+        "|-----------|----------|-------|------|--------|------------|--------|",
+    ]
+    for name, item in results["benchmarks"].items():
+        change = f"{item['change']:+.1%}" if item.get("change") is not None else "-"
+        lines.append(
+            f"| {name} | {item['seconds']:.3f} | {item['cpu_seconds']:.3f} | {item['rows']} | "
+            f"{item['rows_per_second'] or '-'} | {item.get('baseline_seconds', '-')} | {change} |"
+        )
+    for name in results["skipped"]:
+        lines.append(f"| {name} | skipped (needs --database-url) | | | | | |")
+    if results["missing_baseline"]:
+        lines += ["", f"No baseline: {', '.join(results['missing_baseline'])}"]
+    if results["regressions"]:
+        lines += ["", "Regressions:"]
+        lines += [f"- {item['benchmark']}: {item['seconds']}s vs {item['expected_seconds']}s expected" for item in results["regressions"]]
+    return "\n".join(lines) + "\n"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on deterministic synthetic A-share data.")
+    parser.add_argument("--scale", choices=sorted(SCALES), default="default", help="Preset universe size and history length.")
+    parser.add_argument("--securities", type=int, help="Override the number of securities.")
+    parser.add_argument("--years", type=int, help="Override the years of daily history.")
+    parser.add_argument("--news-per-day", type=int, help="Override the synthetic news volume.")
+    parser.add_argument("--seed", type=int, default=7, help="Synthetic data seed.")
+    parser.add_argument("--only", nargs="+", choices=[benchmark.name for benchmark in BENCHMARKS], help="Benchmarks to run.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark; the median is reported.")
+    parser.add_argument(
+        "--database-url",
+        default=os.getenv("BENCH_DATABASE_URL"),
+        help="Scratch PostgreSQL database for the loader benchmarks; its tables are overwritten.",
+    )
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds the stub LLM waits per request.")
+    parser.add_argument("--output", type=Path, help="Directory for result files (default DATA_DIR/bench).")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_PATH, help="Baseline file to compare against.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Allowed slowdown before failing.")
+    parser.add_argument("--update-baseline", action="store_true", help="Store this run as the baseline for the scale.")
+    parser.add_argument("--keep-data", action="store_true", help="Keep the temporary data directory.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args = parse_args()
+    preset = SCALES[args.scale]
+    scale = Scale(
+        securities=args.securities or preset.securities,
+        years=args.years or preset.years,
+        news_per_day=args.news_per_day or preset.news_per_day,
+    )
+    output = args.output or Path(os.getenv("DATA_DIR", "data")).expanduser() / "bench"
+    scale_name = args.scale if scale == preset else "custom"
+    workdir = Path(tempfile.mkdtemp(prefix="market-bench-"))
+    regressions: List[Dict] = []
+    missing: List[str] = []
+    with StubLLMServer(args.llm_latency) as llm:
+        # Settings are read once per process, so the sandbox must be in place before any job code runs.
+        os.environ.update(
+            {
+                "DATA_DIR": str(workdir),
+                "DATABASE_URL": args.database_url or "postgresql://bench@127.0.0.1:1/unused",
+                "TUSHARE_TOKEN": "synthetic",
+                "TUSHARE_CALLS_PER_MINUTE": "1000000",
+                "TUSHARE_QUOTAS": ",".join(f"{endpoint}=1000000" for endpoint in TUSHARE_ENDPOINTS),
+                "LLM_ENDPOINT": llm.endpoint,
+                "LLM_API_KEY": "synthetic",
+                "RUN_LOG_PATH": str(workdir / "run-log.md"),
+            }
+        )
+        try:
+            started_at = datetime.now().isoformat(timespec="seconds")
+            logger.info("Generating synthetic market: %s.", scale)
+            market = SyntheticMarket(scale, seed=args.seed)
+            ctx = BenchContext(market, SyntheticTushareClient(market), market.date_strs[-1], bool(args.database_url))
+            selected = [benchmark for benchmark in BENCHMARKS if not args.only or benchmark.name in args.only]
+            runnable = [benchmark for benchmark in selected if ctx.database or not benchmark.needs_db]
+            prepare(ctx)
+            calibration = calibrate()
+            benchmarks = {}
+            for benchmark in runnable:
+                benchmarks[benchmark.name] = measure(benchmark, ctx, args.repeat)
+                logger.info("%-26s %8.3fs median, %s rows.", benchmark.name, benchmarks[benchmark.name]["seconds"], benchmarks[benchmark.name]["rows"])
+            results = {
+                "version": RESULTS_VERSION,
+                "started_at": started_at,
+                "scale_name": scale_name,
+                "scale": asdict(scale),
+                "seed": args.seed,
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "calibration_seconds": round(calibration, 4),
+                "database": ctx.database,
+                "llm_requests": llm.requests,
+                "benchmarks": benchmarks,
+                "skipped": [benchmark.name for benchmark in selected if benchmark not in runnable],
+                "stages": metrics.current().as_dict("ok")["stages"],
+            }
+            groups = baseline_groups(runnable, scale_name)
+            for key, names in groups.items():
+                group_regressions, group_missing = compare(
+                    results, key, names, load_baseline(args.baseline, key), args.tolerance
+                )
+                regressions += group_regressions
+                missing += group_missing
+            results["regressions"] = regressions
+            results["missing_baseline"] = missing
+            output.mkdir(parents=True, exist_ok=True)
+            stem = output / f"bench_{scale_name}_{datetime.now().strftime('%Y%m%dT%H%M%S')}"
+            stem.with_suffix(".json").write_text(json.dumps(results, indent=2, ensure_ascii=False), encoding="utf-8")
+            stem.with_suffix(".md").write_text(render_markdown(results), encoding="utf-8")
+            logger.info("Results written to %s.{json,md}.", stem)
+            if args.update_baseline:
+                update_baseline(args.baseline, results, groups)
+        finally:
+            if args.keep_data:
+                logger.info("Synthetic data kept in %s.", workdir)
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+    for regression in regressions:
+        logger.error(
+            "Regression in %s: %.3fs vs %.3fs expected.", regression["benchmark"], regression["seconds"], regression["expected_seconds"]
+        )
+    if missing and not args.update_baseline:
+        # An unrecorded benchmark would otherwise pass silently however slow it is.
+        logger.error("No baseline for: %s; record one with --update-baseline.", ", ".join(missing))
+    if (regressions or missing) and not args.update_baseline:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+from __future__ import annotations
+
+import hashlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from market.config import get_settings
+from market.services.tushare_client import TushareClient
+
+# Deterministic stand-in for the Tushare data the jobs consume: a listed universe, daily
+# bars, quarterly fina_indicator filings (with late restatements) and Sina-style news
+# that mentions listed companies and contains reposted near-duplicates.
+
+END_DATE = "20241231"
+DAILY_LIMIT = 0.1
+SUSPENSION_RATE = 0.01
+RESTATEMENT_RATE = 0.03
+REPOST_RATE = 0.1
+_REGIONS = [
+    "华东", "华北", "华南", "西部", "东方", "中原", "江南", "沪上", "深圳", "北京", "浙江", "江苏", "山东", "四川", "湖南",
+    "湖北", "福建", "广州", "天津", "重庆", "安徽", "河南", "陕西", "云南", "辽宁",
+]
+_CORES = [
+    "恒瑞", "鼎盛", "华光", "新源", "远航", "宏达", "长青", "金桥", "银河", "瑞丰", "天合", "博远", "正泰", "国信", "海川",
+    "中科", "明德", "汇通", "聚能", "卓越", "安泰", "永兴", "东升", "嘉禾", "立信", "万达", "森源", "联创", "星辰", "蓝海",
+]
+_INDUSTRIES = ["科技", "医药", "电子", "能源", "材料", "机械", "化工", "食品", "地产", "银行", "证券", "汽车", "传媒", "环保"]
+_EVENTS = [
+    "发布{period}业绩预告，预计净利润同比增长{pct}%",
+    "公告拟以{amount}亿元投资建设新生产基地",
+    "获得{count}家机构调研，关注新产品放量节奏",
+    "控股股东计划减持不超过{pct}%股份",
+    "中标{amount}亿元重大项目，订单储备充足",
+    "收到监管问询函，要求说明应收账款大幅增长原因",
+    "与行业龙头签署战略合作协议，共同开拓海外市场",
+    "回购计划实施完毕，累计回购金额{amount}亿元",
+]
+# Body text is drawn from a vocabulary of random two-character words, so unrelated articles
+# share few shingles and only reposts look like near-duplicates to MinHash.
+_CHARACTERS = (
+    "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所"
+    "民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日"
+    "那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想"
+)
+_VOCABULARY = [_CHARACTERS[first] + _CHARACTERS[second] for first, second in np.random.default_rng(11).integers(0, len(_CHARACTERS), size=(4000, 2))]
+
+
+@dataclass(frozen=True)
+class Scale:
+    securities: int
+    years: int
+    news_per_day: int
+
+
+SCALES: Dict[str, Scale] = {
+    "smoke": Scale(securities=200, years=1, news_per_day=40),
+    "default": Scale(securities=1000, years=3, news_per_day=200),
+    "full": Scale(securities=5500, years=15, news_per_day=1500),
+}
+
+
+def _seed(*parts: object) -> int:
+    digest = hashlib.blake2b("|".join(map(str, parts)).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class SyntheticMarket:
+    def __init__(self, scale: Scale, seed: int = 7) -> None:
+        self.scale = scale
+        self.seed = seed
+        end = pd.Timestamp(END_DATE)
+        self.dates = pd.bdate_range(end - pd.DateOffset(years=scale.years) + pd.Timedelta(days=1), end)
+        self.date_strs = [day.strftime("%Y%m%d") for day in self.dates]
+        self._date_positions = {date_str: index for index, date_str in enumerate(self.date_strs)}
+        self.universe = self._universe()
+        self.close, self.volume = self._bars()
+
+    @property
+    def security_ids(self) -> np.ndarray:
+        return self.universe["ts_code"].to_numpy()
+
+    def _universe(self) -> pd.DataFrame:
+        rng = np.random.default_rng(_seed(self.seed, "universe"))
+        count = self.scale.securities
+        combos = len(_REGIONS) * len(_CORES) * len(_INDUSTRIES)
+        if count > combos:
+            raise ValueError(f"At most {combos} synthetic securities are supported.")
+        picks = rng.permutation(combos)[:count]
+        rows = []
+        for index, pick in enumerate(picks):
+            region = _REGIONS[pick // (len(_CORES) * len(_INDUSTRIES))]
+            core = _CORES[(pick // len(_INDUSTRIES)) % len(_CORES)]
+            industry = _INDUSTRIES[pick % len(_INDUSTRIES)]
+            board = index % 3
+            if board == 0:
+                symbol, exchange = f"{600000 + index:06d}", "SH"
+            elif board == 1:
+                symbol, exchange = f"{1 + index:06d}", "SZ"
+            else:
+                symbol, exchange = f"{300001 + index:06d}", "SZ"
+            rows.append(
+                {
+                    "ts_code": f"{symbol}.{exchange}",
+                    "symbol": symbol,
+                    "name": f"{region}{core}{industry[:1]}",
+                    "fullname": f"{region}{core}{industry}股份有限公司",
+                    "enname": f"Synthetic {core} {industry} Co Ltd {index}",
+                    "exchange": "SSE" if exchange == "SH" else "SZSE",
+                }
+            )
+        return pd.DataFrame(rows)
+
+    def _bars(self):
+        # Dense float32 date x security panels: a market factor plus idiosyncratic noise,
+        # clipped at the daily price limit, with occasional suspensions (NaN).
+        rng = np.random.default_rng(_seed(self.seed, "bars"))
+        days, count = len(self.dates), self.scale.securities
+        market = rng.normal(0.0003, 0.012, size=(days, 1))
+        beta = rng.uniform(0.6, 1.4, size=(1, count))
+        returns = np.clip(market * beta + rng.standard_t(4, size=(days, count)) * 0.012, -DAILY_LIMIT, DAILY_LIMIT)
+        start = rng.lognormal(2.5, 0.8, size=count)
+        close = (start * np.exp(np.cumsum(np.log1p(returns), axis=0))).astype("float32")
+        volume = (rng.lognormal(11, 1.0, size=(1, count)) * rng.lognormal(0, 0.35, size=(days, count))).astype("float32")
+        suspended = rng.random((days, count)) < SUSPENSION_RATE
+        close[suspended] = np.nan
+        volume[suspended] = np.nan
+        return close, volume
+
+    def daily(self, trade_date: str) -> pd.DataFrame:
+        position = self._date_positions.get(trade_date)
+        if position is None:
+            return pd.DataFrame(columns=["ts_code", "trade_date", "open", "high", "low", "close", "vol", "amount"])
+        close = self.close[position].astype("float64")
+        previous = self.close[position - 1].astype("float64") if position else close
+        traded = ~np.isnan(close)
+        rng = np.random.default_rng(_seed(self.seed, "ohlc", trade_date))
+        spread = np.abs(rng.normal(0, 0.01, size=len(close)))
+        open_ = np.where(np.isnan(previous), close, previous) * (1 + rng.normal(0, 0.005, size=len(close)))
+        volume = self.volume[position].astype("float64")
+        df = pd.DataFrame(
+            {
+                "ts_code": self.security_ids,
+                "trade_date": trade_date,
+                "open": open_.round(2),
+                "high": (np.maximum(open_, close) * (1 + spread)).round(2),
+                "low": (np.minimum(open_, close) * (1 - spread)).round(2),
+                "close": close.round(2),
+                "vol": volume.round(0),
+                # Tushare reports vol in lots of 100 shares and amount in thousands of yuan.
+                "amount": (volume * close * 100 / 1000).round(3),
+            }
+        )
+        return df[traded].reset_index(drop=True)
+
+    def price_history(self, end_date: str, days: int) -> pd.DataFrame:
+        # Long (security_id, trade_date, close, volume) rows as fetch_price_history returns them.
+        end = self._date_positions[end_date] + 1
+        start = max(0, end - days)
+        close = self.close[start:end]
+        volume = self.volume[start:end]
+        df = pd.DataFrame(
+            {
+                "security_id": np.tile(self.security_ids, end - start),
+                "trade_date": np.repeat(self.dates[start:end].values, len(self.security_ids)),
+                "close": close.ravel().astype("float64"),
+                "volume": volume.ravel().astype("float64"),
+            }
+        )
+        df = df.dropna(subset=["close"])
+        return df.sort_values(["security_id", "trade_date"], kind="mergesort").reset_index(drop=True)
+
+    def pivots(self, end_date: Optional[str] = None, days: Optional[int] = None):
+        end = self._date_positions[end_date or self.date_strs[-1]] + 1
+        start = 0 if days is None else max(0, end - days)
+        index = pd.DatetimeIndex(self.dates[start:end], name="trade_date")
+        columns = pd.Index(self.security_ids, name="security_id")
+        return (
+            pd.DataFrame(self.close[start:end], index=index, columns=columns),
+            pd.DataFrame(self.volume[start:end], index=index, columns=columns),
+        )
+
+    def periods(self) -> List[str]:
+        first = self.dates[0] - pd.offsets.QuarterEnd(1)
+        return [day.strftime("%Y%m%d") for day in pd.date_range(first, self.dates[-1], freq="QE")]
+
+    def fina_indicator(self, period: str) -> pd.DataFrame:
+        period_end = pd.Timestamp(period)
+        rng = np.random.default_rng(_seed(self.seed, "fina", period))
+        count = self.scale.securities
+        deadline = {3: 30, 6: 62, 9: 31, 12: 120}[period_end.month]
+        ann = period_end + pd.to_timedelta(rng.integers(10, deadline + 1, size=count), unit="D")
+        df = pd.DataFrame(
+            {
+                "ts_code": self.security_ids,
+                "ann_date": ann.strftime("%Y%m%d"),
+                "end_date": period,
+                "roe": rng.normal(8, 6, count).round(4),
+                "roa": rng.normal(4, 3, count).round(4),
+                "q_dtprofit": rng.lognormal(18, 1.5, count).round(2),
+                "q_dtprofit_yoy": rng.normal(10, 30, count).round(4),
+                "grossprofit_margin": rng.uniform(5, 60, count).round(4),
+                "netprofit_margin": rng.normal(10, 8, count).round(4),
+                "asset_turn": rng.uniform(0.1, 1.5, count).round(4),
+            }
+        )
+        restated = df[rng.random(count) < RESTATEMENT_RATE].copy()
+        if not restated.empty:
+            later = pd.to_datetime(restated["ann_date"]) + pd.to_timedelta(rng.integers(30, 200, len(restated)), unit="D")
+            restated["ann_date"] = later.dt.strftime("%Y%m%d")
+            restated["roe"] = (restated["roe"] * rng.uniform(0.8, 1.2, len(restated))).round(4)
+            df = pd.concat([df, restated], ignore_index=True)
+        return df
+
+    def fina_indicator_announced(self, start_date: str, end_date: str) -> pd.DataFrame:
+        frames = [self.fina_indicator(period) for period in self.periods()]
+        df = pd.concat(frames, ignore_index=True)
+        return df[(df["ann_date"] >= start_date) & (df["ann_date"] <= end_date)].reset_index(drop=True)
+
+    def news_for_day(self, day: pd.Timestamp) -> pd.DataFrame:
+        rng = np.random.default_rng(_seed(self.seed, "news", day.strftime("%Y%m%d")))
+        names = self.universe["name"].to_numpy()
+        count = self.scale.news_per_day
+        seconds = np.sort(rng.integers(0, 86400, size=count))
+        rows = []
+        for index in range(count):
+            published = day + pd.Timedelta(seconds=int(seconds[index]))
+            if rows and rng.random() < REPOST_RATE:
+                # A repost of an earlier story with a new lead-in and a trimmed tail.
+                source = rows[int(rng.integers(0, len(rows)))]
+                content = "【转载】" + source["content"][: max(40, int(len(source["content"]) * 0.9))]
+                rows.append({"datetime": published.strftime("%Y-%m-%d %H:%M:%S"), "title": source["title"], "content": content})
+                continue
+            mentioned = names[rng.integers(0, len(names), size=int(rng.integers(1, 3)))]
+            event = _EVENTS[int(rng.integers(0, len(_EVENTS)))].format(
+                period="半年度", pct=int(rng.integers(5, 120)), amount=int(rng.integers(1, 50)), count=int(rng.integers(5, 80))
+            )
+            title = f"{mentioned[0]}{event[:18]}"
+            sentences = [f"{mentioned[0]}{event}。"]
+            for _ in range(int(rng.integers(3, 25))):
+                words = rng.integers(0, len(_VOCABULARY), size=int(rng.integers(6, 16)))
+                sentences.append("".join(_VOCABULARY[int(word)] for word in words) + "。")
+            if len(mentioned) > 1:
+                sentences.insert(2, f"同行业的{mentioned[1]}近期也有类似动作。")
+            rows.append({"datetime": published.strftime("%Y-%m-%d %H:%M:%S"), "title": title, "content": "".join(sentences)})
+        return pd.DataFrame(rows, columns=["datetime", "title", "content"])
+
+    def news(self, start_date: str, end_date: str) -> pd.DataFrame:
+        start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+        frames = [self.news_for_day(day) for day in pd.date_range(start.normalize(), end.normalize(), freq="D")]
+        if not frames:
+            return pd.DataFrame(columns=["datetime", "title", "content"])
+        df = pd.concat(frames, ignore_index=True)
+        published = pd.to_datetime(df["datetime"])
+        return df[(published >= start) & (published < end)].reset_index(drop=True)
+
+
+class SyntheticProApi:
+    # Answers the subset of the tushare pro_api query() surface the client uses.
+
+    def __init__(self, market: SyntheticMarket) -> None:
+        self.market = market
+
+    def query(self, endpoint: str, **params) -> pd.DataFrame:
+        market = self.market
+        if endpoint == "daily":
+            df = market.daily(params["trade_date"])
+        elif endpoint == "fina_indicator":
+            if "period" in params:
+                df = market.fina_indicator(params["period"])
+            else:
+                df = market.fina_indicator_announced(params["start_date"], params["end_date"])
+        elif endpoint == "news":
+            df = market.news(params["start_date"], params["end_date"])
+        elif endpoint == "stock_basic":
+            df = market.universe
+        elif endpoint == "namechange":
+            df = market.universe[["ts_code", "name"]].assign(start_date="20000101", end_date=None)
+        elif endpoint == "trade_cal":
+            dates = [day for day in market.date_strs if params["start_date"] <= day <= params["end_date"]]
+            df = pd.DataFrame({"cal_date": dates})
+        else:
+            raise ValueError(f"Synthetic Tushare has no endpoint {endpoint}.")
+        offset, limit = params.get("offset"), params.get("limit")
+        if limit is not None:
+            df = df.iloc[int(offset or 0) : int(offset or 0) + int(limit)]
+        return df.reset_index(drop=True)
+
+
+class SyntheticTushareClient(TushareClient):
+    # The real client (rate limiter, retries, pagination) over the synthetic API.
+
+    def __init__(self, market: SyntheticMarket) -> None:
+        self._client = SyntheticProApi(market)
+        self._cache_ttl = None
+        self._cache_root: Path = get_settings().data_root / "cache" / "tushare"
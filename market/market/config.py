@@ -1,9 +1,9 @@
 from __future__ import annotations
 
 import os
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional
+from typing import Dict, Optional
 
 from dotenv import load_dotenv
 
@@ -15,6 +15,20 @@ class Settings:
     llm_endpoint: Optional[str]
     llm_api_key: Optional[str]
     data_root: Path
+    llm_concurrency: int = 8
+    llm_requests_per_minute: Optional[int] = None
+    llm_tokens_per_minute: Optional[int] = None
+    llm_cache_max_entries: int = 200_000
+    llm_cache_max_age_days: int = 180
+    tushare_calls_per_minute: int = 500
+    tushare_quotas: Dict[str, int] = field(default_factory=dict)
+    tushare_cache_ttl_seconds: Optional[int] = None
+    run_log_path: Optional[Path] = None
+    embedding_backend: str = "local"
+    embedding_endpoint: Optional[str] = None
+    embedding_api_key: Optional[str] = None
+    embedding_model: str = "text-embedding-3-small"
+    embedding_batch_size: int = 64
 
 
 def _resolve_data_root() -> Path:
@@ -23,9 +37,36 @@ def _resolve_data_root() -> Path:
     path.mkdir(parents=True, exist_ok=True)
     (path / "raw").mkdir(parents=True, exist_ok=True)
     (path / "logs").mkdir(parents=True, exist_ok=True)
+    (path / "cache").mkdir(parents=True, exist_ok=True)
     return path
 
 
+def _resolve_run_log(data_root: Path) -> Path:
+    configured = os.getenv("RUN_LOG_PATH")
+    if configured:
+        return Path(configured).expanduser().resolve()
+    # docs/run-log.md in a source checkout, otherwise next to the job logs.
+    docs = Path(__file__).resolve().parents[2] / "docs"
+    return docs / "run-log.md" if docs.is_dir() else data_root / "logs" / "run-log.md"
+
+
+def _optional_int(name: str) -> Optional[int]:
+    value = os.getenv(name)
+    if not value:
+        return None
+    return int(value)
+
+
+def _parse_quotas(value: Optional[str]) -> Dict[str, int]:
+    quotas: Dict[str, int] = {}
+    for item in (value or "").split(","):
+        if "=" not in item:
+            continue
+        endpoint, limit = item.split("=", 1)
+        quotas[endpoint.strip()] = int(limit)
+    return quotas
+
+
 _cached_settings: Optional[Settings] = None
 
 
@@ -39,12 +80,27 @@ def get_settings() -> Settings:
             raise RuntimeError("DATABASE_URL is not set; please update your .env file.")
         if not tushare_token:
             raise RuntimeError("TUSHARE_TOKEN is not set; please update your .env file.")
+        data_root = _resolve_data_root()
         _cached_settings = Settings(
             database_url=database_url,
             tushare_token=tushare_token,
             llm_endpoint=os.getenv("LLM_ENDPOINT"),
             llm_api_key=os.getenv("LLM_API_KEY"),
-            data_root=_resolve_data_root(),
+            data_root=data_root,
+            llm_concurrency=_optional_int("LLM_CONCURRENCY") or 8,
+            llm_requests_per_minute=_optional_int("LLM_REQUESTS_PER_MINUTE"),
+            llm_tokens_per_minute=_optional_int("LLM_TOKENS_PER_MINUTE"),
+            llm_cache_max_entries=_optional_int("LLM_CACHE_MAX_ENTRIES") or 200_000,
+            llm_cache_max_age_days=_optional_int("LLM_CACHE_MAX_AGE_DAYS") or 180,
+            tushare_calls_per_minute=_optional_int("TUSHARE_CALLS_PER_MINUTE") or 500,
+            tushare_quotas=_parse_quotas(os.getenv("TUSHARE_QUOTAS")),
+            tushare_cache_ttl_seconds=_optional_int("TUSHARE_CACHE_TTL_SECONDS"),
+            run_log_path=_resolve_run_log(data_root),
+            embedding_backend=(os.getenv("EMBEDDING_BACKEND") or "local").lower(),
+            embedding_endpoint=os.getenv("EMBEDDING_ENDPOINT"),
+            embedding_api_key=os.getenv("EMBEDDING_API_KEY"),
+            embedding_model=os.getenv("EMBEDDING_MODEL") or "text-embedding-3-small",
+            embedding_batch_size=_optional_int("EMBEDDING_BATCH_SIZE") or 64,
         )
     return _cached_settings
 
@@ -3,15 +3,40 @@ from __future__ import annotations
 import argparse
 import logging
 from datetime import date, timedelta
+from typing import Optional, Tuple
 
+import numpy as np
 import pandas as pd
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 
-from market.services.db import get_engine
-from market.services.storage import save_dataframe
+from market.services import metrics
+from market.services.db import bulk_upsert, get_engine, read_frame
+from market.services.factors import compute_panel, required_lookback, resolve
+from market.services.fundamentals import as_of_join, financials_as_of, load_intervals
+from market.services.price_matrix import PriceMatrix
+from market.services.rolling_state import RollingPriceState, max_feature_difference
+from market.services.screening import bump_version
+from market.services.sentiment import SENTIMENT_WINDOWS, daily_rollup, fetch_rollup, rolling_features
+from market.services.storage import read_raw, save_dataframe, save_partitioned
 
 logger = logging.getLogger("jobs.calc_features")
 
+KEY_COLUMNS = ("security_id", "snapshot_date")
+PRICE_FEATURES = ["close", "ret_5d", "ret_20d", "vol_ratio_5_20"]
+FINANCIAL_COLUMNS = ["roe", "netprofit_margin", "grossprofit_margin", "asset_turn"]
+VERIFY_TOLERANCE = 1e-6
+# Security IDs repeat on every row and volume/amount only feed ratios, so those shrink to
+# category/float32. close stays float64: it is written to the snapshot as is, and float32
+# would store 1234.56 as 1234.5600586.
+PRICE_DTYPES = {
+    "security_id": "category",
+    "trade_date": "datetime64[ns]",
+    "close": "float64",
+    "volume": "float32",
+    "amount": "float32",
+}
+
 
 def _validate_date(value: str) -> str:
     if len(value) != 8 or not value.isdigit():
@@ -26,112 +51,269 @@ def _default_date() -> str:
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Calculate factor features for A-share universe.")
     parser.add_argument("--date", type=_validate_date, default=_default_date(), help="Trade date in YYYYMMDD.")
+    parser.add_argument("--start", type=_validate_date, help="First snapshot date in YYYYMMDD (enables range mode).")
+    parser.add_argument("--end", type=_validate_date, help="Last snapshot date in YYYYMMDD (defaults to --date).")
     parser.add_argument("--window", type=int, default=60, help="Number of historical days to include.")
+    parser.add_argument(
+        "--source",
+        choices=["db", "raw", "matrix"],
+        default="db",
+        help="Read prices from PostgreSQL, the local raw store or the memory-mapped price matrix.",
+    )
     parser.add_argument("--replace", action="store_true", help="Replace existing snapshot for the date.")
-    return parser.parse_args()
+    parser.add_argument("--incremental", action="store_true", help="Advance the saved rolling state by one trade date.")
+    parser.add_argument("--verify", action="store_true", help="Check incremental features against a full recompute.")
+    parser.add_argument(
+        "--factors",
+        default="base",
+        help="Price factors to compute: base, all, or a comma-separated list of factor names.",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="Processes to shard factor computation across.")
+    metrics.add_profile_arguments(parser)
+    args = parser.parse_args()
+    try:
+        factors = resolve(args.factors)
+    except KeyError as exc:
+        parser.error(exc.args[0])
+    # The rolling state only carries the base features.
+    if args.incremental and factors != PRICE_FEATURES:
+        parser.error("--incremental only supports --factors base")
+    if args.incremental and args.source != "db":
+        parser.error("--incremental reads prices from the database; --source raw|matrix is not supported")
+    return args
 
 
-def fetch_price_history(trade_date: str, window: int) -> pd.DataFrame:
-    engine = get_engine()
+def fetch_price_history(trade_date: str, window: int, start_date: Optional[str] = None, source: str = "db") -> pd.DataFrame:
     end_date = pd.to_datetime(trade_date)
-    start_date = end_date - timedelta(days=window * 2)
-    with engine.connect() as conn:
-        result = conn.execute(
-            text(
-                """
-                SELECT security_id, trade_date, close, volume
-                FROM daily_prices
-                WHERE trade_date BETWEEN :start_date AND :end_date
-                ORDER BY security_id, trade_date
-                """
-            ),
-            {"start_date": start_date, "end_date": end_date},
-        )
-        df = pd.DataFrame(result.fetchall(), columns=result.keys())
-    if df.empty:
-        return df
-    df["trade_date"] = pd.to_datetime(df["trade_date"])
-    return df
+    first_date = pd.to_datetime(start_date) if start_date else end_date
+    window_start = first_date - timedelta(days=window * 2)
+    if source == "raw":
+        return _fetch_price_history_raw(window_start, end_date)
+    return read_frame(
+        """
+        SELECT security_id, trade_date, close, volume, amount
+        FROM daily_prices
+        WHERE trade_date BETWEEN :start_date AND :end_date
+        ORDER BY security_id, trade_date
+        """,
+        {"start_date": window_start, "end_date": end_date},
+        PRICE_DTYPES,
+    )
 
 
-def compute_price_features(df: pd.DataFrame, trade_date: str) -> pd.DataFrame:
+def history_window(window: int, factors: Optional[str] = None) -> int:
+    # Longer factors (250-day highs, 120-day momentum) need more history than --window.
+    return max(window, required_lookback(resolve(factors)))
+
+
+def compute_price_features(
+    df: pd.DataFrame, trade_date: str, factors: Optional[str] = None, workers: int = 1
+) -> pd.DataFrame:
     if df.empty:
         return df
-    pivot = df.pivot(index="trade_date", columns="security_id", values="close")
     target_date = pd.to_datetime(trade_date)
-    if target_date not in pivot.index:
+    if target_date not in set(df["trade_date"]):
         logger.warning("Trade date %s not present in daily_prices.", trade_date)
         return pd.DataFrame()
-    returns = pivot.pct_change()
-    rolling_5 = returns.rolling(5).sum()
-    rolling_20 = returns.rolling(20).sum()
+    features = compute_price_feature_panel(df, trade_date, trade_date, factors, workers)
+    return features.drop(columns="snapshot_date")
+
+
+def _fetch_price_history_raw(start_date: pd.Timestamp, end_date: pd.Timestamp) -> pd.DataFrame:
+    df = read_raw(
+        "daily",
+        start=start_date.strftime("%Y%m%d"),
+        end=end_date.strftime("%Y%m%d"),
+        columns=["ts_code", "trade_date", "close", "vol", "amount"],
+    )
+    if df.empty:
+        return pd.DataFrame(columns=list(PRICE_DTYPES)).astype(PRICE_DTYPES)
+    df = df.rename(columns={"ts_code": "security_id", "vol": "volume"})
+    df["trade_date"] = pd.to_datetime(df["trade_date"])
+    return df.sort_values(["security_id", "trade_date"]).reset_index(drop=True).astype(PRICE_DTYPES)
+
+
+def fetch_trade_date_prices(trade_date: str) -> pd.DataFrame:
+    # Same precision as fetch_price_history, so incremental and full recomputes agree.
+    return read_frame(
+        "SELECT security_id, close, volume FROM daily_prices WHERE trade_date = :trade_date",
+        {"trade_date": pd.to_datetime(trade_date)},
+        {"close": "float64", "volume": "float32"},
+    )
+
+
+def fetch_previous_trade_date(trade_date: str) -> Optional[pd.Timestamp]:
+    engine = get_engine()
+    with engine.connect() as conn:
+        previous = conn.execute(
+            text("SELECT MAX(trade_date) FROM daily_prices WHERE trade_date < :trade_date"),
+            {"trade_date": pd.to_datetime(trade_date)},
+        ).scalar()
+    return pd.Timestamp(previous) if previous is not None else None
+
+
+def _incremental_blocker(state: Optional[RollingPriceState], trade_date: str, lookback_days: int) -> Optional[str]:
+    if state is None:
+        return "no saved state"
+    if state.lookback_days != lookback_days:
+        return "window changed"
+    target_date = pd.to_datetime(trade_date)
+    if state.last_date is None or state.last_date >= target_date:
+        return f"state already at {state.last_date}"
+    previous = fetch_previous_trade_date(trade_date)
+    if previous != state.last_date:
+        return f"gap between state {state.last_date.date()} and previous trade date {previous}"
+    return None
+
+
+def compute_price_features_incremental(trade_date: str, window: int, replace: bool, verify: bool) -> pd.DataFrame:
+    target_date = pd.to_datetime(trade_date)
+    lookback_days = window * 2
+    state = None if replace else RollingPriceState.load()
+    reason = "--replace requested" if replace else _incremental_blocker(state, trade_date, lookback_days)
+    if reason is None:
+        day = fetch_trade_date_prices(trade_date)
+        if day.empty:
+            logger.warning("Trade date %s not present in daily_prices.", trade_date)
+            return pd.DataFrame()
+        state.update(target_date, day)
+        features = state.features()
+        if verify:
+            expected = compute_price_features(fetch_price_history(trade_date, window), trade_date)
+            difference = max_feature_difference(expected, features)
+            if difference > VERIFY_TOLERANCE:
+                reason = f"verification mismatch (max diff {difference:g})"
+            else:
+                logger.info("Incremental features match full recompute (max diff %g).", difference)
+        if reason is None:
+            state.save()
+            return features
+    logger.info("Rebuilding rolling feature state from full history: %s.", reason)
+    history = fetch_price_history(trade_date, window)
+    features = compute_price_features(history, trade_date)
+    if not features.empty:
+        RollingPriceState.from_history(history, target_date, lookback_days).save()
+    return features
+
+
+def compute_price_feature_panel(
+    df: pd.DataFrame, start_date: str, end_date: str, factors: Optional[str] = None, workers: int = 1
+) -> pd.DataFrame:
+    if df.empty:
+        return pd.DataFrame()
+    pivot = df.pivot(index="trade_date", columns="security_id", values="close")
     vol = df.pivot(index="trade_date", columns="security_id", values="volume")
-    vol_mean_5 = vol.rolling(5).mean()
-    vol_mean_20 = vol.rolling(20).mean()
-    close_series = pivot.loc[target_date]
-    ret5_series = rolling_5.loc[target_date]
-    ret20_series = rolling_20.loc[target_date]
-    vol_ratio = (vol_mean_5.loc[target_date] / vol_mean_20.loc[target_date]).replace([pd.NA, float("inf")], None)
+    amount = df.pivot(index="trade_date", columns="security_id", values="amount") if "amount" in df.columns else None
+    return compute_price_feature_panel_from_pivots(pivot, vol, start_date, end_date, amount, factors, workers)
+
+
+def load_price_pivots_from_matrix(
+    end_date: str, window: int, start_date: Optional[str] = None
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    matrix = PriceMatrix()
+    first_date = pd.to_datetime(start_date or end_date) - timedelta(days=window * 2)
+    start = first_date.strftime("%Y%m%d")
+    return tuple(matrix.frame(field, start, end_date) for field in ("close", "volume", "amount"))
+
+
+def fetch_snapshot_closes(start_date: str, end_date: str, connection: Optional[Connection] = None) -> pd.DataFrame:
+    # The matrix holds float32 bars; snapshots store close as the exchange printed it.
+    return read_frame(
+        """
+        SELECT security_id, trade_date AS snapshot_date, close
+        FROM daily_prices
+        WHERE trade_date BETWEEN :start_date AND :end_date
+        """,
+        {"start_date": pd.to_datetime(start_date), "end_date": pd.to_datetime(end_date)},
+        {"snapshot_date": "datetime64[ns]", "close": "float64"},
+        connection,
+    )
+
+
+def with_exact_close(price_panel: pd.DataFrame, closes: pd.DataFrame) -> pd.DataFrame:
+    exact = closes.set_index(["snapshot_date", "security_id"])["close"]
+    keys = pd.MultiIndex.from_frame(price_panel[["snapshot_date", "security_id"]])
+    return price_panel.assign(close=exact.reindex(keys).to_numpy())
+
+
+def compute_price_feature_panel_from_pivots(
+    pivot: pd.DataFrame,
+    vol: pd.DataFrame,
+    start_date: str,
+    end_date: str,
+    amount: Optional[pd.DataFrame] = None,
+    factors: Optional[str] = None,
+    workers: int = 1,
+) -> pd.DataFrame:
+    # Every factor comes out of one shared pass over the date x security panel; only rows in
+    # [start_date, end_date] are materialized.
+    names = resolve(factors)
+    first_row = int(pivot.index.searchsorted(pd.to_datetime(start_date), side="left"))
+    last_row = int(pivot.index.searchsorted(pd.to_datetime(end_date), side="right"))
+    vol = vol.reindex(index=pivot.index, columns=pivot.columns)
+    if amount is not None:
+        amount = amount.reindex(index=pivot.index, columns=pivot.columns).to_numpy(dtype="float64")
+    panels = compute_panel(
+        pivot.to_numpy(dtype="float64")[:last_row],
+        vol.to_numpy(dtype="float64")[:last_row],
+        amount[:last_row] if amount is not None else None,
+        names,
+        first_row=first_row,
+        workers=workers,
+    )
+    dates = pivot.index[first_row:last_row]
+    securities = pivot.columns
     features = pd.DataFrame(
         {
-            "security_id": close_series.index,
-            "close": close_series.values,
-            "ret_5d": ret5_series.values,
-            "ret_20d": ret20_series.values,
-            "vol_ratio_5_20": vol_ratio.values,
+            "snapshot_date": np.repeat(dates.values, len(securities)),
+            "security_id": np.tile(securities.values, len(dates)),
         }
     )
-    return features
+    for name in names:
+        features[name] = panels[name].ravel()
+    return features.dropna(subset=names, how="all").reset_index(drop=True)
 
 
 def fetch_financial_metrics(trade_date: str) -> pd.DataFrame:
-    engine = get_engine()
-    with engine.connect() as conn:
-        result = conn.execute(
-            text(
-                """
-                SELECT DISTINCT ON (security_id)
-                    security_id,
-                    period_end,
-                    roe,
-                    netprofit_margin,
-                    grossprofit_margin,
-                    asset_turn
-                FROM financial_metrics
-                WHERE period_end <= :trade_date
-                ORDER BY security_id, period_end DESC
-                """
-            ),
-            {"trade_date": pd.to_datetime(trade_date)},
-        )
-        df = pd.DataFrame(result.fetchall(), columns=result.keys())
+    # Point-in-time lookup: only filings announced on or before trade_date are visible.
+    df = financials_as_of(trade_date)
     if df.empty:
         return df
-    numeric_cols = ["roe", "netprofit_margin", "grossprofit_margin", "asset_turn"]
-    for column in numeric_cols:
-        if column in df.columns:
-            df[column] = pd.to_numeric(df[column], errors="coerce")
-    return df
+    return df[["security_id", "period_end", *FINANCIAL_COLUMNS]]
+
+
+def fetch_financial_history(end_date: str, source: str = "db") -> pd.DataFrame:
+    return load_intervals(end_date, source=source)
 
 
 def fetch_sentiment(trade_date: str) -> pd.DataFrame:
-    engine = get_engine()
-    end_dt = pd.to_datetime(trade_date)
-    start_dt = end_dt - timedelta(days=30)
-    with engine.connect() as conn:
-        result = conn.execute(
-            text(
-                """
-                SELECT security_id, AVG(sentiment) AS sentiment_30d
-                FROM news
-                WHERE publish_time BETWEEN :start AND :end
-                GROUP BY security_id
-                """
-            ),
-            {"start": start_dt, "end": end_dt},
-        )
-        df = pd.DataFrame(result.fetchall(), columns=result.keys())
-    return df
+    panel = fetch_sentiment_panel(trade_date, trade_date)
+    return panel.drop(columns="snapshot_date")
+
+
+def _fetch_daily_sentiment_raw(first_day: pd.Timestamp, last_day: pd.Timestamp) -> pd.DataFrame:
+    news = read_raw(
+        "news",
+        start=first_day.strftime("%Y%m%d"),
+        end=last_day.strftime("%Y%m%d"),
+        columns=["news_id", "security_id", "publish_time", "sentiment", "duplicate_of"],
+    )
+    if news.empty:
+        return news
+    news = news.drop_duplicates("news_id")
+    news["publish_time"] = pd.to_datetime(news["publish_time"])
+    return daily_rollup(news[news["publish_time"] < last_day])
+
+
+def fetch_sentiment_panel(start_date: str, end_date: str, source: str = "db") -> pd.DataFrame:
+    # The rollup holds one row per security and day, so every window reads the same small range.
+    first_day = pd.to_datetime(start_date) - timedelta(days=max(SENTIMENT_WINDOWS))
+    last_day = pd.to_datetime(end_date)
+    if source == "raw":
+        daily = _fetch_daily_sentiment_raw(first_day, last_day)
+    else:
+        daily = fetch_rollup(first_day, last_day)
+    return rolling_features(daily, start_date, end_date)
 
 
 def combine_features(price_features: pd.DataFrame, financials: pd.DataFrame, sentiment: pd.DataFrame, trade_date: str) -> pd.DataFrame:
@@ -146,35 +328,140 @@ def combine_features(price_features: pd.DataFrame, financials: pd.DataFrame, sen
     return combined
 
 
-def load_snapshot(df: pd.DataFrame, trade_date: str, replace: bool) -> None:
+def combine_feature_panel(price_panel: pd.DataFrame, financials: pd.DataFrame, sentiment_panel: pd.DataFrame) -> pd.DataFrame:
+    if price_panel.empty:
+        return pd.DataFrame()
+    combined = price_panel
+    if not financials.empty:
+        combined = as_of_join(combined, financials, "snapshot_date", ["period_end", *FINANCIAL_COLUMNS])
+    if not sentiment_panel.empty:
+        combined = combined.merge(sentiment_panel, on=["snapshot_date", "security_id"], how="left")
+    return combined.reset_index(drop=True)
+
+
+def load_snapshot(df: pd.DataFrame, trade_date: str, replace: bool, end_date: Optional[str] = None) -> None:
     if df.empty:
         logger.warning("No features computed for %s.", trade_date)
         return
-    engine = get_engine()
-    with engine.begin() as conn:
-        if replace:
-            conn.execute(
-                text("DELETE FROM feature_snapshots WHERE snapshot_date = :snapshot_date"),
-                {"snapshot_date": df["snapshot_date"].iloc[0]},
+    if end_date:
+        scope = {"snapshot_date": (pd.to_datetime(trade_date), pd.to_datetime(end_date))} if replace else None
+    else:
+        scope = {"snapshot_date": df["snapshot_date"].iloc[0]} if replace else None
+    result = bulk_upsert(df, "feature_snapshots", KEY_COLUMNS, replace_scope=scope)
+    # Screeners cache whole snapshots; the new version tells them to reload.
+    bump_version()
+    logger.info(
+        "feature_snapshots for %s: %d inserted, %d updated, %d deleted.",
+        f"{trade_date}-{end_date}" if end_date else trade_date,
+        result.inserted,
+        result.updated,
+        result.deleted,
+    )
+
+
+def run_range(
+    start_date: str,
+    end_date: str,
+    window: int,
+    replace: bool,
+    source: str = "db",
+    factors: Optional[str] = None,
+    workers: int = 1,
+) -> int:
+    logger.info("Calculating features for %s to %s from %s.", start_date, end_date, source)
+    window = history_window(window, factors)
+    if source == "matrix":
+        with metrics.stage("calc_features.price_history") as stage:
+            close, volume, amount = load_price_pivots_from_matrix(end_date, window, start_date)
+            stage.rows = close.size
+        with metrics.stage("calc_features.price_features") as stage:
+            price_panel = compute_price_feature_panel_from_pivots(
+                close, volume, start_date, end_date, amount, factors, workers
             )
-        df.to_sql("feature_snapshots", conn, if_exists="append", index=False, method="multi", chunksize=1000)
-    logger.info("Inserted %d feature rows for %s.", len(df), trade_date)
+            stage.rows = len(price_panel)
+        if "close" in price_panel.columns:
+            with metrics.stage("calc_features.close") as stage:
+                closes = fetch_snapshot_closes(start_date, end_date)
+                stage.rows = len(closes)
+            price_panel = with_exact_close(price_panel, closes)
+    else:
+        with metrics.stage("calc_features.price_history") as stage:
+            price_history = fetch_price_history(end_date, window, start_date=start_date, source=source)
+            stage.rows = len(price_history)
+        with metrics.stage("calc_features.price_features", rows=len(price_history)):
+            price_panel = compute_price_feature_panel(price_history, start_date, end_date, factors, workers)
+    # The price matrix only holds bars; fundamentals and sentiment still come from the database.
+    other_source = "db" if source == "matrix" else source
+    with metrics.stage("calc_features.financials") as stage:
+        financials = fetch_financial_history(end_date, source=other_source)
+        stage.rows = len(financials)
+    with metrics.stage("calc_features.sentiment") as stage:
+        sentiment_panel = fetch_sentiment_panel(start_date, end_date, source=other_source)
+        stage.rows = len(sentiment_panel)
+    with metrics.stage("calc_features.combine") as stage:
+        snapshots = combine_feature_panel(price_panel, financials, sentiment_panel)
+        stage.rows = len(snapshots)
+    logger.info(
+        "Computed %d feature rows across %d dates.",
+        len(snapshots),
+        snapshots["snapshot_date"].nunique() if not snapshots.empty else 0,
+    )
+    with metrics.stage("calc_features.save_raw", rows=len(snapshots)):
+        save_partitioned(snapshots, "features", "snapshot_date")
+    with metrics.stage("calc_features.load", rows=len(snapshots)):
+        load_snapshot(snapshots, start_date, replace, end_date=end_date)
+    return len(snapshots)
+
+
+def run(
+    trade_date: str,
+    window: int = 60,
+    replace: bool = False,
+    incremental: bool = False,
+    verify: bool = False,
+    factors: Optional[str] = None,
+    workers: int = 1,
+) -> int:
+    logger.info("Calculating features for %s.", trade_date)
+    if incremental:
+        with metrics.stage("calc_features.price_features") as stage:
+            price_features = compute_price_features_incremental(trade_date, window, replace, verify)
+            stage.rows = len(price_features)
+    else:
+        with metrics.stage("calc_features.price_history") as stage:
+            price_history = fetch_price_history(trade_date, history_window(window, factors))
+            stage.rows = len(price_history)
+        with metrics.stage("calc_features.price_features", rows=len(price_history)):
+            price_features = compute_price_features(price_history, trade_date, factors, workers)
+    with metrics.stage("calc_features.financials") as stage:
+        financials = fetch_financial_metrics(trade_date)
+        stage.rows = len(financials)
+    with metrics.stage("calc_features.sentiment") as stage:
+        sentiment = fetch_sentiment(trade_date)
+        stage.rows = len(sentiment)
+    with metrics.stage("calc_features.combine") as stage:
+        snapshot = combine_features(price_features, financials, sentiment, trade_date)
+        stage.rows = len(snapshot)
+    with metrics.stage("calc_features.save_raw", rows=len(snapshot)):
+        save_dataframe(snapshot, "features", trade_date)
+    with metrics.stage("calc_features.load", rows=len(snapshot)):
+        load_snapshot(snapshot, trade_date, replace)
+    logger.info("Feature calculation completed for %s.", trade_date)
+    return len(snapshot)
 
 
 def main() -> None:
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
     args = parse_args()
-    logger.info("Calculating features for %s.", args.date)
-    price_history = fetch_price_history(args.date, args.window)
-    price_features = compute_price_features(price_history, args.date)
-    financials = fetch_financial_metrics(args.date)
-    sentiment = fetch_sentiment(args.date)
-    snapshot = combine_features(price_features, financials, sentiment, args.date)
-    save_dataframe(snapshot, "features", args.date, f"features_{args.date}.csv")
-    load_snapshot(snapshot, args.date, args.replace)
-    logger.info("Feature calculation completed for %s.", args.date)
+    with metrics.track_run("calc_features", args.profile, args.profile_mode):
+        if args.start or args.source != "db":
+            start_date = args.start or args.date
+            end_date = args.end or args.date
+            run_range(start_date, end_date, args.window, args.replace, args.source, args.factors, args.workers)
+            logger.info("Feature calculation completed for %s to %s.", start_date, args.end or args.date)
+            return
+        run(args.date, args.window, args.replace, args.incremental, args.verify, args.factors, args.workers)
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import time
+from datetime import date
+from pathlib import Path
+from typing import List, Tuple
+
+import pandas as pd
+
+from market.services import metrics
+from market.services.evaluation import DEFAULT_HORIZONS, evaluate, load_close_panel, load_feature_panel
+
+logger = logging.getLogger("jobs.evaluate_factors")
+
+
+def _validate_date(value: str) -> str:
+    if len(value) != 8 or not value.isdigit():
+        raise argparse.ArgumentTypeError("Date must be YYYYMMDD.")
+    return value
+
+
+def _horizons(value: str) -> List[int]:
+    try:
+        horizons = sorted({int(item) for item in value.split(",") if item.strip()})
+    except ValueError:
+        raise argparse.ArgumentTypeError("Horizons must look like '1,5,20'.") from None
+    if not horizons or horizons[0] < 1:
+        raise argparse.ArgumentTypeError("Horizons must be positive trading-day counts.")
+    return horizons
+
+
+def _weight(value: str) -> Tuple[str, float]:
+    column, _, weight = value.partition("=")
+    try:
+        return column.strip(), float(weight) if weight else 1.0
+    except ValueError:
+        raise argparse.ArgumentTypeError("Weight must look like 'ret_20d=1' or 'vol_ratio_5_20=-0.5'.") from None
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Evaluate feature_snapshots factors against forward returns.")
+    parser.add_argument("--start", type=_validate_date, required=True, help="First snapshot date in YYYYMMDD.")
+    parser.add_argument(
+        "--end", type=_validate_date, default=date.today().strftime("%Y%m%d"), help="Last snapshot date in YYYYMMDD."
+    )
+    parser.add_argument("--factors", help="Comma-separated snapshot columns (defaults to every numeric column).")
+    parser.add_argument(
+        "--weight",
+        type=_weight,
+        action="append",
+        default=[],
+        help="Also evaluate a screener-style composite score, e.g. 'ret_20d=1' (repeatable).",
+    )
+    parser.add_argument(
+        "--horizons",
+        type=_horizons,
+        default=list(DEFAULT_HORIZONS),
+        help="Forward-return horizons in trading days for rank IC.",
+    )
+    parser.add_argument("--quantiles", type=int, default=5, help="Number of quantile portfolios.")
+    parser.add_argument("--rebalance", type=int, default=5, help="Trading days between portfolio rebalances.")
+    parser.add_argument("--cost-bps", type=float, default=0.0, help="One-way trading cost charged on turnover.")
+    parser.add_argument("--delay", type=int, default=0, help="Trading days between a snapshot and acting on it.")
+    parser.add_argument(
+        "--source",
+        choices=["db", "raw", "matrix"],
+        default="db",
+        help="Read prices from PostgreSQL, the local raw store or the memory-mapped price matrix.",
+    )
+    parser.add_argument("--output", type=Path, help="Directory to write summary, IC, quantile and equity CSVs to.")
+    metrics.add_profile_arguments(parser)
+    args = parser.parse_args()
+    if args.quantiles < 2:
+        parser.error("--quantiles must be at least 2")
+    if args.rebalance < 1 or args.delay < 0:
+        parser.error("--rebalance must be positive and --delay non-negative")
+    return args
+
+
+def write_outputs(result, directory: Path) -> None:
+    directory.mkdir(parents=True, exist_ok=True)
+    result.summary.to_csv(directory / "summary.csv", index_label="factor")
+    ic = result.ic.copy()
+    ic.columns = [f"{factor}_{horizon}d" for factor, horizon in ic.columns]
+    ic.to_csv(directory / "ic.csv", index_label="trade_date")
+    result.equity.to_csv(directory / "long_short_equity.csv", index_label="trade_date")
+    quantiles = pd.concat(
+        {factor: frame.stack().rename("return") for factor, frame in result.quantile_returns.items()},
+        names=["factor", "trade_date", "quantile"],
+    )
+    quantiles.reset_index().to_csv(directory / "quantile_returns.csv", index=False)
+    turnover = pd.concat(
+        {factor: frame.stack().rename("turnover") for factor, frame in result.turnover.items()},
+        names=["factor", "trade_date", "quantile"],
+    )
+    turnover.reset_index().to_csv(directory / "turnover.csv", index=False)
+    logger.info("Evaluation written to %s.", directory)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args = parse_args()
+    factors = [name.strip() for name in args.factors.split(",") if name.strip()] if args.factors else None
+    if factors and args.weight:
+        factors += [name for name, _ in args.weight if name not in factors]
+    with metrics.track_run("evaluate_factors", args.profile, args.profile_mode):
+        with metrics.stage("evaluate_factors.features") as stage:
+            panel = load_feature_panel(args.start, args.end, factors)
+            stage.rows = len(panel.dates) * len(panel.securities)
+        with metrics.stage("evaluate_factors.prices") as stage:
+            horizon = max(args.horizons) + args.delay + 1
+            close = load_close_panel(args.start, args.end, horizon, args.source)
+            stage.rows = close.size
+        started = time.perf_counter()
+        with metrics.stage("evaluate_factors.evaluate", rows=len(panel.dates) * len(panel.securities)):
+            result = evaluate(
+                panel,
+                close,
+                horizons=args.horizons,
+                quantiles=args.quantiles,
+                rebalance=args.rebalance,
+                cost_bps=args.cost_bps,
+                delay=args.delay,
+                weights=args.weight,
+            )
+        logger.info(
+            "Evaluated %d factors over %d dates x %d securities in %.2fs.",
+            len(result.summary),
+            len(panel.dates),
+            len(panel.securities),
+            time.perf_counter() - started,
+        )
+        if args.output:
+            write_outputs(result, args.output)
+    with pd.option_context("display.width", 200, "display.max_columns", None, "display.float_format", "{:.4f}".format):
+        print(result.summary.to_string())
+
+
+if __name__ == "__main__":
+    main()
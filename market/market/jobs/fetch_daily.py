@@ -2,18 +2,27 @@ from __future__ import annotations
 
 import argparse
 import logging
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date
+from typing import Optional
 
 import pandas as pd
+from sqlalchemy.engine import Connection
 
-from sqlalchemy import text
-
-from market.services.db import get_engine
+from market.services import metrics
+from market.services.checkpoints import completed_keys, mark_done
+from market.services.db import UpsertResult, bulk_upsert, get_engine
+from market.services.price_matrix import PriceMatrix
 from market.services.storage import save_dataframe
 from market.services.tushare_client import TushareClient
 
 logger = logging.getLogger("jobs.fetch_daily")
 
+JOB_NAME = "fetch_daily"
+KEY_COLUMNS = ("security_id", "trade_date")
+
 
 def _validate_date(value: str) -> str:
     if len(value) != 8 or not value.isdigit():
@@ -29,38 +38,114 @@ def _default_trade_date() -> str:
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Fetch daily A-share market data.")
     parser.add_argument("--date", type=_validate_date, default=_default_trade_date(), help="Trade date in YYYYMMDD.")
+    parser.add_argument("--start", type=_validate_date, help="Backfill start date in YYYYMMDD (enables backfill mode).")
+    parser.add_argument("--end", type=_validate_date, default=_default_trade_date(), help="Backfill end date in YYYYMMDD.")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent Tushare fetches in backfill mode.")
     parser.add_argument("--replace", action="store_true", help="Replace records for the same date before insert.")
+    metrics.add_profile_arguments(parser)
     return parser.parse_args()
 
 
-def load_dataframe(df: pd.DataFrame, trade_date: str, replace: bool) -> None:
+def load_dataframe(
+    df: pd.DataFrame, trade_date: str, replace: bool, connection: Optional[Connection] = None
+) -> UpsertResult:
     if df.empty:
         logger.warning("No data returned for %s.", trade_date)
-        return
+        return UpsertResult()
     df = df.rename(columns={"ts_code": "security_id", "vol": "volume"})
     df["trade_date"] = pd.to_datetime(df["trade_date"])
-    engine = get_engine()
-    with engine.begin() as connection:
-        if replace:
-            connection.execute(
-                text("DELETE FROM daily_prices WHERE trade_date = :trade_date"),
-                {"trade_date": df["trade_date"].iloc[0]},
-            )
-        df.to_sql("daily_prices", connection, if_exists="append", index=False, method="multi", chunksize=1000)
-    logger.info("Inserted %d rows into daily_prices.", len(df))
+    scope = {"trade_date": df["trade_date"].iloc[0]} if replace else None
+    result = bulk_upsert(df, "daily_prices", KEY_COLUMNS, connection=connection, replace_scope=scope)
+    logger.info(
+        "daily_prices for %s: %d inserted, %d updated, %d deleted.",
+        trade_date,
+        result.inserted,
+        result.updated,
+        result.deleted,
+    )
+    return result
+
+
+def store_trade_date(df: pd.DataFrame, trade_date: str, replace: bool, matrix: Optional[PriceMatrix] = None) -> bool:
+    save_dataframe(df, "daily", trade_date)
+    if df.empty:
+        logger.warning("No data returned for %s; leaving it unchecked for a later run.", trade_date)
+        return False
+    matrix = matrix or PriceMatrix(writable=True)
+    with get_engine().begin() as connection:
+        load_dataframe(df, trade_date, replace, connection)
+        # Appending rewrites the date's row, so it goes before the checkpoint: a crash in between
+        # leaves the date unchecked and the next run redoes both stores.
+        matrix.append(trade_date, df.rename(columns={"ts_code": "security_id", "vol": "volume"}))
+        mark_done(connection, JOB_NAME, trade_date, len(df))
+    return True
+
+
+def backfill(client: TushareClient, start: str, end: str, replace: bool, workers: int) -> int:
+    trade_dates = client.trade_dates(start, end)
+    done = set() if replace else completed_keys(JOB_NAME, trade_dates)
+    pending = [trade_date for trade_date in trade_dates if trade_date not in done]
+    logger.info(
+        "Backfilling %d of %d trade dates between %s and %s (%d already loaded).",
+        len(pending),
+        len(trade_dates),
+        start,
+        end,
+        len(done),
+    )
+    failures = 0
+    matrix = PriceMatrix(writable=True)
+    remaining = iter(pending)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        # Keep a bounded window of fetches in flight and consume them in date order, so
+        # Tushare I/O for later dates overlaps the COPY of the current one.
+        in_flight = deque()
+        for trade_date in remaining:
+            in_flight.append((trade_date, executor.submit(client.daily, trade_date)))
+            if len(in_flight) >= workers * 2:
+                break
+        while in_flight:
+            trade_date, future = in_flight.popleft()
+            next_date = next(remaining, None)
+            if next_date is not None:
+                in_flight.append((next_date, executor.submit(client.daily, next_date)))
+            try:
+                with metrics.stage("fetch_daily.wait_fetch"):
+                    df = future.result()
+                with metrics.stage("fetch_daily.store", rows=len(df)):
+                    stored = store_trade_date(df, trade_date, replace, matrix)
+                if not stored:
+                    failures += 1
+            except Exception as exc:  # noqa: BLE001
+                failures += 1
+                logger.error("Backfill failed for %s: %s", trade_date, exc)
+    logger.info("Backfill finished: %d loaded, %d failed.", len(pending) - failures, failures)
+    return failures
+
+
+def run(client: TushareClient, trade_date: str, replace: bool = False) -> int:
+    logger.info("Fetching daily data for %s.", trade_date)
+    with metrics.stage("fetch_daily.fetch") as stage:
+        df = client.daily(trade_date)
+        stage.rows = len(df)
+    with metrics.stage("fetch_daily.store", rows=len(df)):
+        store_trade_date(df, trade_date, replace)
+    logger.info("Daily data pipeline completed for %s.", trade_date)
+    return len(df)
 
 
 def main() -> None:
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
     args = parse_args()
-    client = TushareClient()
-    logger.info("Fetching daily data for %s.", args.date)
-    df = client.daily(args.date)
-    save_dataframe(df, "daily", args.date, f"daily_{args.date}.csv")
-    load_dataframe(df, args.date, args.replace)
-    logger.info("Daily data pipeline completed for %s.", args.date)
+    with metrics.track_run(JOB_NAME, args.profile, args.profile_mode):
+        client = TushareClient()
+        if args.start:
+            failures = backfill(client, args.start, args.end, args.replace, args.workers)
+            if failures:
+                sys.exit(1)
+            return
+        run(client, args.date, args.replace)
 
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+import argparse
+import logging
+
+from market.services import metrics
+from market.services.schema import migrate, pending_migrations
+
+logger = logging.getLogger("jobs.migrate")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Create or upgrade the market database schema.")
+    parser.add_argument("--dry-run", action="store_true", help="List pending migrations without applying them.")
+    metrics.add_profile_arguments(parser)
+    return parser.parse_args()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args = parse_args()
+    with metrics.track_run("migrate", args.profile, args.profile_mode):
+        pending = pending_migrations()
+        if not pending:
+            logger.info("Schema is up to date.")
+            return
+        for migration in pending:
+            logger.info("Pending migration %d: %s.", migration.version, migration.name)
+        if args.dry_run:
+            return
+        applied = migrate()
+        logger.info("Applied %d of %d pending migrations.", len(applied), len(pending))
+
+
+if __name__ == "__main__":
+    main()
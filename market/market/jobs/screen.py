@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import re
+import time
+from typing import Tuple
+
+import pandas as pd
+
+from market.services.screening import RANK_METHODS, Screen, get_screener
+
+logger = logging.getLogger("jobs.screen")
+
+_FILTER = re.compile(r"^\s*(\w+)\s*(>=|<=|==|!=|>|<)\s*(.+?)\s*$")
+_NULL_FILTER = re.compile(r"^\s*(\w+)\s+(notnull|isnull)\s*$")
+
+
+def _filter(value: str) -> Tuple[str, str, object]:
+    match = _NULL_FILTER.match(value)
+    if match:
+        return match.group(1), match.group(2), None
+    match = _FILTER.match(value)
+    if not match:
+        raise argparse.ArgumentTypeError("Filter must look like 'roe>=0.1' or 'sentiment_30d notnull'.")
+    column, operator, operand = match.groups()
+    if column == "security_id":
+        return column, operator, operand
+    try:
+        return column, operator, float(operand)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Filter value {operand!r} is not a number.") from None
+
+
+def _weight(value: str) -> Tuple[str, float]:
+    column, _, weight = value.partition("=")
+    try:
+        return column.strip(), float(weight) if weight else 1.0
+    except ValueError:
+        raise argparse.ArgumentTypeError("Weight must look like 'ret_20d=1' or 'vol_ratio_5_20=-0.5'.") from None
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Screen and rank the universe on one feature snapshot.")
+    parser.add_argument("--date", help="Snapshot date in YYYYMMDD (defaults to the latest snapshot).")
+    parser.add_argument("--filter", type=_filter, action="append", default=[], help="e.g. 'roe>=0.1' (repeatable).")
+    parser.add_argument("--weight", type=_weight, action="append", default=[], help="e.g. 'ret_20d=1' (repeatable).")
+    parser.add_argument("--method", choices=RANK_METHODS, default="zscore", help="Cross-sectional rank to combine.")
+    parser.add_argument("--sort", help="Column to sort by (defaults to the score when weights are given).")
+    parser.add_argument("--ascending", action="store_true", help="Sort ascending instead of descending.")
+    parser.add_argument("--top", type=int, default=50, help="Number of securities to return.")
+    parser.add_argument("--columns", help="Comma-separated output columns (defaults to every factor).")
+    return parser.parse_args()
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args = parse_args()
+    screen = Screen(
+        filters=tuple(args.filter),
+        weights=tuple(args.weight),
+        method=args.method,
+        sort_by=args.sort,
+        ascending=args.ascending,
+        limit=args.top,
+        columns=tuple(column.strip() for column in args.columns.split(",")) if args.columns else None,
+    )
+    screener = get_screener()
+    snapshot = screener.snapshot(args.date)
+    started = time.perf_counter()
+    results = screener.screen(screen, snapshot.snapshot_date)
+    logger.info(
+        "%s: %d of %d securities matched; screened in %.2f ms.",
+        f"{snapshot.snapshot_date:%Y-%m-%d}",
+        results.attrs["matched"],
+        len(snapshot),
+        (time.perf_counter() - started) * 1000,
+    )
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(results.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
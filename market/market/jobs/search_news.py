@@ -0,0 +1,44 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import time
+
+import pandas as pd
+
+from market.services.embeddings import search, similar_to
+
+logger = logging.getLogger("jobs.search_news")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Find news articles semantically similar to a query or an article.")
+    parser.add_argument("query", nargs="?", help="Free-text query, e.g. a risk event description.")
+    parser.add_argument("--like", metavar="NEWS_ID", help="Find articles similar to this stored article instead.")
+    parser.add_argument("--security", action="append", help="Only articles linked to this security (repeatable).")
+    parser.add_argument("--start-date", help="Earliest publish date in YYYYMMDD format.")
+    parser.add_argument("--end-date", help="Latest publish date in YYYYMMDD format (inclusive).")
+    parser.add_argument("-k", "--top", type=int, default=10, help="Number of articles to return.")
+    args = parser.parse_args()
+    if bool(args.query) == bool(args.like):
+        parser.error("give either a query or --like NEWS_ID")
+    return args
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    args = parse_args()
+    start = pd.to_datetime(args.start_date) if args.start_date else None
+    end = pd.to_datetime(args.end_date) + pd.Timedelta(days=1) if args.end_date else None
+    started = time.perf_counter()
+    if args.like:
+        results = similar_to(args.like, args.top, args.security, start, end)
+    else:
+        results = search(args.query, args.top, args.security, start, end)
+    logger.info("%d results in %.1f ms.", len(results), (time.perf_counter() - started) * 1000)
+    with pd.option_context("display.max_colwidth", 60, "display.width", 200):
+        print(results.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
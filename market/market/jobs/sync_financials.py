@@ -2,23 +2,44 @@ from __future__ import annotations
 
 import argparse
 import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, timedelta
+from typing import List, Optional
 
 import pandas as pd
+from sqlalchemy.engine import Connection
 
-from sqlalchemy import text
-
-from market.services.db import get_engine
-from market.services.storage import save_dataframe
+from market.services import metrics
+from market.services.checkpoints import get_value, mark_done
+from market.services.db import UpsertResult, bulk_upsert, get_engine
+from market.services.fundamentals import record_filings, refresh_intervals
+from market.services.storage import save_dataframe, save_partitioned
 from market.services.tushare_client import TushareClient
 
 logger = logging.getLogger("jobs.sync_financials")
 
+JOB_NAME = "sync_financials"
+HIGH_WATER_MARK = "ann_date"
+KEY_COLUMNS = ("security_id", "period_end")
+DEFAULT_LOOKBACK_DAYS = 7
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Sync quarterly financial indicators.")
-    parser.add_argument("--period", required=True, help="Reporting period in YYYYMMDD (e.g. 20231231).")
+    parser.add_argument("--period", nargs="+", help="Reporting period(s) in YYYYMMDD (e.g. 20231231).")
+    parser.add_argument("--incremental", action="store_true", help="Sync filings announced since the last incremental run.")
+    parser.add_argument("--since", help="Override the incremental start announcement date (YYYYMMDD).")
+    parser.add_argument("--workers", type=int, default=4, help="Periods fetched concurrently.")
     parser.add_argument("--replace", action="store_true", help="Replace existing period data before insert.")
-    return parser.parse_args()
+    parser.add_argument(
+        "--rebuild-intervals", action="store_true", help="Recompute all point-in-time validity intervals from history."
+    )
+    metrics.add_profile_arguments(parser)
+    args = parser.parse_args()
+    if not args.period and not args.incremental and not args.rebuild_intervals:
+        parser.error("one of --period, --incremental or --rebuild-intervals is required")
+    return args
 
 
 def transform(df: pd.DataFrame) -> pd.DataFrame:
@@ -26,6 +47,10 @@ def transform(df: pd.DataFrame) -> pd.DataFrame:
         return df
     df = df.rename(columns={"ts_code": "security_id", "end_date": "period_end"})
     df["period_end"] = pd.to_datetime(df["period_end"])
+    if "ann_date" in df.columns:
+        df["ann_date"] = pd.to_datetime(df["ann_date"], errors="coerce")
+        # Restated filings repeat a period; keep the latest announcement per key.
+        df = df.sort_values("ann_date", na_position="first")
     numeric_cols = [
         "roe",
         "roa",
@@ -38,33 +63,119 @@ def transform(df: pd.DataFrame) -> pd.DataFrame:
     for column in numeric_cols:
         if column in df.columns:
             df[column] = pd.to_numeric(df[column], errors="coerce")
-    return df
+    return df.drop_duplicates(subset=list(KEY_COLUMNS), keep="last").reset_index(drop=True)
 
 
-def load_dataframe(df: pd.DataFrame, period: str, replace: bool) -> None:
+def load_dataframe(
+    df: pd.DataFrame, period: str, replace: bool, connection: Optional[Connection] = None
+) -> UpsertResult:
     if df.empty:
         logger.warning("No financial indicator data for %s.", period)
-        return
-    engine = get_engine()
-    with engine.begin() as connection:
-        if replace:
-            connection.execute(text("DELETE FROM financial_metrics WHERE period_end = :period"), {"period": df["period_end"].iloc[0]})
-        df.to_sql("financial_metrics", connection, if_exists="append", index=False, method="multi", chunksize=1000)
-    logger.info("Inserted %d rows into financial_metrics.", len(df))
+        return UpsertResult()
+    scope = {"period_end": df["period_end"].iloc[0]} if replace else None
+    if connection is None:
+        with get_engine().begin() as conn:
+            return load_dataframe(df, period, replace, conn)
+    result = bulk_upsert(df, "financial_metrics", KEY_COLUMNS, connection=connection, replace_scope=scope)
+    # Every announced version is kept so features can be built as of any past date.
+    record_filings(df, connection)
+    logger.info(
+        "financial_metrics for %s: %d inserted, %d updated, %d deleted.",
+        period,
+        result.inserted,
+        result.updated,
+        result.deleted,
+    )
+    return result
+
+
+def sync_periods(client: TushareClient, periods: List[str], replace: bool, workers: int) -> int:
+    failures = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = {executor.submit(client.fina_indicator, period): period for period in periods}
+        for future in as_completed(futures):
+            period = futures[future]
+            try:
+                with metrics.stage("sync_financials.transform") as stage:
+                    df = transform(future.result())
+                    stage.rows = len(df)
+            except Exception as exc:  # noqa: BLE001
+                failures += 1
+                logger.error("Fetching financial indicators for %s failed: %s", period, exc)
+                continue
+            with metrics.stage("sync_financials.save_raw", rows=len(df)):
+                save_dataframe(df, "financials", period)
+            with metrics.stage("sync_financials.load", rows=len(df)):
+                load_dataframe(df, period, replace)
+    return failures
+
+
+def sync_incremental(client: TushareClient, since: Optional[str]) -> int:
+    end_date = date.today().strftime("%Y%m%d")
+    start_date = since or get_value(JOB_NAME, HIGH_WATER_MARK)
+    if not start_date:
+        start_date = (date.today() - timedelta(days=DEFAULT_LOOKBACK_DAYS)).strftime("%Y%m%d")
+    # The high-water mark day is fetched again so filings published late that day are not missed.
+    logger.info("Fetching financial indicators announced between %s and %s.", start_date, end_date)
+    with metrics.stage("sync_financials.fetch") as stage:
+        raw = client.fina_indicator_announced(start_date, end_date)
+        stage.rows = len(raw)
+    with metrics.stage("sync_financials.transform", rows=len(raw)):
+        df = transform(raw)
+    if df.empty:
+        logger.info("No new filings announced since %s.", start_date)
+        return 0
+    with metrics.stage("sync_financials.save_raw", rows=len(df)):
+        save_partitioned(df, "financials", "period_end", name=f"ann_{start_date}_{end_date}")
+    latest = df["ann_date"].max()
+    high_water_mark = latest.strftime("%Y%m%d") if pd.notna(latest) else start_date
+    with metrics.stage("sync_financials.load", rows=len(df)), get_engine().begin() as connection:
+        load_dataframe(df, f"announcements {start_date}-{end_date}", False, connection)
+        mark_done(connection, JOB_NAME, HIGH_WATER_MARK, len(df), value=high_water_mark)
+    logger.info(
+        "Merged %d filings from %d companies; high-water mark now %s.",
+        len(df),
+        df["security_id"].nunique(),
+        high_water_mark,
+    )
+    return len(df)
+
+
+def run(
+    client: TushareClient,
+    periods: Optional[List[str]] = None,
+    incremental: bool = False,
+    since: Optional[str] = None,
+    workers: int = 4,
+    replace: bool = False,
+) -> int:
+    if incremental:
+        rows = sync_incremental(client, since)
+        logger.info("Incremental financial sync completed.")
+        return rows
+    logger.info("Fetching financial indicators for periods %s.", ", ".join(periods))
+    failures = sync_periods(client, periods, replace, workers)
+    if failures:
+        raise RuntimeError(f"{failures} of {len(periods)} periods failed.")
+    logger.info("Financial indicators pipeline completed for %s.", ", ".join(periods))
+    return len(periods)
 
 
 def main() -> None:
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
     args = parse_args()
-    logger.info("Fetching financial indicators for period %s.", args.period)
-    client = TushareClient()
-    df = client.fina_indicator(args.period)
-    df = transform(df)
-    save_dataframe(df, "financials", args.period, f"financials_{args.period}.csv")
-    load_dataframe(df, args.period, args.replace)
-    logger.info("Financial indicators pipeline completed for %s.", args.period)
+    with metrics.track_run(JOB_NAME, args.profile, args.profile_mode):
+        if args.rebuild_intervals:
+            with metrics.stage("sync_financials.rebuild_intervals"), get_engine().begin() as connection:
+                refresh_intervals(connection)
+            if not args.period and not args.incremental:
+                return
+        try:
+            run(TushareClient(), args.period, args.incremental, args.since, args.workers, args.replace)
+        except RuntimeError as exc:
+            logger.error("%s", exc)
+            sys.exit(1)
 
 
 if __name__ == "__main__":
     main()
-
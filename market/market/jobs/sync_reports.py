@@ -1,34 +1,86 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import hashlib
 import json
 import logging
-from typing import List
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 
+import httpx
 import pandas as pd
 from sqlalchemy import text
+from sqlalchemy.engine import Connection
 
-from market.services.db import get_engine
-from market.services.llm import LLMUnavailable, summarize_report
-from market.services.storage import save_dataframe
+from market.services import metrics
+from market.services.checkpoints import get_value, mark_done
+from market.services.db import UpsertResult, bulk_upsert, get_engine
+from market.services.dedup import LLM_COLUMNS, LOOKBACK_DAYS, encode, fetch_recent_canonicals, find_duplicates, signature
+from market.services.embeddings import (
+    EMBEDDING_COLUMNS,
+    EmbeddingUnavailable,
+    clear_search_cache,
+    embed_articles,
+    get_embedder,
+)
+from market.services.entity_linking import get_linker, link_frame, primary_securities
+from market.services.llm import LLMUnavailable, summarize_reports
+from market.services.schema import relation_exists
+from market.services.sentiment import refresh_rollup
+from market.services.storage import save_partitioned
+from market.services.streaming import prefetch
 from market.services.tushare_client import TushareClient
 
 logger = logging.getLogger("jobs.sync_reports")
 
+KEY_COLUMNS = ("news_id", "publish_time")
+LINK_KEY_COLUMNS = ("news_id", "security_id")
+JOB_NAME = "sync_reports"
+# Tushare caps one news call at 1500 rows; a slice that hits the cap was truncated.
+NEWS_ROW_CAP = 1500
+TUSHARE_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+EMBED_BACKFILL_BATCH = 1_000
+
+
+@dataclass(frozen=True)
+class NewsChunk:
+    start: pd.Timestamp
+    end: pd.Timestamp
+    news: pd.DataFrame
+    links: pd.DataFrame
+    embeddings: pd.DataFrame
+    high_water_mark: pd.Timestamp
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Sync research reports and news summaries.")
     parser.add_argument("--start-date", required=True, help="Start date in YYYYMMDD format.")
     parser.add_argument("--end-date", required=True, help="End date in YYYYMMDD format.")
-    parser.add_argument("--limit", type=int, default=50, help="Maximum number of items to process.")
-    parser.add_argument("--replace", action="store_true", help="Delete existing entries in the date window before insert.")
+    parser.add_argument("--limit", type=int, default=50, help="Maximum number of items to process in this run.")
+    parser.add_argument("--slice-hours", type=int, default=6, help="Hours of news fetched per Tushare call.")
+    parser.add_argument("--queue-depth", type=int, default=2, help="Slices buffered between pipeline stages.")
+    parser.add_argument("--restart", action="store_true", help="Ignore the saved high-water mark for this window.")
+    parser.add_argument(
+        "--replace",
+        action="store_true",
+        help="Delete existing entries in the date window before insert (implies --restart).",
+    )
+    parser.add_argument("--concurrency", type=int, default=None, help="Concurrent LLM requests (defaults to LLM_CONCURRENCY).")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the local LLM result cache.")
+    parser.add_argument(
+        "--rebuild-rollup", action="store_true", help="Recompute the sentiment rollup for the window without fetching."
+    )
+    parser.add_argument(
+        "--embed-missing", action="store_true", help="Embed stored articles in the window that have no vector yet."
+    )
+    metrics.add_profile_arguments(parser)
     return parser.parse_args()
 
 
-def transform(df: pd.DataFrame, limit: int) -> pd.DataFrame:
+def transform(df: pd.DataFrame) -> pd.DataFrame:
     if df.empty:
         return df
-    df = df.head(limit)
     df = df.rename(
         columns={
             "datetime": "publish_time",
@@ -38,73 +90,340 @@ def transform(df: pd.DataFrame, limit: int) -> pd.DataFrame:
         }
     )
     df["publish_time"] = pd.to_datetime(df["publish_time"])
-    return df
+    blank = pd.Series("", index=df.index)
+    titles = df["title"] if "title" in df.columns else blank
+    bodies = df["body"] if "body" in df.columns else blank
+    df["news_id"] = [_news_id(ts, title, body) for ts, title, body in zip(df["publish_time"], titles, bodies)]
+    return df.sort_values("publish_time", kind="mergesort").reset_index(drop=True)
+
+
+def _news_id(publish_time: pd.Timestamp, title, body) -> str:
+    raw = f"{publish_time.isoformat()}|{title or ''}|{body or ''}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
 
+def link(df: pd.DataFrame) -> pd.DataFrame:
+    # Sina news carries no ts_code; attach every mentioned security and keep the most
+    # relevant one on the article itself for per-security rollups.
+    links = link_frame(get_linker(), df)
+    if not df.empty:
+        df["security_id"] = primary_securities(links, df["news_id"])
+        logger.info("%d of %d articles linked to a security.", df["security_id"].notna().sum(), len(df))
+    return links
 
-def enrich(df: pd.DataFrame) -> pd.DataFrame:
+
+def deduplicate(
+    df: pd.DataFrame,
+    recent: Optional[pd.DataFrame] = None,
+    fetch_canonicals: Callable[[pd.Timestamp, pd.Timestamp], pd.DataFrame] = fetch_recent_canonicals,
+) -> pd.DataFrame:
+    if df.empty:
+        return pd.DataFrame(columns=["news_id", *LLM_COLUMNS])
+    titles = df["title"] if "title" in df.columns else pd.Series(None, index=df.index)
+    bodies = df["body"] if "body" in df.columns else pd.Series(None, index=df.index)
+    df["minhash"] = [encode(signature(title, body)) for title, body in zip(titles, bodies)]
+    start = df["publish_time"].min() - pd.Timedelta(days=LOOKBACK_DAYS)
+    stored = fetch_canonicals(start, df["publish_time"].max())
+    if recent is not None and not recent.empty:
+        # Canonicals from slices still queued for loading are not in the database yet.
+        frames = [frame for frame in (stored, recent[recent["publish_time"] >= start]) if not frame.empty]
+        if frames:
+            stored = pd.concat(frames, ignore_index=True).drop_duplicates("news_id", keep="last")
+    df["duplicate_of"] = find_duplicates(df, stored)
+    logger.info(
+        "%d of %d articles are near-duplicates (%d stored canonicals checked).",
+        df["duplicate_of"].notna().sum(),
+        len(df),
+        len(stored),
+    )
+    return stored
+
+
+def enrich(
+    df: pd.DataFrame, concurrency: Optional[int] = None, use_cache: bool = True, stored: Optional[pd.DataFrame] = None
+) -> pd.DataFrame:
     if df.empty:
         return df
-    summaries: List[str] = []
-    sentiments: List[float] = []
-    risks: List[str] = []
-    highlights: List[str] = []
-    llm_available = True
-    for _, row in df.iterrows():
-        if not llm_available:
-            summaries.append(None)
-            sentiments.append(None)
-            risks.append(None)
-            highlights.append(None)
-            continue
-        try:
-            result = summarize_report(row.get("body", "") or "")
-            summaries.append(result.get("summary"))
-            sentiments.append(result.get("sentiment"))
-            risks.append(json.dumps(result.get("risks", []), ensure_ascii=False))
-            highlights.append(json.dumps(result.get("highlights", []), ensure_ascii=False))
-        except LLMUnavailable:
-            llm_available = False
-            logger.warning("LLM endpoint not configured; skipping enrichment.")
-            summaries.append(None)
-            sentiments.append(None)
-            risks.append(None)
-            highlights.append(None)
-        except Exception as exc:  # noqa: BLE001
-            logger.error("LLM enrichment failed: %s", exc)
-            summaries.append(None)
-            sentiments.append(None)
-            risks.append(None)
-            highlights.append(None)
-    df = df.assign(summary=summaries, sentiment=sentiments, risk_tags=risks, highlights=highlights)
+    duplicates = df["duplicate_of"].notna() if "duplicate_of" in df.columns else pd.Series(False, index=df.index)
+    canonical = df[~duplicates]
+    bodies = [body if isinstance(body, str) else "" for body in canonical.get("body", pd.Series("", index=canonical.index))]
+    try:
+        # Each slice runs its LLM calls on a fresh event loop in the enrich stage's thread.
+        results = asyncio.run(summarize_reports(bodies, concurrency=concurrency, use_cache=use_cache))
+    except LLMUnavailable:
+        logger.warning("LLM endpoint not configured; skipping enrichment.")
+        results = [None] * len(canonical)
+    summaries = [result.get("summary") if result else None for result in results]
+    sentiments = [result.get("sentiment") if result else None for result in results]
+    risks = [json.dumps(result.get("risks", []), ensure_ascii=False) if result else None for result in results]
+    highlights = [json.dumps(result.get("highlights", []), ensure_ascii=False) if result else None for result in results]
+    enriched = canonical.assign(summary=summaries, sentiment=sentiments, risk_tags=risks, highlights=highlights)
+    df = df.assign(**{column: enriched[column].reindex(df.index) for column in LLM_COLUMNS})
+    if duplicates.any():
+        # Near-duplicates reuse the canonical article's result instead of another LLM call.
+        sources = [enriched[["news_id", *LLM_COLUMNS]]]
+        if stored is not None and not stored.empty:
+            sources.append(stored[["news_id", *LLM_COLUMNS]])
+        source = pd.concat(sources, ignore_index=True).drop_duplicates("news_id").set_index("news_id")
+        copied = source.reindex(df.loc[duplicates, "duplicate_of"])
+        for column in LLM_COLUMNS:
+            df.loc[duplicates, column] = copied[column].to_numpy()
+        logger.info("Copied LLM results to %d near-duplicate articles.", duplicates.sum())
     return df
 
 
-def load_dataframe(df: pd.DataFrame, start_date: str, end_date: str, replace: bool) -> None:
+def embed(df: pd.DataFrame) -> pd.DataFrame:
+    # Articles still load when the embedding backend is down; --embed-missing fills them in later.
+    try:
+        return embed_articles(df)
+    except (EmbeddingUnavailable, httpx.HTTPError, ValueError) as exc:
+        logger.warning("Embedding failed for %d articles (%s); loading them without vectors.", len(df), exc)
+        return pd.DataFrame(columns=EMBEDDING_COLUMNS)
+
+
+def load_links(connection: Connection, df: pd.DataFrame, links: pd.DataFrame, replace: bool) -> None:
+    if replace:
+        connection.execute(
+            text("DELETE FROM news_securities WHERE publish_time BETWEEN :start AND :end"),
+            {"start": df["publish_time"].min(), "end": df["publish_time"].max()},
+        )
+    else:
+        connection.execute(text("DELETE FROM news_securities WHERE news_id = ANY(:ids)"), {"ids": list(df["news_id"])})
+    bulk_upsert(links, "news_securities", LINK_KEY_COLUMNS, connection=connection)
+
+
+def load_dataframe(
+    df: pd.DataFrame,
+    start_date: str,
+    end_date: str,
+    replace: bool,
+    links: Optional[pd.DataFrame] = None,
+    connection: Optional[Connection] = None,
+    embeddings: Optional[pd.DataFrame] = None,
+) -> UpsertResult:
     if df.empty:
         logger.warning("No reports/news between %s and %s.", start_date, end_date)
-        return
-    engine = get_engine()
-    with engine.begin() as connection:
-        if replace:
-            connection.execute(
-                text("DELETE FROM news WHERE publish_time BETWEEN :start AND :end"),
-                {"start": df["publish_time"].min(), "end": df["publish_time"].max()},
+        return UpsertResult()
+    if connection is None:
+        with get_engine().begin() as conn:
+            return load_dataframe(df, start_date, end_date, replace, links, conn, embeddings)
+    scope = {"publish_time": (df["publish_time"].min(), df["publish_time"].max())} if replace else None
+    result = bulk_upsert(df, "news", KEY_COLUMNS, connection=connection, replace_scope=scope)
+    if links is not None:
+        if relation_exists("news_securities"):
+            load_links(connection, df, links, replace)
+        else:
+            logger.warning("news_securities does not exist; run market-migrate to store entity links.")
+    if embeddings is not None and not embeddings.empty:
+        bulk_upsert(embeddings, "news_embeddings", ("news_id",), connection=connection, replace_scope=scope)
+    logger.info(
+        "news for %s-%s: %d inserted, %d updated, %d deleted.",
+        start_date,
+        end_date,
+        result.inserted,
+        result.updated,
+        result.deleted,
+    )
+    # Until migration 6 is applied fetch_rollup aggregates news directly, so there is nothing to refresh.
+    if not relation_exists("news_sentiment_rollup"):
+        logger.warning("news_sentiment_rollup does not exist; run market-migrate to enable the rollup.")
+        return result
+    # The rollup is refreshed in the same transaction so features never see half a sync.
+    days = refresh_rollup(connection, df["publish_time"].min(), df["publish_time"].max())
+    logger.info("news_sentiment_rollup refreshed: %d security-days.", days)
+    return result
+
+
+def time_slices(start_date: str, end_date: str, hours: int) -> List[Tuple[pd.Timestamp, pd.Timestamp]]:
+    edges = pd.date_range(
+        pd.to_datetime(start_date),
+        pd.to_datetime(end_date) + pd.Timedelta(days=1),
+        freq=pd.Timedelta(hours=max(1, hours)),
+    )
+    if edges[-1] < pd.to_datetime(end_date) + pd.Timedelta(days=1):
+        edges = edges.append(pd.DatetimeIndex([pd.to_datetime(end_date) + pd.Timedelta(days=1)]))
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def fetch_slices(
+    client: TushareClient, slices: Iterable[Tuple[pd.Timestamp, pd.Timestamp]], resume_from: Optional[pd.Timestamp]
+) -> Iterator[Tuple[pd.Timestamp, pd.Timestamp, pd.DataFrame]]:
+    for start, end in slices:
+        if resume_from is not None and end <= resume_from:
+            continue
+        with metrics.stage("sync_reports.fetch") as stage:
+            raw = client.news(start.strftime(TUSHARE_TIME_FORMAT), end.strftime(TUSHARE_TIME_FORMAT))
+            stage.rows = len(raw)
+        if len(raw) >= NEWS_ROW_CAP:
+            logger.warning("News slice %s-%s hit the %d row cap; use a smaller --slice-hours.", start, end, NEWS_ROW_CAP)
+        with metrics.stage("sync_reports.transform", rows=len(raw)):
+            df = transform(raw)
+        if not df.empty:
+            lower = max(start, resume_from) if resume_from is not None else start
+            df = df[(df["publish_time"] >= lower) & (df["publish_time"] < end)].reset_index(drop=True)
+        yield start, end, df
+
+
+def process_slices(
+    batches: Iterable[Tuple[pd.Timestamp, pd.Timestamp, pd.DataFrame]],
+    limit: Optional[int],
+    concurrency: Optional[int],
+    use_cache: bool,
+    embed_vectors: bool = False,
+    fetch_canonicals: Callable[[pd.Timestamp, pd.Timestamp], pd.DataFrame] = fetch_recent_canonicals,
+) -> Iterator[NewsChunk]:
+    recent = pd.DataFrame()
+    remaining = limit
+    for start, end, df in batches:
+        truncated = remaining is not None and len(df) > remaining
+        if truncated:
+            df = df.head(remaining)
+        with metrics.stage("sync_reports.link", rows=len(df)):
+            links = link(df)
+        with metrics.stage("sync_reports.dedup", rows=len(df)):
+            stored = deduplicate(df, recent, fetch_canonicals)
+        with metrics.stage("sync_reports.enrich", rows=len(df)):
+            df = enrich(df, concurrency, use_cache=use_cache, stored=stored)
+        embeddings = pd.DataFrame(columns=EMBEDDING_COLUMNS)
+        if embed_vectors:
+            with metrics.stage("sync_reports.embed", rows=len(df)):
+                embeddings = embed(df)
+        if not df.empty:
+            canonical = df[df["duplicate_of"].isna() & df["minhash"].notna()]
+            recent = pd.concat([recent, canonical[["news_id", "publish_time", "minhash", *LLM_COLUMNS]]], ignore_index=True)
+            recent = recent[recent["publish_time"] >= df["publish_time"].max() - pd.Timedelta(days=LOOKBACK_DAYS)]
+        # A slice cut short by --limit resumes from its last article rather than its end.
+        high_water_mark = df["publish_time"].max() if truncated and not df.empty else end
+        yield NewsChunk(start, end, df, links, embeddings, high_water_mark)
+        if remaining is not None:
+            remaining -= len(df)
+            if truncated or remaining <= 0:
+                logger.info("Reached --limit of %d articles; stopping at %s.", limit, high_water_mark)
+                return
+
+
+def store_chunk(chunk: NewsChunk, window: str, replace: bool) -> None:
+    # Named by the first article rather than the slice start, so the rest of a slice cut short by
+    # --limit lands in a new file instead of overwriting the part already stored.
+    first = chunk.news["publish_time"].min() if not chunk.news.empty else chunk.start
+    tag = first.strftime("%Y%m%d%H%M%S")
+    save_partitioned(chunk.news, "news", "publish_time", name=f"news_{tag}")
+    save_partitioned(chunk.links, "news_links", "publish_time", name=f"links_{tag}")
+    with get_engine().begin() as connection:
+        if not chunk.news.empty:
+            load_dataframe(
+                chunk.news, str(chunk.start), str(chunk.end), replace, chunk.links, connection, chunk.embeddings
+            )
+        mark_done(connection, JOB_NAME, window, len(chunk.news), value=chunk.high_water_mark.isoformat())
+    if not chunk.embeddings.empty:
+        clear_search_cache()
+
+
+def run(
+    client: TushareClient,
+    start_date: str,
+    end_date: str,
+    limit: Optional[int] = 50,
+    replace: bool = False,
+    concurrency: Optional[int] = None,
+    use_cache: bool = True,
+    slice_hours: int = 6,
+    queue_depth: int = 2,
+    restart: bool = False,
+) -> int:
+    window = f"{start_date}-{end_date}"
+    # Replacing a window means refetching all of it, however far an earlier run got.
+    saved = None if restart or replace else get_value(JOB_NAME, window)
+    resume_from = pd.Timestamp(saved) if saved else None
+    if resume_from is not None:
+        logger.info("Resuming %s from high-water mark %s.", window, resume_from)
+    slices = time_slices(start_date, end_date, slice_hours)
+    # Without pgvector (migration 9 pending) articles load as before, just without vectors.
+    embed_vectors = relation_exists("news_embeddings")
+    if not embed_vectors:
+        logger.warning("news_embeddings does not exist (pgvector missing?); skipping the embedding stage.")
+    # fetch -> (link, dedup, enrich, embed) -> load, each stage in its own thread with bounded
+    # queues between them, so Tushare calls overlap LLM calls and memory stays per-slice.
+    fetched = prefetch(fetch_slices(client, slices, resume_from), queue_depth, name="news-fetch")
+    processed = prefetch(
+        process_slices(fetched, limit, concurrency, use_cache, embed_vectors), queue_depth, name="news-enrich"
+    )
+    loaded = 0
+    for chunk in processed:
+        with metrics.stage("sync_reports.store", rows=len(chunk.news)):
+            store_chunk(chunk, window, replace)
+        loaded += len(chunk.news)
+    logger.info("News sync completed for window %s: %d articles loaded.", window, loaded)
+    return loaded
+
+
+def embed_missing(start_date: str, end_date: str, batch_size: int = EMBED_BACKFILL_BATCH) -> int:
+    # Backfills canonical articles stored without a vector for the current model: ones loaded
+    # while the backend was down, before migration 9, or under a previous embedding model.
+    if not relation_exists("news_embeddings"):
+        raise RuntimeError("news_embeddings does not exist; install pgvector and run market-migrate first.")
+    model = get_embedder().model
+    start = pd.to_datetime(start_date)
+    end = pd.to_datetime(end_date) + pd.Timedelta(days=1)
+    cursor = (start - pd.Timedelta(microseconds=1), "")
+    embedded = 0
+    while True:
+        with get_engine().connect() as connection:
+            batch = pd.read_sql(
+                text(
+                    """
+                    SELECT n.news_id, n.publish_time, n.security_id, n.title, n.body, n.duplicate_of
+                    FROM news n
+                    LEFT JOIN news_embeddings e ON e.news_id = n.news_id AND e.model = :model
+                    WHERE n.publish_time < :end
+                      AND (n.publish_time, n.news_id) > (:after_time, :after_id)
+                      AND n.duplicate_of IS NULL
+                      AND e.news_id IS NULL
+                    ORDER BY n.publish_time, n.news_id
+                    LIMIT :limit
+                    """
+                ),
+                connection,
+                params={"model": model, "end": end, "after_time": cursor[0], "after_id": cursor[1], "limit": batch_size},
             )
-        df.to_sql("news", connection, if_exists="append", index=False, method="multi", chunksize=500)
-    logger.info("Inserted %d rows into news.", len(df))
+        if batch.empty:
+            break
+        cursor = (batch["publish_time"].iloc[-1], batch["news_id"].iloc[-1])
+        with metrics.stage("sync_reports.embed", rows=len(batch)):
+            embeddings = embed_articles(batch)
+        bulk_upsert(embeddings, "news_embeddings", ("news_id",))
+        embedded += len(embeddings)
+        logger.info("Embedded %d articles up to %s.", embedded, cursor[0])
+    clear_search_cache()
+    return embedded
 
 
 def main() -> None:
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
     args = parse_args()
-    client = TushareClient()
-    logger.info("Fetching news from %s to %s.", args.start_date, args.end_date)
-    df = client.news(args.start_date, args.end_date)
-    df = transform(df, args.limit)
-    df = enrich(df)
-    save_dataframe(df, "news", f"{args.start_date}_{args.end_date}", f"news_{args.start_date}_{args.end_date}.csv")
-    load_dataframe(df, args.start_date, args.end_date, args.replace)
-    logger.info("News sync completed for window %s-%s.", args.start_date, args.end_date)
+    with metrics.track_run(JOB_NAME, args.profile, args.profile_mode):
+        if args.rebuild_rollup:
+            with get_engine().begin() as connection:
+                days = refresh_rollup(connection, pd.to_datetime(args.start_date), pd.to_datetime(args.end_date))
+            logger.info("Rebuilt sentiment rollup for %s-%s: %d security-days.", args.start_date, args.end_date, days)
+            return
+        if args.embed_missing:
+            embedded = embed_missing(args.start_date, args.end_date)
+            logger.info("Embedded %d articles for %s-%s.", embedded, args.start_date, args.end_date)
+            return
+        logger.info("Streaming news from %s to %s.", args.start_date, args.end_date)
+        run(
+            TushareClient(),
+            args.start_date,
+            args.end_date,
+            limit=args.limit,
+            replace=args.replace,
+            concurrency=args.concurrency,
+            use_cache=not args.no_cache,
+            slice_hours=args.slice_hours,
+            queue_depth=args.queue_depth,
+            restart=args.restart,
+        )
 
 
 if __name__ == "__main__":
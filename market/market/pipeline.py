@@ -0,0 +1,355 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from datetime import date
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+from sqlalchemy import text
+
+from market.config import get_settings
+from market.jobs import calc_features, fetch_daily, sync_financials, sync_reports
+from market.services import metrics
+from market.services.db import get_engine
+from market.services.storage import partition_fingerprint
+from market.services.tushare_client import TushareClient
+
+logger = logging.getLogger("pipeline")
+
+MANIFEST_VERSION = 1
+
+
+@dataclass(frozen=True)
+class Task:
+    name: str
+    action: Callable[[], int]
+    fingerprint: Callable[[], str]
+    deps: Tuple[str, ...] = ()
+    params: Tuple[object, ...] = ()
+    # Volatile tasks read external sources that change over time, so they always run;
+    # their downstream tasks still skip when the produced data hashes the same.
+    volatile: bool = False
+
+
+@dataclass
+class TaskOutcome:
+    status: str
+    rows: int = 0
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+
+def manifest_path() -> Path:
+    return get_settings().data_root / "state" / "pipeline_manifest.json"
+
+
+class Manifest:
+    def __init__(self, path: Optional[Path] = None) -> None:
+        self.path = path or manifest_path()
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict] = {}
+        if self.path.exists():
+            payload = json.loads(self.path.read_text(encoding="utf-8"))
+            if payload.get("version") == MANIFEST_VERSION:
+                self._entries = payload.get("tasks", {})
+
+    def get(self, name: str) -> Optional[Dict]:
+        with self._lock:
+            return self._entries.get(name)
+
+    def record(self, name: str, entry: Dict) -> None:
+        with self._lock:
+            self._entries[name] = entry
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(".json.tmp")
+            tmp_path.write_text(
+                json.dumps({"version": MANIFEST_VERSION, "tasks": self._entries}, indent=1, sort_keys=True),
+                encoding="utf-8",
+            )
+            os.replace(tmp_path, self.path)
+
+
+def _input_key(task: Task, manifest: Manifest) -> str:
+    upstream = {dep: (manifest.get(dep) or {}).get("output") for dep in task.deps}
+    payload = json.dumps([task.name, [str(param) for param in task.params], upstream], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _topological_order(tasks: Dict[str, Task]) -> List[str]:
+    remaining = {name: set(task.deps) for name, task in tasks.items()}
+    for name, deps in remaining.items():
+        missing = deps - tasks.keys()
+        if missing:
+            raise ValueError(f"Task {name} depends on unknown tasks: {', '.join(sorted(missing))}")
+    order: List[str] = []
+    while remaining:
+        ready = sorted(name for name, deps in remaining.items() if not deps)
+        if not ready:
+            raise ValueError(f"Dependency cycle among: {', '.join(sorted(remaining))}")
+        for name in ready:
+            order.append(name)
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+    return order
+
+
+def _is_fresh(task: Task, manifest: Manifest) -> bool:
+    entry = manifest.get(task.name)
+    if task.volatile or entry is None or entry.get("input") != _input_key(task, manifest):
+        return False
+    # Outputs are re-hashed so deleted or hand-edited partitions are rebuilt.
+    return entry.get("output") == task.fingerprint()
+
+
+def _execute(task: Task, manifest: Manifest, force: bool) -> TaskOutcome:
+    if not force and _is_fresh(task, manifest):
+        logger.info("Skipping %s: inputs and outputs unchanged.", task.name)
+        return TaskOutcome("skipped")
+    input_key = _input_key(task, manifest)
+    started = time.perf_counter()
+    logger.info("Running %s.", task.name)
+    with metrics.stage(f"pipeline.{task.name}") as stage:
+        rows = task.action()
+        stage.rows = rows
+    seconds = time.perf_counter() - started
+    output = task.fingerprint()
+    previous = manifest.get(task.name) or {}
+    manifest.record(
+        task.name,
+        {
+            "input": input_key,
+            "output": output,
+            "rows": int(rows or 0),
+            "seconds": round(seconds, 3),
+            "completed_at": pd.Timestamp.now().isoformat(timespec="seconds"),
+        },
+    )
+    changed = "unchanged" if previous.get("output") == output else "changed"
+    logger.info("Finished %s in %.1fs: %d rows, output %s.", task.name, seconds, rows or 0, changed)
+    return TaskOutcome("ok", int(rows or 0), seconds)
+
+
+def run_dag(tasks: List[Task], workers: int = 4, force: bool = False, dry_run: bool = False) -> Dict[str, TaskOutcome]:
+    by_name = {task.name: task for task in tasks}
+    order = _topological_order(by_name)
+    manifest = Manifest()
+    if dry_run:
+        for name in order:
+            task = by_name[name]
+            state = "run" if force or not _is_fresh(task, manifest) else "fresh"
+            logger.info("%-40s %-6s after %s", name, state, ", ".join(task.deps) or "-")
+        return {}
+    outcomes: Dict[str, TaskOutcome] = {}
+    running: Dict[Future, str] = {}
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="pipeline") as executor:
+        while len(outcomes) < len(order):
+            for name in order:
+                if name in outcomes or name in running.values():
+                    continue
+                deps = [outcomes.get(dep) for dep in by_name[name].deps]
+                if any(dep is None for dep in deps):
+                    continue
+                failed = [dep for dep, outcome in zip(by_name[name].deps, deps) if outcome.status in ("failed", "blocked")]
+                if failed:
+                    logger.error("Not running %s: upstream %s failed.", name, ", ".join(failed))
+                    outcomes[name] = TaskOutcome("blocked", error=f"upstream failed: {', '.join(failed)}")
+                    continue
+                running[executor.submit(_execute, by_name[name], manifest, force)] = name
+            if not running:
+                continue
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    outcomes[name] = future.result()
+                except Exception as exc:  # noqa: BLE001
+                    logger.exception("Task %s failed.", name)
+                    outcomes[name] = TaskOutcome("failed", error=str(exc))
+    return outcomes
+
+
+def _financials_fingerprint() -> str:
+    with get_engine().connect() as conn:
+        row = conn.execute(text("SELECT count(*), max(ann_date) FROM financial_metrics_history")).one()
+    return hashlib.sha256(f"{row[0]}|{row[1]}".encode("utf-8")).hexdigest()
+
+
+def _partitions(category: str, dates: List[str]) -> Callable[[], str]:
+    def fingerprint() -> str:
+        digest, rows = partition_fingerprint(category, dates)
+        return f"{digest}:{rows}"
+
+    return fingerprint
+
+
+def _calendar(start_date: str, end_date: str) -> List[str]:
+    return [day.strftime("%Y%m%d") for day in pd.date_range(pd.to_datetime(start_date), pd.to_datetime(end_date))]
+
+
+@dataclass
+class PipelineOptions:
+    workers: int = 4
+    force: bool = False
+    dry_run: bool = False
+    news: bool = True
+    financials: bool = True
+    news_limit: Optional[int] = None
+    window: int = 60
+    replace: bool = False
+
+
+def source_tasks(client: TushareClient, news_start: str, news_end: str, options: PipelineOptions) -> List[Task]:
+    tasks: List[Task] = []
+    if options.financials:
+        tasks.append(
+            Task(
+                "sync_financials:incremental",
+                lambda: sync_financials.run(client, incremental=True),
+                _financials_fingerprint,
+                volatile=True,
+            )
+        )
+    if options.news:
+        tasks.append(
+            Task(
+                f"sync_reports:{news_start}-{news_end}",
+                lambda: sync_reports.run(client, news_start, news_end, limit=options.news_limit),
+                _partitions("news", _calendar(news_start, news_end)),
+                params=(options.news_limit,),
+                volatile=True,
+            )
+        )
+    return tasks
+
+
+def daily_tasks(client: TushareClient, trade_date: str, options: PipelineOptions) -> List[Task]:
+    previous_day = (pd.to_datetime(trade_date) - pd.Timedelta(days=1)).strftime("%Y%m%d")
+    tasks = source_tasks(client, previous_day, trade_date, options)
+    if options.dry_run:
+        # A plan makes no Tushare calls; it shows the price and feature tasks a trade date gets.
+        logger.info("Dry run: not checking whether %s is a trade date.", trade_date)
+    elif not client.trade_dates(trade_date, trade_date):
+        logger.info("%s is not a trade date; only syncing news and financials.", trade_date)
+        return tasks
+
+    def fetch_prices() -> int:
+        rows = fetch_daily.run(client, trade_date, options.replace)
+        if not rows:
+            raise RuntimeError(f"No daily bars published for {trade_date} yet.")
+        return rows
+
+    fetch = Task(
+        f"fetch_daily:{trade_date}",
+        fetch_prices,
+        _partitions("daily", [trade_date]),
+        params=(options.replace,),
+    )
+    features = Task(
+        f"calc_features:{trade_date}",
+        lambda: calc_features.run(trade_date, options.window, options.replace, incremental=True),
+        _partitions("features", [trade_date]),
+        deps=(fetch.name, *(task.name for task in tasks)),
+        params=(options.window,),
+    )
+    return [*tasks, fetch, features]
+
+
+def range_tasks(client: TushareClient, start_date: str, end_date: str, options: PipelineOptions) -> List[Task]:
+    previous_day = (pd.to_datetime(start_date) - pd.Timedelta(days=1)).strftime("%Y%m%d")
+    tasks = source_tasks(client, previous_day, end_date, options)
+    if options.dry_run:
+        logger.info("Dry run: not fetching the trade calendar for %s-%s.", start_date, end_date)
+        trade_dates = _calendar(start_date, end_date)
+    else:
+        trade_dates = client.trade_dates(start_date, end_date)
+
+    def backfill() -> int:
+        # One task for the whole range: the backfill appends to the price matrix in date order.
+        failures = fetch_daily.backfill(client, start_date, end_date, options.replace, options.workers)
+        if failures:
+            raise RuntimeError(f"{failures} trade dates failed to load.")
+        return len(trade_dates)
+
+    fetch = Task(
+        f"fetch_daily:{start_date}-{end_date}",
+        backfill,
+        _partitions("daily", trade_dates),
+        params=(options.replace,),
+    )
+    features = Task(
+        f"calc_features:{start_date}-{end_date}",
+        lambda: calc_features.run_range(start_date, end_date, options.window, options.replace),
+        _partitions("features", trade_dates),
+        deps=(fetch.name, *(task.name for task in tasks)),
+        params=(options.window,),
+    )
+    return [*tasks, fetch, features]
+
+
+def _validate_date(value: str) -> str:
+    if len(value) != 8 or not value.isdigit():
+        raise argparse.ArgumentTypeError("Date must be YYYYMMDD.")
+    return value
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Run the market data pipeline as a dependency graph.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    daily = commands.add_parser("daily", help="Close-to-features run for one trade date.")
+    daily.add_argument("--date", type=_validate_date, default=date.today().strftime("%Y%m%d"), help="Trade date in YYYYMMDD.")
+    backfill = commands.add_parser("range", help="Backfill prices, news and features for a date range.")
+    backfill.add_argument("--start", type=_validate_date, required=True, help="First date in YYYYMMDD.")
+    backfill.add_argument("--end", type=_validate_date, required=True, help="Last date in YYYYMMDD.")
+    for command in (daily, backfill):
+        command.add_argument("--workers", type=int, default=4, help="Tasks run concurrently.")
+        command.add_argument("--force", action="store_true", help="Run every task even if its inputs are unchanged.")
+        command.add_argument("--dry-run", action="store_true", help="Print the plan without running anything.")
+        command.add_argument("--no-news", action="store_true", help="Leave out the news sync.")
+        command.add_argument("--no-financials", action="store_true", help="Leave out the financial indicator sync.")
+        command.add_argument("--news-limit", type=int, help="Maximum news items enriched per run (default: all).")
+        command.add_argument("--window", type=int, default=60, help="Feature lookback window in days.")
+        command.add_argument("--replace", action="store_true", help="Replace existing rows for the dates.")
+        metrics.add_profile_arguments(command)
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(threadName)s %(message)s")
+    args = parse_args(argv)
+    options = PipelineOptions(
+        workers=args.workers,
+        force=args.force,
+        dry_run=args.dry_run,
+        news=not args.no_news,
+        financials=not args.no_financials,
+        news_limit=args.news_limit,
+        window=args.window,
+        replace=args.replace,
+    )
+    with metrics.track_run("pipeline", args.profile, args.profile_mode):
+        # One client and one engine pool shared by every task in the process.
+        client = TushareClient()
+        if args.command == "daily":
+            tasks = daily_tasks(client, args.date, options)
+        else:
+            tasks = range_tasks(client, args.start, args.end, options)
+        outcomes = run_dag(tasks, options.workers, options.force, options.dry_run)
+        for name, outcome in outcomes.items():
+            logger.info("%-40s %-8s %8d rows %7.1fs", name, outcome.status, outcome.rows, outcome.seconds)
+        if any(outcome.status in ("failed", "blocked") for outcome in outcomes.values()):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+from typing import Iterable, Optional, Set
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from market.services.db import get_engine
+from market.services.schema import column_exists, relation_exists
+
+_table_ready = False
+
+
+def ensure_table(connection: Connection) -> None:
+    global _table_ready
+    if _table_ready:
+        return
+    if relation_exists("job_checkpoints") and not column_exists("job_checkpoints", "value"):
+        raise RuntimeError("job_checkpoints has no value column; run market-migrate first.")
+    connection.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS job_checkpoints (
+                job TEXT NOT NULL,
+                key TEXT NOT NULL,
+                rows BIGINT NOT NULL DEFAULT 0,
+                completed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                value TEXT,
+                PRIMARY KEY (job, key)
+            )
+            """
+        )
+    )
+    _table_ready = True
+
+
+def completed_keys(job: str, keys: Iterable[str]) -> Set[str]:
+    keys = list(keys)
+    if not keys:
+        return set()
+    with get_engine().begin() as connection:
+        ensure_table(connection)
+        result = connection.execute(
+            text("SELECT key FROM job_checkpoints WHERE job = :job AND key = ANY(:keys)"),
+            {"job": job, "keys": keys},
+        )
+        return {row.key for row in result}
+
+
+def mark_done(connection: Connection, job: str, key: str, rows: int, value: Optional[str] = None) -> None:
+    ensure_table(connection)
+    connection.execute(
+        text(
+            """
+            INSERT INTO job_checkpoints (job, key, rows, completed_at, value)
+            VALUES (:job, :key, :rows, now(), :value)
+            ON CONFLICT (job, key) DO UPDATE
+            SET rows = EXCLUDED.rows, completed_at = EXCLUDED.completed_at, value = EXCLUDED.value
+            """
+        ),
+        {"job": job, "key": key, "rows": rows, "value": value},
+    )
+
+
+def get_value(job: str, key: str) -> Optional[str]:
+    with get_engine().begin() as connection:
+        ensure_table(connection)
+        return connection.execute(
+            text("SELECT value FROM job_checkpoints WHERE job = :job AND key = :key"),
+            {"job": job, "key": key},
+        ).scalar()
@@ -1,13 +1,35 @@
 from __future__ import annotations
 
+import io
+import logging
+import time
+from dataclasses import dataclass
 from functools import lru_cache
-from typing import Generator
+from typing import Dict, Generator, List, Optional, Sequence, Set, Tuple, Union
 
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine import Engine
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from pandas.api.types import union_categoricals
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.engine import Connection, Engine
 from sqlalchemy.orm import Session, sessionmaker
 
 from market.config import get_settings
+from market.services import metrics
+
+logger = logging.getLogger("services.db")
+
+COPY_CHUNK_ROWS = 100_000
+READ_CHUNK_ROWS = 50_000
+
+
+@dataclass(frozen=True)
+class UpsertResult:
+    inserted: int = 0
+    updated: int = 0
+    deleted: int = 0
 
 
 @lru_cache(maxsize=1)
@@ -28,3 +50,205 @@ def run_healthcheck() -> bool:
         conn.execute(text("SELECT 1"))
     return True
 
+
+def read_frame(
+    statement: Union[str, TextClause],
+    params: Optional[Dict[str, object]] = None,
+    dtypes: Optional[Dict[str, str]] = None,
+    connection: Optional[Connection] = None,
+    chunk_rows: int = READ_CHUNK_ROWS,
+) -> DataFrame:
+    # Streams the result through a server-side cursor and converts each chunk into typed column
+    # arrays, so only one chunk of rows ever exists as Python objects next to the frame.
+    # dtypes maps columns to "category", "datetime64[ns]" or a numpy dtype such as "float32";
+    # other columns keep the dtype DataFrame(rows) infers.
+    if connection is None:
+        with get_engine().connect() as conn:
+            return read_frame(statement, params, dtypes, conn, chunk_rows)
+    dtypes = dtypes or {}
+    statement = text(statement) if isinstance(statement, str) else statement
+    started = time.perf_counter()
+    result = connection.execute(
+        statement.execution_options(stream_results=True, max_row_buffer=chunk_rows), params or {}
+    )
+    columns = list(result.keys())
+    chunks: Dict[str, list] = {column: [] for column in columns}
+    rows = 0
+    for partition in result.partitions(chunk_rows):
+        rows += len(partition)
+        chunk = DataFrame(partition, columns=columns)
+        for column in columns:
+            chunks[column].append(_typed_chunk(chunk[column], dtypes.get(column)))
+    if not rows:
+        empty = DataFrame([], columns=columns)
+        chunks = {column: [_typed_chunk(empty[column], dtypes.get(column))] for column in columns}
+    frame = DataFrame({column: _concat_chunks(chunks.pop(column)) for column in columns})
+    peak = metrics.peak_rss_mb()
+    logger.info(
+        "Streamed %d rows in %.2fs: %.1f MB as typed columns, peak RSS %s MB.",
+        rows,
+        time.perf_counter() - started,
+        frame.memory_usage(deep=True).sum() / 1e6,
+        f"{peak:.0f}" if peak is not None else "n/a",
+    )
+    return frame
+
+
+def _typed_chunk(values: pd.Series, dtype: Optional[str]):
+    if dtype is None:
+        return values
+    if dtype == "category":
+        return pd.Categorical(values)
+    if dtype.startswith("datetime64"):
+        return pd.to_datetime(values).to_numpy(dtype=dtype)
+    # NUMERIC columns arrive as Decimal objects and NULLs as None; both coerce to float first.
+    return pd.to_numeric(values, errors="coerce").to_numpy(dtype=dtype)
+
+
+def _concat_chunks(chunks: list):
+    if isinstance(chunks[0], pd.Categorical):
+        return union_categoricals(chunks, sort_categories=True) if len(chunks) > 1 else chunks[0]
+    if isinstance(chunks[0], pd.Series):
+        return pd.concat(chunks, ignore_index=True) if len(chunks) > 1 else chunks[0]
+    return np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+
+
+def bulk_upsert(
+    df: DataFrame,
+    table: str,
+    key_columns: Sequence[str],
+    connection: Optional[Connection] = None,
+    replace_scope: Optional[Dict[str, object]] = None,
+) -> UpsertResult:
+    if df.empty:
+        return UpsertResult()
+    if connection is None:
+        with get_engine().begin() as conn:
+            return bulk_upsert(df, table, key_columns, conn, replace_scope)
+    keys = list(key_columns)
+    with metrics.stage(f"db.upsert.{table}", rows=len(df)):
+        df = df.drop_duplicates(subset=keys, keep="last")
+        table_columns = _ensure_target(connection, df, table, keys)
+        extra = [column for column in df.columns if column not in table_columns]
+        if extra:
+            # Usually a pending migration; warned once per table and column set, not per batch.
+            if (table, tuple(extra)) not in _dropped_columns:
+                _dropped_columns.add((table, tuple(extra)))
+                logger.warning("Dropping columns not present in %s: %s", table, ", ".join(extra))
+            df = df.drop(columns=extra)
+        columns = list(df.columns)
+        stage = f"_stage_{table}"
+        connection.execute(text(f"DROP TABLE IF EXISTS {stage}"))
+        connection.execute(text(f"CREATE TEMP TABLE {stage} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP"))
+        _copy_frame(connection, df, stage, columns)
+        inserted, updated = _merge_stage(connection, stage, table, columns, keys)
+        deleted = 0
+        # replace_scope maps column -> value or (low, high); rows in scope missing from df are
+        # removed inside the same transaction, so readers never see a half-replaced table.
+        if replace_scope:
+            deleted = _delete_outside_stage(connection, stage, table, keys, replace_scope)
+        connection.execute(text(f"DROP TABLE {stage}"))
+        return UpsertResult(inserted=inserted, updated=updated, deleted=deleted)
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+_ensured_targets: Dict[Tuple[str, Tuple[str, ...]], List[str]] = {}
+_dropped_columns: Set[Tuple[str, Tuple[str, ...]]] = set()
+
+
+def _ensure_target(connection: Connection, df: DataFrame, table: str, keys: Sequence[str]) -> List[str]:
+    marker = (table, tuple(keys))
+    if marker in _ensured_targets:
+        return _ensured_targets[marker]
+    inspector = inspect(connection)
+    if not inspector.has_table(table):
+        df.head(0).to_sql(table, connection, index=False)
+    if not _has_unique_key(inspector, table, keys):
+        key_list = ", ".join(_quote(key) for key in keys)
+        index_name = f"{table}_{'_'.join(keys)}_key"
+        connection.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS {index_name} ON {table} ({key_list})"))
+    _ensured_targets[marker] = [column["name"] for column in inspector.get_columns(table)]
+    return _ensured_targets[marker]
+
+
+def _has_unique_key(inspector, table: str, keys: Sequence[str]) -> bool:
+    wanted = set(keys)
+    primary = inspector.get_pk_constraint(table).get("constrained_columns") or []
+    if set(primary) == wanted:
+        return True
+    for constraint in inspector.get_unique_constraints(table):
+        if set(constraint.get("column_names") or []) == wanted:
+            return True
+    for index in inspector.get_indexes(table):
+        if index.get("unique") and set(index.get("column_names") or []) == wanted:
+            return True
+    return False
+
+
+def _copy_frame(connection: Connection, df: DataFrame, table: str, columns: Sequence[str]) -> None:
+    column_list = ", ".join(_quote(column) for column in columns)
+    statement = f"COPY {table} ({column_list}) FROM STDIN WITH (FORMAT csv)"
+    cursor = connection.connection.cursor()
+    try:
+        for start in range(0, len(df), COPY_CHUNK_ROWS):
+            buffer = io.StringIO()
+            df.iloc[start : start + COPY_CHUNK_ROWS].to_csv(buffer, index=False, header=False, na_rep="")
+            buffer.seek(0)
+            cursor.copy_expert(statement, buffer)
+    finally:
+        cursor.close()
+
+
+def _merge_stage(
+    connection: Connection, stage: str, table: str, columns: Sequence[str], keys: Sequence[str]
+) -> Tuple[int, int]:
+    column_list = ", ".join(_quote(column) for column in columns)
+    key_list = ", ".join(_quote(key) for key in keys)
+    updates = [f"{_quote(column)} = EXCLUDED.{_quote(column)}" for column in columns if column not in keys]
+    conflict_action = f"DO UPDATE SET {', '.join(updates)}" if updates else "DO NOTHING"
+    row = connection.execute(
+        text(
+            f"""
+            WITH merged AS (
+                INSERT INTO {table} ({column_list})
+                SELECT {column_list} FROM {stage}
+                ON CONFLICT ({key_list}) {conflict_action}
+                RETURNING (xmax = 0) AS inserted
+            )
+            SELECT
+                COUNT(*) FILTER (WHERE inserted) AS inserted,
+                COUNT(*) FILTER (WHERE NOT inserted) AS updated
+            FROM merged
+            """
+        )
+    ).one()
+    return int(row.inserted), int(row.updated)
+
+
+def _delete_outside_stage(
+    connection: Connection, stage: str, table: str, keys: Sequence[str], scope: Dict[str, object]
+) -> int:
+    conditions = []
+    params: Dict[str, object] = {}
+    for index, (column, value) in enumerate(scope.items()):
+        if isinstance(value, tuple):
+            conditions.append(f"t.{_quote(column)} BETWEEN :scope_low_{index} AND :scope_high_{index}")
+            params[f"scope_low_{index}"], params[f"scope_high_{index}"] = value
+        else:
+            conditions.append(f"t.{_quote(column)} = :scope_{index}")
+            params[f"scope_{index}"] = value
+    key_match = " AND ".join(f"s.{_quote(key)} = t.{_quote(key)}" for key in keys)
+    result = connection.execute(
+        text(
+            f"""
+            DELETE FROM {table} AS t
+            WHERE {' AND '.join(conditions)}
+              AND NOT EXISTS (SELECT 1 FROM {stage} AS s WHERE {key_match})
+            """
+        ),
+        params,
+    )
+    return result.rowcount
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import re
+import unicodedata
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from market.services.db import get_engine
+from market.services.schema import column_exists
+
+logger = logging.getLogger("services.dedup")
+
+SHINGLE_SIZE = 3
+MIN_TEXT_CHARS = 30
+NUM_PERMUTATIONS = 64
+# 16 bands of 4 rows: pairs with Jaccard 0.7 become candidates ~99% of the time, pairs
+# below 0.3 almost never; candidates are then confirmed on the full signature.
+BANDS = 16
+ROWS_PER_BAND = NUM_PERMUTATIONS // BANDS
+SIMILARITY_THRESHOLD = 0.7
+LOOKBACK_DAYS = 3
+LLM_COLUMNS = ["summary", "sentiment", "risk_tags", "highlights"]
+_PRIME = np.uint64(4294967311)
+_rng = np.random.default_rng(20240101)
+# a < 2**31 keeps a * hash + b inside uint64 for 32-bit shingle hashes.
+_A = _rng.integers(1, 1 << 31, NUM_PERMUTATIONS, dtype=np.uint64)
+_B = _rng.integers(0, 1 << 32, NUM_PERMUTATIONS, dtype=np.uint64)
+_NOISE = re.compile(r"[\s\W_]+", re.UNICODE)
+
+
+def _shingle_hashes(content: str) -> np.ndarray:
+    shingles = {content[position : position + SHINGLE_SIZE] for position in range(len(content) - SHINGLE_SIZE + 1)}
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=4).digest(), "little") for item in shingles),
+        dtype=np.uint64,
+        count=len(shingles),
+    )
+
+
+def signature(title: Optional[str], body: Optional[str]) -> Optional[np.ndarray]:
+    content = body if isinstance(body, str) and len(body) >= MIN_TEXT_CHARS else f"{title or ''}{body or ''}"
+    content = _NOISE.sub("", unicodedata.normalize("NFKC", content).lower())
+    if len(content) < MIN_TEXT_CHARS:
+        return None
+    hashes = _shingle_hashes(content)
+    permuted = (hashes[:, None] * _A + _B) % _PRIME
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def encode(value: Optional[np.ndarray]) -> Optional[str]:
+    return None if value is None else value.astype("<u4").tobytes().hex()
+
+
+def decode(value: Optional[str]) -> Optional[np.ndarray]:
+    if not isinstance(value, str) or not value:
+        return None
+    return np.frombuffer(bytes.fromhex(value), dtype="<u4")
+
+
+def similarity(left: np.ndarray, right: np.ndarray) -> float:
+    return float(np.count_nonzero(left == right)) / NUM_PERMUTATIONS
+
+
+class MinHashIndex:
+    def __init__(self) -> None:
+        self._buckets: List[Dict[bytes, List[str]]] = [defaultdict(list) for _ in range(BANDS)]
+        self._signatures: Dict[str, np.ndarray] = {}
+
+    @staticmethod
+    def _bands(value: np.ndarray) -> List[bytes]:
+        return [value[band * ROWS_PER_BAND : (band + 1) * ROWS_PER_BAND].tobytes() for band in range(BANDS)]
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def add(self, key: str, value: np.ndarray) -> None:
+        self._signatures[key] = value
+        for band, bucket in zip(self._bands(value), self._buckets):
+            bucket[band].append(key)
+
+    def query(self, value: np.ndarray) -> Optional[str]:
+        best: Optional[Tuple[float, str]] = None
+        seen = set()
+        for band, bucket in zip(self._bands(value), self._buckets):
+            for key in bucket.get(band, ()):
+                if key in seen:
+                    continue
+                seen.add(key)
+                score = similarity(value, self._signatures[key])
+                if score >= SIMILARITY_THRESHOLD and (best is None or score > best[0]):
+                    best = (score, key)
+        return best[1] if best else None
+
+
+def fetch_recent_canonicals(start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+    if not column_exists("news", "duplicate_of"):
+        # Before migration 8 nothing stored carries a signature, so the batch dedups against itself.
+        logger.warning("news.minhash/duplicate_of do not exist; run market-migrate to dedup against stored news.")
+        return pd.DataFrame(columns=["news_id", "publish_time", "minhash", *LLM_COLUMNS])
+    with get_engine().connect() as conn:
+        result = conn.execute(
+            text(
+                f"""
+                SELECT news_id, publish_time, minhash, {', '.join(LLM_COLUMNS)}
+                FROM news
+                WHERE publish_time >= :start AND publish_time <= :end
+                  AND minhash IS NOT NULL AND duplicate_of IS NULL
+                """
+            ),
+            {"start": start, "end": end},
+        )
+        return pd.DataFrame(result.fetchall(), columns=result.keys())
+
+
+def find_duplicates(df: pd.DataFrame, stored: pd.DataFrame) -> pd.Series:
+    # Articles are visited oldest first, so the canonical copy of a story is its first
+    # appearance; stored canonicals are indexed up front and win over batch copies.
+    index = MinHashIndex()
+    if not stored.empty:
+        for news_id, value in zip(stored["news_id"], stored["minhash"]):
+            decoded = decode(value)
+            if decoded is not None:
+                index.add(news_id, decoded)
+    stored_ids = set(stored["news_id"]) if not stored.empty else set()
+    duplicate_of = pd.Series(None, index=df.index, dtype="object")
+    for row_index in df.sort_values("publish_time", kind="mergesort").index:
+        news_id = df.at[row_index, "news_id"]
+        value = decode(df.at[row_index, "minhash"])
+        if news_id in stored_ids or value is None:
+            continue
+        canonical = index.query(value)
+        if canonical is not None and canonical != news_id:
+            duplicate_of[row_index] = canonical
+        else:
+            index.add(news_id, value)
+    return duplicate_of
@@ -0,0 +1,391 @@
+from __future__ import annotations
+
+import logging
+import random
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple, Union
+
+import httpx
+import numpy as np
+import pandas as pd
+from pgvector import Vector
+from sqlalchemy import text
+
+from market.config import get_settings
+from market.services import metrics
+from market.services.db import get_engine
+
+logger = logging.getLogger("services.embeddings")
+
+# news_embeddings.embedding is vector(512); every backend has to produce exactly this many.
+DIMENSIONS = 512
+MAX_CHARS = 2_000
+EMBEDDING_COLUMNS = ["news_id", "publish_time", "security_id", "model", "embedding"]
+RESULT_COLUMNS = ["news_id", "publish_time", "security_id", "title", "summary", "similarity"]
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+HASH_NGRAMS = (1, 2, 3)
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+_HASH_PRIME = np.uint64(1_000_003)
+# HNSW candidate list per query; recall flattens out well before 100 at this dimension.
+EF_SEARCH = 100
+# Windows this short (or any per-security filter) are scanned exactly: the candidate set is
+# small, and post-filtering an approximate walk over the whole index could return too few rows.
+EXACT_SCAN_DAYS = 2
+SEARCH_CACHE_ENTRIES = 1_024
+SEARCH_CACHE_TTL_SECONDS = 300
+
+
+class EmbeddingUnavailable(RuntimeError):
+    pass
+
+
+def _l2_normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms > 0)
+
+
+class HashingEmbedder:
+    # Signed feature hashing of character 1-3 grams: no model download, identical vectors in
+    # every process, and close enough to find coverage that shares names and phrasing.
+
+    def __init__(self, dimensions: int = DIMENSIONS) -> None:
+        self.dimensions = dimensions
+        self.model = f"hashing-ngram-{dimensions}"
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, content in enumerate(texts):
+            normalized = "".join(unicodedata.normalize("NFKC", content or "").lower().split())
+            codes = np.frombuffer(normalized.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+            for size in HASH_NGRAMS:
+                if len(codes) < size:
+                    break
+                grams = np.full(len(codes) - size + 1, size, dtype=np.uint64)
+                for offset in range(size):
+                    grams = grams * _HASH_PRIME + codes[offset : len(codes) - size + 1 + offset]
+                mixed = grams * _HASH_MULTIPLIER
+                buckets = (mixed >> np.uint64(40)) % np.uint64(self.dimensions)
+                signs = np.where((mixed >> np.uint64(39)) & np.uint64(1), -1.0, 1.0)
+                matrix[row] += np.bincount(buckets.astype(np.int64), weights=signs, minlength=self.dimensions)
+        # Sublinear counts keep long articles from being dominated by their most repeated grams.
+        return _l2_normalize(np.sign(matrix) * np.log1p(np.abs(matrix)))
+
+
+class HTTPEmbedder:
+    # OpenAI-compatible /v1/embeddings endpoint, called in batches with retries.
+
+    def __init__(
+        self,
+        endpoint: str,
+        api_key: Optional[str],
+        model: str,
+        dimensions: int = DIMENSIONS,
+        batch_size: int = 64,
+        max_retries: int = 5,
+        timeout: float = 60.0,
+    ) -> None:
+        self.endpoint = endpoint
+        self.model = model
+        self.dimensions = dimensions
+        self._api_key = api_key
+        self._batch_size = max(1, batch_size)
+        self._max_retries = max_retries
+        self._timeout = timeout
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        vectors: List[List[float]] = []
+        headers = {"Content-Type": "application/json"}
+        if self._api_key:
+            headers["Authorization"] = f"Bearer {self._api_key}"
+        with httpx.Client(timeout=self._timeout) as client:
+            for start in range(0, len(texts), self._batch_size):
+                batch = [content or " " for content in texts[start : start + self._batch_size]]
+                payload = {"model": self.model, "input": batch, "dimensions": self.dimensions}
+                data = self._post_with_retry(client, headers, payload).json().get("data") or []
+                if len(data) != len(batch):
+                    raise ValueError(f"embedding endpoint returned {len(data)} vectors for {len(batch)} inputs")
+                vectors.extend(item["embedding"] for item in sorted(data, key=lambda item: item.get("index", 0)))
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+        if len(texts) and matrix.shape[1] != self.dimensions:
+            raise ValueError(
+                f"{self.model} returned {matrix.shape[1]} dimensions; news_embeddings expects {self.dimensions}"
+            )
+        return _l2_normalize(matrix)
+
+    def _post_with_retry(self, client: httpx.Client, headers: Dict[str, str], payload: Dict) -> httpx.Response:
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = client.post(self.endpoint, headers=headers, json=payload)
+            except httpx.TransportError:
+                metrics.observe("embedding", "embed", time.perf_counter() - started, ok=False)
+                if attempt >= self._max_retries:
+                    raise
+                time.sleep(_backoff(attempt))
+                attempt += 1
+                continue
+            metrics.observe("embedding", "embed", time.perf_counter() - started, ok=response.status_code < 400)
+            if response.status_code in RETRY_STATUS_CODES and attempt < self._max_retries:
+                time.sleep(_backoff(attempt))
+                attempt += 1
+                continue
+            response.raise_for_status()
+            return response
+
+
+def _backoff(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    return min(cap, base * 2**attempt) * random.uniform(0.5, 1.5)
+
+
+@lru_cache(maxsize=1)
+def get_embedder() -> Union[HashingEmbedder, HTTPEmbedder]:
+    settings = get_settings()
+    if settings.embedding_backend == "local":
+        return HashingEmbedder()
+    if settings.embedding_backend == "http":
+        if not settings.embedding_endpoint:
+            raise EmbeddingUnavailable("EMBEDDING_BACKEND=http but EMBEDDING_ENDPOINT is not configured.")
+        return HTTPEmbedder(
+            settings.embedding_endpoint,
+            settings.embedding_api_key,
+            settings.embedding_model,
+            batch_size=settings.embedding_batch_size,
+        )
+    raise EmbeddingUnavailable(f"Unknown EMBEDDING_BACKEND {settings.embedding_backend!r}; use local or http.")
+
+
+def article_text(title, body) -> str:
+    parts = [part.strip() for part in (title, body) if isinstance(part, str) and part.strip()]
+    return "\n".join(parts)[:MAX_CHARS]
+
+
+def embed_articles(df: pd.DataFrame) -> pd.DataFrame:
+    # Near-duplicates are not embedded: they would crowd every result list with reposts,
+    # and similar_to() resolves them to their canonical article instead.
+    if df.empty:
+        return pd.DataFrame(columns=EMBEDDING_COLUMNS)
+    canonical = df[df["duplicate_of"].isna()] if "duplicate_of" in df.columns else df
+    titles = canonical["title"] if "title" in canonical.columns else pd.Series(None, index=canonical.index)
+    bodies = canonical["body"] if "body" in canonical.columns else pd.Series(None, index=canonical.index)
+    texts = pd.Series([article_text(title, body) for title, body in zip(titles, bodies)], index=canonical.index)
+    texts = texts[texts.str.len() > 0]
+    if texts.empty:
+        return pd.DataFrame(columns=EMBEDDING_COLUMNS)
+    embedder = get_embedder()
+    vectors = embedder.embed(list(texts))
+    rows = canonical.loc[texts.index]
+    return pd.DataFrame(
+        {
+            "news_id": rows["news_id"].to_numpy(),
+            "publish_time": rows["publish_time"].to_numpy(),
+            "security_id": rows["security_id"].to_numpy() if "security_id" in rows.columns else None,
+            "model": embedder.model,
+            "embedding": [Vector(vector).to_text() for vector in vectors],
+        }
+    )
+
+
+class QueryCache:
+    # In-process LRU of recent search results. Entries also expire after ttl_seconds so a
+    # long-lived process picks up articles loaded by other processes.
+
+    def __init__(self, max_entries: int, ttl_seconds: float) -> None:
+        self._max_entries = max_entries
+        self._ttl = ttl_seconds
+        self._entries: "OrderedDict[Hashable, Tuple[float, pd.DataFrame]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[pd.DataFrame]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self._ttl:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1].copy()
+
+    def put(self, key: Hashable, value: pd.DataFrame) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value.copy())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+
+_search_cache = QueryCache(SEARCH_CACHE_ENTRIES, SEARCH_CACHE_TTL_SECONDS)
+
+
+def clear_search_cache() -> None:
+    _search_cache.clear()
+
+
+def search_cache_stats() -> Dict[str, int]:
+    return _search_cache.stats()
+
+
+@lru_cache(maxsize=4_096)
+def _query_literal(query: str) -> str:
+    return Vector(get_embedder().embed([query])[0]).to_text()
+
+
+@lru_cache(maxsize=1)
+def _iterative_scan_supported() -> bool:
+    # pgvector 0.8 can keep walking the HNSW graph until enough rows pass the filters.
+    with get_engine().connect() as connection:
+        version = connection.execute(text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")).scalar()
+    try:
+        return tuple(int(part) for part in (version or "0").split(".")[:2]) >= (0, 8)
+    except ValueError:
+        return False
+
+
+def search(
+    query: str,
+    k: int = 10,
+    securities: Optional[Sequence[str]] = None,
+    start=None,
+    end=None,
+    use_cache: bool = True,
+) -> pd.DataFrame:
+    query = " ".join(query.split())
+    if not query:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    return _cached(("text", query), k, securities, start, end, (), use_cache, lambda: _query_literal(query))
+
+
+def similar_to(
+    news_id: str,
+    k: int = 10,
+    securities: Optional[Sequence[str]] = None,
+    start=None,
+    end=None,
+    use_cache: bool = True,
+) -> pd.DataFrame:
+    # "Other articles like this one": a near-duplicate is looked up through its canonical
+    # article, and neither of them is returned.
+    with get_engine().connect() as connection:
+        row = connection.execute(
+            text(
+                """
+                SELECT e.news_id, e.embedding::text AS embedding
+                FROM news_embeddings e
+                WHERE e.news_id = COALESCE(
+                    (SELECT duplicate_of FROM news WHERE news_id = :news_id AND duplicate_of IS NOT NULL LIMIT 1),
+                    :news_id
+                )
+                """
+            ),
+            {"news_id": news_id},
+        ).first()
+    if row is None:
+        raise KeyError(f"No embedding stored for article {news_id}.")
+    exclude = tuple(sorted({news_id, row.news_id}))
+    return _cached(("news", row.news_id), k, securities, start, end, exclude, use_cache, lambda: row.embedding)
+
+
+def _cached(
+    kind: Tuple[str, str],
+    k: int,
+    securities: Optional[Sequence[str]],
+    start,
+    end,
+    exclude: Tuple[str, ...],
+    use_cache: bool,
+    literal: Callable[[], str],
+) -> pd.DataFrame:
+    model = get_embedder().model
+    securities = tuple(sorted(set(securities))) if securities else ()
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+    key = (model, kind, k, securities, start, end, exclude)
+    if use_cache:
+        cached = _search_cache.get(key)
+        if cached is not None:
+            return cached
+    started = time.perf_counter()
+    ok = False
+    try:
+        result = _nearest(literal(), model, k, securities, start, end, exclude)
+        ok = True
+    finally:
+        metrics.observe("embedding", "search", time.perf_counter() - started, ok=ok)
+    if use_cache:
+        _search_cache.put(key, result)
+    return result
+
+
+def _nearest(
+    literal: str,
+    model: str,
+    k: int,
+    securities: Tuple[str, ...],
+    start: Optional[pd.Timestamp],
+    end: Optional[pd.Timestamp],
+    exclude: Tuple[str, ...],
+) -> pd.DataFrame:
+    params: Dict[str, object] = {"query": literal, "model": model, "k": k, "exclude": list(exclude)}
+    filters = ["e.model = :model", "e.news_id <> ALL(:exclude)"]
+    if start is not None:
+        filters.append("e.publish_time >= :start")
+        params["start"] = start
+    if end is not None:
+        filters.append("e.publish_time < :end")
+        params["end"] = end
+    distance = "e.embedding <=> CAST(:query AS vector)"
+    narrow = start is not None and end is not None and end - start <= pd.Timedelta(days=EXACT_SCAN_DAYS)
+    iterative = _iterative_scan_supported()
+    exact = bool(securities) or narrow or (not iterative and (start is not None or end is not None))
+    if securities:
+        params["securities"] = list(securities)
+        bounds = (("publish_time >= :start", start), ("publish_time < :end", end))
+        window = [clause for clause, value in bounds if value is not None]
+        source = f"""
+            (SELECT DISTINCT news_id FROM news_securities
+             WHERE {' AND '.join(["security_id = ANY(:securities)", *window])}) candidates
+            JOIN news_embeddings e ON e.news_id = candidates.news_id
+        """
+    else:
+        source = "news_embeddings e"
+    inner = f"""
+        SELECT e.news_id, e.publish_time, e.security_id, {distance} AS distance
+        FROM {source}
+        WHERE {' AND '.join(filters)}
+    """
+    if exact:
+        # Materialized first so the planner scores only the filtered rows instead of
+        # walking the HNSW index and discarding most of what it finds.
+        nearest = f"scored AS MATERIALIZED ({inner}), nearest AS (SELECT * FROM scored ORDER BY distance LIMIT :k)"
+    else:
+        nearest = f"nearest AS MATERIALIZED ({inner} ORDER BY distance LIMIT :k)"
+    statement = f"""
+        WITH {nearest}
+        SELECT nearest.news_id, nearest.publish_time, nearest.security_id, n.title, n.summary,
+               1 - nearest.distance AS similarity
+        FROM nearest
+        LEFT JOIN news n ON n.news_id = nearest.news_id AND n.publish_time = nearest.publish_time
+        ORDER BY nearest.distance
+    """
+    with get_engine().begin() as connection:
+        if not exact:
+            connection.execute(text(f"SET LOCAL hnsw.ef_search = {max(EF_SEARCH, int(k))}"))
+            if iterative and (start is not None or end is not None):
+                connection.execute(text("SET LOCAL hnsw.iterative_scan = relaxed_order"))
+        result = pd.read_sql(text(statement), connection, params=params)
+    return result.reindex(columns=RESULT_COLUMNS)
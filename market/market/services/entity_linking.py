@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import logging
+import os
+import pickle
+import re
+import time
+import unicodedata
+from collections import defaultdict
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import ahocorasick
+import jieba
+import pandas as pd
+
+from market.config import get_settings
+
+logger = logging.getLogger("services.entity_linking")
+
+INDEX_VERSION = 1
+INDEX_MAX_AGE_SECONDS = 24 * 3600
+# Weight of one mention by the kind of pattern that matched it.
+MATCH_WEIGHTS = {"fullname": 1.0, "name": 1.0, "code": 0.9, "alias": 0.7, "former": 0.5}
+TITLE_BOOST = 3.0
+MIN_RELEVANCE = 0.2
+# Aliases this short (e.g. 平安, 万科) also occur inside ordinary words, so their matches
+# must line up with jieba token boundaries.
+AMBIGUOUS_LENGTH = 2
+BOUNDARY_CONTEXT = 8
+# Patterns are matched against normalize()d text, hence the lower-case markers.
+_STATUS_PREFIX = re.compile(r"^(\*?st|s\*st|sst|xd|xr|dr|n|c)(?=[一-鿿])")
+_SHARE_SUFFIX = re.compile(r"(?<=[一-鿿])[ab]$")
+_ASCII_WORD = re.compile(r"[0-9a-z]")
+
+Match = Tuple[str, str]  # (security_id, kind)
+
+
+@dataclass(frozen=True)
+class Link:
+    security_id: str
+    relevance: float
+    mentions: int
+
+
+def normalize(value: Optional[str]) -> str:
+    if not isinstance(value, str):
+        return ""
+    return unicodedata.normalize("NFKC", value).lower().replace(" ", "").replace("　", "")
+
+
+def build_patterns(securities: pd.DataFrame, name_changes: Optional[pd.DataFrame] = None) -> Dict[str, List[Match]]:
+    patterns: Dict[str, List[Match]] = defaultdict(list)
+
+    def add(raw: Optional[str], security_id: str, kind: str) -> None:
+        key = normalize(raw)
+        if len(key) < AMBIGUOUS_LENGTH or (security_id, kind) in patterns[key]:
+            return
+        patterns[key].append((security_id, kind))
+
+    for row in securities.itertuples(index=False):
+        security_id = row.ts_code
+        name = normalize(getattr(row, "name", None))
+        base = _STATUS_PREFIX.sub("", name)
+        add(name, security_id, "name")
+        add(base, security_id, "name")
+        add(_SHARE_SUFFIX.sub("", base), security_id, "alias")
+        add(getattr(row, "fullname", None), security_id, "fullname")
+        add(getattr(row, "enname", None), security_id, "alias")
+        add(security_id, security_id, "code")
+        add(getattr(row, "symbol", None), security_id, "code")
+    if name_changes is not None and not name_changes.empty:
+        known = set(securities["ts_code"])
+        for row in name_changes.itertuples(index=False):
+            if row.ts_code in known:
+                add(_STATUS_PREFIX.sub("", normalize(row.name)), row.ts_code, "former")
+    return dict(patterns)
+
+
+class EntityLinker:
+    # Leftmost-longest Aho-Corasick scan over normalized text, so 中国平安 wins over 平安;
+    # jieba is only consulted for the few short aliases that need a word-boundary check.
+
+    def __init__(self, patterns: Dict[str, List[Match]]) -> None:
+        self.patterns = patterns
+        self.automaton = ahocorasick.Automaton()
+        for key, matches in patterns.items():
+            self.automaton.add_word(key, (key, tuple(matches)))
+        self.automaton.make_automaton()
+        self._tokenizer: Optional[jieba.Tokenizer] = None
+
+    @property
+    def tokenizer(self) -> jieba.Tokenizer:
+        if self._tokenizer is None:
+            jieba.setLogLevel(logging.WARNING)
+            tokenizer = jieba.Tokenizer()
+            for key in self.patterns:
+                if not _ASCII_WORD.search(key):
+                    tokenizer.add_word(key)
+            self._tokenizer = tokenizer
+        return self._tokenizer
+
+    def __getstate__(self) -> dict:
+        return {"patterns": self.patterns, "automaton": self.automaton}
+
+    def __setstate__(self, state: dict) -> None:
+        self.patterns = state["patterns"]
+        self.automaton = state["automaton"]
+        self._tokenizer = None
+
+    def mentions(
+        self, text: str, totals: Dict[str, float], counts: Dict[str, int], boost: float = 1.0
+    ) -> None:
+        if not text or not self.patterns:
+            return
+        for end, (key, matches) in self.automaton.iter_long(text):
+            start = end - len(key) + 1
+            if not self._accept(text, key, start, end + 1):
+                continue
+            share = boost / len(matches)
+            for security_id, kind in matches:
+                totals[security_id] += MATCH_WEIGHTS[kind] * share
+                counts[security_id] += 1
+
+    def link(self, title: Optional[str], body: Optional[str]) -> List[Link]:
+        totals: Dict[str, float] = defaultdict(float)
+        counts: Dict[str, int] = defaultdict(int)
+        self.mentions(normalize(title), totals, counts, TITLE_BOOST)
+        self.mentions(normalize(body), totals, counts)
+        if not totals:
+            return []
+        best = max(totals.values())
+        links = [
+            Link(security_id, round(score / best, 4), counts[security_id])
+            for security_id, score in totals.items()
+            if score / best >= MIN_RELEVANCE
+        ]
+        return sorted(links, key=lambda link: (-link.relevance, link.security_id))
+
+    def _accept(self, text: str, key: str, start: int, end: int) -> bool:
+        if _ASCII_WORD.search(key):
+            # Codes and English names must not be glued to other letters or digits.
+            before = text[start - 1] if start > 0 else ""
+            after = text[end] if end < len(text) else ""
+            return not (_ASCII_WORD.match(before or " ") or _ASCII_WORD.match(after or " "))
+        if len(key) > AMBIGUOUS_LENGTH:
+            return True
+        offset = max(0, start - BOUNDARY_CONTEXT)
+        window = text[offset : end + BOUNDARY_CONTEXT]
+        boundaries = {offset}
+        for _, _, token_end in self.tokenizer.tokenize(window):
+            boundaries.add(offset + token_end)
+        return start in boundaries and end in boundaries
+
+
+def link_frame(linker: EntityLinker, df: pd.DataFrame) -> pd.DataFrame:
+    columns = ["news_id", "publish_time", "security_id", "relevance", "mentions"]
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+    titles = df["title"] if "title" in df.columns else pd.Series(None, index=df.index)
+    bodies = df["body"] if "body" in df.columns else pd.Series(None, index=df.index)
+    rows = []
+    started = time.perf_counter()
+    for news_id, publish_time, title, body in zip(df["news_id"], df["publish_time"], titles, bodies):
+        for link in linker.link(title, body):
+            rows.append((news_id, publish_time, link.security_id, link.relevance, link.mentions))
+    logger.info("Linked %d articles to %d security mentions in %.2fs.", len(df), len(rows), time.perf_counter() - started)
+    return pd.DataFrame(rows, columns=columns)
+
+
+def index_path() -> Path:
+    return get_settings().data_root / "cache" / "entity_index.pkl"
+
+
+def load_linker(client=None, max_age: float = INDEX_MAX_AGE_SECONDS) -> EntityLinker:
+    path = index_path()
+    try:
+        if time.time() - path.stat().st_mtime < max_age:
+            with path.open("rb") as handle:
+                cached = pickle.load(handle)
+            if cached.get("version") == INDEX_VERSION:
+                return cached["linker"]
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError, AttributeError, KeyError):
+        pass
+    if client is None:
+        from market.services.tushare_client import TushareClient
+
+        client = TushareClient()
+    linker = build_linker(client.stock_basic(), client.name_changes())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(".tmp")
+    with tmp_path.open("wb") as handle:
+        pickle.dump({"version": INDEX_VERSION, "linker": linker}, handle)
+    os.replace(tmp_path, path)
+    return linker
+
+
+def build_linker(securities: pd.DataFrame, name_changes: Optional[pd.DataFrame] = None) -> EntityLinker:
+    started = time.perf_counter()
+    patterns = build_patterns(securities, name_changes)
+    linker = EntityLinker(patterns)
+    logger.info(
+        "Built entity index: %d securities, %d patterns in %.2fs.",
+        len(securities),
+        len(patterns),
+        time.perf_counter() - started,
+    )
+    return linker
+
+
+@lru_cache(maxsize=1)
+def get_linker() -> EntityLinker:
+    return load_linker()
+
+
+def primary_securities(links: pd.DataFrame, news_ids: Iterable[str]) -> List[Optional[str]]:
+    if links.empty:
+        return [None for _ in news_ids]
+    top = links.sort_values(["relevance", "mentions"], ascending=False).drop_duplicates("news_id")
+    lookup = dict(zip(top["news_id"], top["security_id"]))
+    return [lookup.get(news_id) for news_id in news_ids]
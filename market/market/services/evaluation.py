@@ -0,0 +1,376 @@
+from __future__ import annotations
+
+import logging
+import warnings
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from market.services.db import get_engine, read_frame
+from market.services.screening import NON_FACTOR_COLUMNS, ZSCORE_CLIP
+
+logger = logging.getLogger("services.evaluation")
+
+TRADING_DAYS = 252
+DEFAULT_HORIZONS = (1, 5, 20)
+# Cross-sections thinner than this get no IC and no quantile portfolios for the day.
+MIN_NAMES = 20
+COMPOSITE = "score"
+
+
+@dataclass(frozen=True)
+class FactorPanel:
+    # Wide date x security matrices, one per factor, sharing the same axes.
+    dates: pd.DatetimeIndex
+    securities: pd.Index
+    values: Dict[str, np.ndarray]
+
+    @property
+    def factors(self) -> List[str]:
+        return list(self.values)
+
+
+@dataclass(frozen=True)
+class Evaluation:
+    summary: pd.DataFrame
+    ic: pd.DataFrame
+    quantile_returns: Dict[str, pd.DataFrame]
+    turnover: Dict[str, pd.DataFrame]
+    long_short: pd.DataFrame
+
+    @property
+    def equity(self) -> pd.DataFrame:
+        return (1.0 + self.long_short.fillna(0.0)).cumprod()
+
+
+def panel_from_frame(df: pd.DataFrame, factors: Optional[Sequence[str]] = None) -> FactorPanel:
+    # Long snapshot rows -> wide matrices by integer codes, without a pivot per factor.
+    if factors is None:
+        factors = [
+            column
+            for column in df.columns
+            if column not in NON_FACTOR_COLUMNS and pd.api.types.is_numeric_dtype(df[column])
+        ]
+    date_codes, dates = pd.factorize(pd.to_datetime(df["snapshot_date"]), sort=True)
+    security_codes, securities = pd.factorize(df["security_id"], sort=True)
+    values: Dict[str, np.ndarray] = {}
+    for name in factors:
+        matrix = np.full((len(dates), len(securities)), np.nan)
+        matrix[date_codes, security_codes] = pd.to_numeric(df[name], errors="coerce").to_numpy(dtype=np.float64)
+        values[name] = matrix
+    return FactorPanel(pd.DatetimeIndex(dates), pd.Index(np.asarray(securities, dtype=object)), values)
+
+
+def snapshot_factor_columns() -> List[str]:
+    with get_engine().connect() as connection:
+        rows = connection.execute(
+            text(
+                """
+                SELECT column_name FROM information_schema.columns
+                WHERE table_name = 'feature_snapshots'
+                  AND data_type IN ('double precision', 'real', 'numeric', 'integer', 'bigint', 'smallint')
+                ORDER BY ordinal_position
+                """
+            )
+        )
+        return [row[0] for row in rows if row[0] not in NON_FACTOR_COLUMNS]
+
+
+def load_feature_panel(start_date: str, end_date: str, factors: Optional[Sequence[str]] = None) -> FactorPanel:
+    available = snapshot_factor_columns()
+    factors = list(factors) if factors else available
+    unknown = [name for name in factors if name not in available]
+    if unknown:
+        raise KeyError(f"Unknown feature_snapshots columns {unknown}; available: {', '.join(available)}")
+    # Names are checked against the catalog above, so they are safe to interpolate.
+    columns = ", ".join(f'"{name}"' for name in factors)
+    # Ranks and portfolio sorts do not need more than float32 resolution.
+    df = read_frame(
+        f"""
+        SELECT snapshot_date, security_id, {columns}
+        FROM feature_snapshots
+        WHERE snapshot_date BETWEEN :start_date AND :end_date
+        """,
+        {"start_date": pd.to_datetime(start_date).date(), "end_date": pd.to_datetime(end_date).date()},
+        {"snapshot_date": "datetime64[ns]", "security_id": "category", **{name: "float32" for name in factors}},
+    )
+    if df.empty:
+        raise LookupError(f"No feature snapshots between {start_date} and {end_date}.")
+    return panel_from_frame(df, factors)
+
+
+def load_close_panel(start_date: str, end_date: str, horizon: int, source: str = "db") -> pd.DataFrame:
+    # Closes from the first snapshot date to `horizon` trading days past the last one.
+    from market.jobs.calc_features import fetch_price_history
+
+    last = (pd.to_datetime(end_date) + timedelta(days=horizon * 2 + 10)).strftime("%Y%m%d")
+    if source == "matrix":
+        from market.services.price_matrix import PriceMatrix
+
+        return PriceMatrix().frame("close", start_date, last).astype("float64")
+    history = fetch_price_history(last, 0, start_date=start_date, source=source)
+    if history.empty:
+        raise LookupError(f"No prices between {start_date} and {last}.")
+    close = history.pivot(index="trade_date", columns="security_id", values="close").astype("float64")
+    close.columns = close.columns.astype(object)
+    return close
+
+
+def forward_fill(values: np.ndarray) -> np.ndarray:
+    rows = np.where(np.isnan(values), 0, np.arange(values.shape[0])[:, None])
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    return values[rows, np.arange(values.shape[1])]
+
+
+def forward_returns(close: np.ndarray, horizon: int) -> np.ndarray:
+    # Entry needs a print on day t; a security suspended or delisted afterwards is marked at its
+    # last close rather than dropped, so holding it is not silently forgiven.
+    filled = forward_fill(close)
+    result = np.full(close.shape, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        result[:-horizon] = filled[horizon:] / close[:-horizon] - 1.0
+    return result
+
+
+def _sort_groups(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Row-wise sort order, a flat id per run of equal values and a flag for entries that share
+    # their run, so ranks for any subset of a row can be recovered without sorting again.
+    # NaNs sort last, each in its own run.
+    order = np.argsort(values, axis=1)
+    ordered = np.take_along_axis(values, order, axis=1)
+    starts = np.ones(ordered.shape, dtype=bool)
+    starts[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    tied = ~starts
+    tied[:, :-1] |= ~starts[:, 1:]
+    return order, np.cumsum(starts.ravel()).reshape(ordered.shape) - 1, tied
+
+
+def _sorted_ranks(
+    order: np.ndarray, groups: np.ndarray, tied: np.ndarray, mask: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    # 1-based ranks among the masked entries of each row, averaged over ties, laid out in sort
+    # order; also returns the mask in that layout.
+    selected = np.take_along_axis(mask, order, axis=1)
+    ranks = np.cumsum(selected, axis=1, dtype=np.float64)
+    fix = selected & tied
+    if fix.any():
+        # Ids ascend in flat order, so equal ids are contiguous once extracted.
+        ids = groups[fix]
+        starts = np.empty(len(ids), dtype=bool)
+        starts[0] = True
+        starts[1:] = ids[1:] != ids[:-1]
+        runs = np.cumsum(starts) - 1
+        ranks[fix] = (np.bincount(runs, weights=ranks[fix]) / np.bincount(runs))[runs]
+    ranks[~selected] = np.nan
+    return selected, ranks
+
+
+def _unsort(order: np.ndarray, ordered: np.ndarray) -> np.ndarray:
+    values = np.empty(ordered.shape, dtype=ordered.dtype)
+    np.put_along_axis(values, order, ordered, axis=1)
+    return values
+
+
+def rank_ic(factor_ranks: np.ndarray, return_ranks: np.ndarray, mask: np.ndarray) -> np.ndarray:
+    # Pearson correlation of the two rank matrices per row, i.e. Spearman over the joint mask.
+    count = mask.sum(axis=1)
+    center = ((count + 1) / 2.0)[:, None]
+    x = factor_ranks - center
+    x[~mask] = 0.0
+    y = return_ranks - center
+    y[~mask] = 0.0
+    with np.errstate(invalid="ignore", divide="ignore"):
+        ic = np.einsum("ij,ij->i", x, y) / np.sqrt(np.einsum("ij,ij->i", x, x) * np.einsum("ij,ij->i", y, y))
+    ic[count < MIN_NAMES] = np.nan
+    return ic
+
+
+def composite(panel: FactorPanel, weights: Sequence[Tuple[str, float]]) -> np.ndarray:
+    # Same scoring as the screener: weighted mean of clipped cross-sectional z-scores, with a
+    # missing factor dropping out of that security's denominator.
+    total = None
+    weight_sum = None
+    for name, weight in weights:
+        if name not in panel.values:
+            raise KeyError(f"Unknown scoring column {name!r}; available: {', '.join(panel.factors)}")
+        values = panel.values[name]
+        with np.errstate(invalid="ignore", divide="ignore"), warnings.catch_warnings():
+            # All-NaN dates are expected before a factor's warm-up completes.
+            warnings.simplefilter("ignore", RuntimeWarning)
+            mean = np.nanmean(values, axis=1, keepdims=True)
+            std = np.nanstd(values, axis=1, keepdims=True)
+            zscores = np.clip((values - mean) / std, -ZSCORE_CLIP, ZSCORE_CLIP)
+        zscores = np.where(std > 0, zscores, np.where(np.isfinite(values), 0.0, np.nan))
+        present = np.isfinite(zscores)
+        if total is None:
+            total = np.zeros(values.shape)
+            weight_sum = np.zeros(values.shape)
+        total += np.where(present, weight * zscores, 0.0)
+        weight_sum += np.where(present, abs(weight), 0.0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(weight_sum > 0, total / weight_sum, np.nan)
+
+
+def _annualized(returns: np.ndarray) -> float:
+    returns = returns[np.isfinite(returns)]
+    if not len(returns):
+        return float("nan")
+    return float(np.prod(1.0 + returns) ** (TRADING_DAYS / len(returns)) - 1.0)
+
+
+def _max_drawdown(returns: np.ndarray) -> float:
+    equity = np.cumprod(1.0 + np.nan_to_num(returns))
+    if not len(equity):
+        return float("nan")
+    return float((equity / np.maximum.accumulate(equity) - 1.0).min())
+
+
+def evaluate(
+    panel: FactorPanel,
+    close: pd.DataFrame,
+    horizons: Sequence[int] = DEFAULT_HORIZONS,
+    quantiles: int = 5,
+    rebalance: int = 5,
+    cost_bps: float = 0.0,
+    delay: int = 0,
+    weights: Sequence[Tuple[str, float]] = (),
+) -> Evaluation:
+    # Everything runs on whole date x security matrices: one sort per factor and per horizon,
+    # the rest is masking, cumulative sums and bincounts.
+    if quantiles < 2:
+        raise ValueError("Need at least two quantiles.")
+    close = close.sort_index().reindex(columns=panel.securities)
+    dates = close.index
+    rows = dates.get_indexer(panel.dates)
+    if (rows < 0).any():
+        logger.warning("%d snapshot dates have no prices and are skipped.", int((rows < 0).sum()))
+    kept = rows >= 0
+    if not kept.any():
+        raise LookupError("No snapshot date has prices.")
+    first, last = int(rows[kept].min()), int(rows[kept].max())
+    prices = close.to_numpy(dtype=np.float64)
+    tradable = np.isfinite(prices)
+    # Held names earn close-to-close on forward-filled prices, so a suspension books 0% while it
+    # lasts and the full move on resumption instead of dropping out of its bucket.
+    filled = forward_fill(prices)
+    daily = np.full(prices.shape, np.nan)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        daily[:-1] = filled[1:] / filled[:-1] - 1.0
+    forward = {horizon: forward_returns(prices, horizon) for horizon in horizons}
+    forward_sorted = {horizon: _sort_groups(np.where(tradable, values, np.nan)) for horizon, values in forward.items()}
+    has_forward = {horizon: np.isfinite(values).any(axis=1) for horizon, values in forward.items()}
+
+    factors = dict(panel.values)
+    if weights:
+        factors[COMPOSITE] = composite(panel, weights)
+    window = slice(first, last + 1)
+    window_dates = dates[window]
+    # Holdings picked at the close of a rebalance date earn the next day's return onwards.
+    rebalance_rows = np.arange(first, last + 1, max(1, rebalance))
+    holding_row = np.zeros(len(dates), dtype=np.int64)
+    holding_row[rebalance_rows] = rebalance_rows
+    np.maximum.accumulate(holding_row, out=holding_row)
+    labels = list(range(1, quantiles + 1))
+
+    summary: Dict[str, Dict[str, float]] = {}
+    ic_columns: Dict[Tuple[str, int], np.ndarray] = {}
+    quantile_returns: Dict[str, pd.DataFrame] = {}
+    turnover: Dict[str, pd.DataFrame] = {}
+    long_short: Dict[str, np.ndarray] = {}
+    for name, matrix in factors.items():
+        values = np.full(prices.shape, np.nan)
+        values[rows[kept]] = matrix[kept]
+        if delay:
+            values[delay:] = values[:-delay].copy()
+            values[:delay] = np.nan
+        valid = np.isfinite(values) & tradable
+        order, groups, tied = _sort_groups(np.where(valid, values, np.nan))
+        ranks = _unsort(order, _sorted_ranks(order, groups, tied, valid)[1])
+        stats: Dict[str, float] = {}
+        for horizon in horizons:
+            joint = valid & np.isfinite(forward[horizon])
+            # Forward returns exist for every tradable name until the last `horizon` rows, so the
+            # factor's own ranks usually already are its ranks over the joint mask.
+            if np.array_equal(joint, valid & has_forward[horizon][:, None]):
+                factor_ranks = ranks
+            else:
+                factor_ranks = _unsort(order, _sorted_ranks(order, groups, tied, joint)[1])
+            # Correlate in the forward returns' sort order, which saves scattering their ranks back.
+            forward_order = forward_sorted[horizon][0]
+            selected, return_ranks = _sorted_ranks(*forward_sorted[horizon], joint)
+            ic = rank_ic(np.take_along_axis(factor_ranks, forward_order, axis=1), return_ranks, selected)
+            ic = ic[window]
+            ic_columns[(name, horizon)] = ic
+            days = int(np.isfinite(ic).sum())
+            mean = float(np.nanmean(ic)) if days else np.nan
+            std = float(np.nanstd(ic, ddof=1)) if days > 1 else np.nan
+            stats[f"ic_{horizon}d"] = mean
+            stats[f"icir_{horizon}d"] = mean / std * np.sqrt(TRADING_DAYS / horizon) if std > 0 else np.nan
+            # Overlapping h-day returns share information; scale the count down to independent periods.
+            stats[f"ic_t_{horizon}d"] = mean / std * np.sqrt(days / horizon) if std > 0 else np.nan
+
+        # Quantile buckets on each rebalance date, 1 = lowest factor values.
+        count = valid.sum(axis=1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            buckets = np.ceil(ranks * quantiles / count[:, None])
+        buckets = np.where(valid & (count >= max(MIN_NAMES, quantiles))[:, None], buckets, 0).astype(np.int64)
+        buckets = np.clip(buckets, 0, quantiles)
+        held = buckets[holding_row]
+        held[:first] = 0
+        held[last + 1 :] = 0
+
+        # Equal-weighted daily return per bucket via one bincount over (row, bucket).
+        earning = (held > 0) & np.isfinite(daily)
+        keys = (np.arange(len(dates))[:, None] * (quantiles + 1) + held)[earning]
+        size = len(dates) * (quantiles + 1)
+        sums = np.bincount(keys, weights=daily[earning], minlength=size).reshape(len(dates), quantiles + 1)
+        counts = np.bincount(keys, minlength=size).reshape(len(dates), quantiles + 1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            bucket_returns = (sums / counts)[window, 1:]
+        quantile_returns[name] = pd.DataFrame(bucket_returns, index=window_dates, columns=labels)
+
+        # Share of each bucket replaced at every rebalance.
+        picks = buckets[rebalance_rows]
+        stayed = (picks[1:] == picks[:-1]) & (picks[1:] > 0)
+        keep_keys = (np.arange(len(picks) - 1)[:, None] * (quantiles + 1) + picks[1:])[stayed]
+        small = (len(picks) - 1) * (quantiles + 1)
+        kept_counts = np.bincount(keep_keys, minlength=small).reshape(-1, quantiles + 1)
+        pick_keys = (np.arange(len(picks) - 1)[:, None] * (quantiles + 1) + picks[1:])[picks[1:] > 0]
+        totals = np.bincount(pick_keys, minlength=small).reshape(-1, quantiles + 1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            replaced = 1.0 - kept_counts / totals
+        replaced = np.vstack([np.full((1, quantiles + 1), np.nan), replaced])[:, 1:]
+        turnover[name] = pd.DataFrame(replaced, index=dates[rebalance_rows], columns=labels)
+
+        spread = bucket_returns[:, -1] - bucket_returns[:, 0]
+        if cost_bps:
+            # Replacing a fraction f of a leg sells f and buys f of its notional.
+            traded = np.nan_to_num(replaced[:, -1]) + np.nan_to_num(replaced[:, 0])
+            spread = spread.copy()
+            spread[rebalance_rows - first] -= 2.0 * traded * cost_bps / 10_000
+        long_short[name] = spread
+
+        for index, label in enumerate(labels):
+            stats[f"q{label}_ann"] = _annualized(bucket_returns[:, index])
+        stats["long_short_ann"] = _annualized(spread)
+        finite = spread[np.isfinite(spread)]
+        deviation = finite.std(ddof=1) if len(finite) > 1 else 0.0
+        stats["sharpe"] = finite.mean() / deviation * np.sqrt(TRADING_DAYS) if deviation > 0 else np.nan
+        stats["max_drawdown"] = _max_drawdown(spread)
+        stats["turnover"] = float(np.nanmean(replaced[:, [0, -1]])) if len(replaced) > 1 else np.nan
+        stats["days"] = float(len(finite))
+        summary[name] = stats
+
+    ic_frame = pd.DataFrame(ic_columns, index=window_dates)
+    ic_frame.columns = pd.MultiIndex.from_tuples(ic_frame.columns, names=["factor", "horizon"])
+    return Evaluation(
+        summary=pd.DataFrame.from_dict(summary, orient="index"),
+        ic=ic_frame,
+        quantile_returns=quantile_returns,
+        turnover=turnover,
+        long_short=pd.DataFrame(long_short, index=window_dates),
+    )
@@ -0,0 +1,479 @@
+from __future__ import annotations
+
+import logging
+import math
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+logger = logging.getLogger("services.factors")
+
+TRADING_DAYS = 252
+BASE_FACTORS = ("close", "ret_5d", "ret_20d", "vol_ratio_5_20")
+# Securities per computation chunk: bounds the memory of shared intermediates (a few dozen
+# date x chunk arrays). Chunks smaller than MIN_SHARD_SECURITIES are not worth a process.
+CHUNK_SECURITIES = 1_000
+MIN_SHARD_SECURITIES = 500
+BENCHMARK_FACTORS = ("beta_60d", "idio_vol_60d")
+# Rows of windows materialized at once by the exact max-drawdown scan.
+DRAWDOWN_BLOCK_ROWS = 32
+
+
+@dataclass(frozen=True)
+class Factor:
+    name: str
+    lookback: int
+    compute: Callable[["FactorContext"], np.ndarray]
+    description: str = ""
+
+
+FACTORS: Dict[str, Factor] = {}
+
+
+def factor(name: str, lookback: int, description: str = "") -> Callable:
+    # lookback is the number of trading days of history the factor needs for its first value.
+    def register(compute: Callable[["FactorContext"], np.ndarray]) -> Callable[["FactorContext"], np.ndarray]:
+        if name in FACTORS:
+            raise ValueError(f"Factor {name} is already registered.")
+        FACTORS[name] = Factor(name, lookback, compute, description)
+        return compute
+
+    return register
+
+
+def resolve(names: Optional[Iterable[str]] = None) -> List[str]:
+    # None or "base" keeps the original snapshot columns; "all" is every registered factor.
+    if names is None:
+        return list(BASE_FACTORS)
+    if isinstance(names, str):
+        names = [name.strip() for name in names.split(",") if name.strip()]
+    resolved: List[str] = []
+    for name in names:
+        expanded = list(BASE_FACTORS) if name == "base" else list(FACTORS) if name == "all" else [name]
+        for item in expanded:
+            if item not in FACTORS:
+                raise KeyError(f"Unknown factor {item!r}; registered: {', '.join(FACTORS)}")
+            if item not in resolved:
+                resolved.append(item)
+    return resolved
+
+
+def required_lookback(names: Iterable[str]) -> int:
+    return max((FACTORS[name].lookback for name in names), default=1)
+
+
+def _forward_fill(values: np.ndarray) -> np.ndarray:
+    rows = np.where(np.isnan(values), 0, np.arange(values.shape[0])[:, None])
+    np.maximum.accumulate(rows, axis=0, out=rows)
+    # Leading gaps stay NaN: they point at row 0, which is NaN for exactly those securities.
+    return values[rows, np.arange(values.shape[1])]
+
+
+def _simple_returns(filled: np.ndarray) -> np.ndarray:
+    # Same as DataFrame.pct_change() with its default pad fill: gaps count as flat days.
+    returns = np.full(filled.shape, np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        returns[1:] = filled[1:] / filled[:-1] - 1
+    return returns
+
+
+def _prefix_sums(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    valid = np.isfinite(values)
+    return np.cumsum(np.where(valid, values, 0.0), axis=0), np.cumsum(valid, axis=0, dtype=np.int32)
+
+
+def _window_sum(prefix: Tuple[np.ndarray, np.ndarray], window: int) -> np.ndarray:
+    # Windows with any missing value are NaN, matching pandas' default min_periods=window.
+    # Differences of running totals agree with a direct window sum to rounding (about 1e-14
+    # relative for returns), not bit for bit.
+    totals, counts = prefix
+    windowed = totals.copy()
+    windowed[window:] -= totals[:-window]
+    complete = counts >= window
+    complete[window:] = counts[window:] - counts[:-window] >= window
+    windowed[~complete] = np.nan
+    return windowed
+
+
+def _rolling_sum(values: np.ndarray, window: int) -> np.ndarray:
+    return _window_sum(_prefix_sums(values), window)
+
+
+def _rolling_extreme(values: np.ndarray, window: int, function: np.ufunc) -> np.ndarray:
+    # van Herk/Gil-Werman: prefix and suffix running extremes inside blocks of `window` rows
+    # give every window in two lookups, so the cost does not grow with the window length.
+    rows, columns = values.shape
+    result = np.full(values.shape, np.nan)
+    if rows < window:
+        return result
+    blocks = -(-rows // window)
+    fill = -np.inf if function is np.maximum else np.inf
+    padded = np.full((blocks * window, columns), fill)
+    padded[:rows] = values
+    shaped = padded.reshape(blocks, window, columns)
+    prefix = function.accumulate(shaped, axis=1).reshape(-1, columns)
+    suffix = function.accumulate(shaped[:, ::-1], axis=1)[:, ::-1].reshape(-1, columns)
+    result[window - 1 :] = function(suffix[: rows - window + 1], prefix[window - 1 : rows])
+    return result
+
+
+class FactorContext:
+    # Inputs plus a memo of shared intermediates (returns, window sums, moving averages), so
+    # factors that need the same rolling sum or EMA reuse one pass instead of each redoing it.
+
+    def __init__(
+        self,
+        close: np.ndarray,
+        volume: np.ndarray,
+        amount: Optional[np.ndarray] = None,
+        benchmark: Optional[np.ndarray] = None,
+        first_row: int = 0,
+    ) -> None:
+        self.close = np.asarray(close, dtype=np.float64)
+        self.volume = np.asarray(volume, dtype=np.float64)
+        self.amount = np.asarray(amount, dtype=np.float64) if amount is not None else np.full(self.close.shape, np.nan)
+        self.first_row = first_row
+        self._memo: Dict[Hashable, np.ndarray] = {}
+        self._benchmark = benchmark
+
+    def _cached(self, key: Hashable, build: Callable[[], np.ndarray]) -> np.ndarray:
+        if key not in self._memo:
+            self._memo[key] = build()
+        return self._memo[key]
+
+    def series(self, name: str) -> np.ndarray:
+        builders = {
+            "close": lambda: self.close,
+            "volume": lambda: self.volume,
+            "amount": lambda: self.amount,
+            "filled_close": lambda: _forward_fill(self.close),
+            "filled_close_squared": lambda: np.square(self.series("filled_close")),
+            "returns": lambda: _simple_returns(self.series("filled_close")),
+            "returns_squared": lambda: np.square(self.series("returns")),
+            "returns_cubed": lambda: self.series("returns_squared") * self.series("returns"),
+            "downside_squared": lambda: np.minimum(self.series("returns"), 0.0) ** 2,
+            "amount_returns": lambda: self.series("returns") * self.amount,
+            "illiquidity": self._illiquidity,
+            "price_change": lambda: np.diff(self.series("filled_close"), axis=0, prepend=np.nan),
+            "gains": lambda: np.maximum(self.series("price_change"), 0.0),
+            "losses": lambda: np.maximum(-self.series("price_change"), 0.0),
+            "macd": lambda: _ratio(
+                self.ema("filled_close", 2 / 13) - self.ema("filled_close", 2 / 27), self.series("filled_close")
+            ),
+        }
+        return self._cached(("series", name), builders[name])
+
+    def _illiquidity(self) -> np.ndarray:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            values = np.abs(self.series("returns")) / self.amount
+        return np.where(np.isfinite(values), values, np.nan)
+
+    def benchmark(self) -> np.ndarray:
+        # Index returns when given, otherwise the equal-weighted mean return of the universe.
+        if self._benchmark is None:
+            self._benchmark = market_returns(self.close)
+        return self._benchmark
+
+    def rolling_sum(self, name: str, window: int) -> np.ndarray:
+        # One prefix sum per series serves every window length over it.
+        prefix = self._cached(("prefix", name), lambda: _prefix_sums(self.series(name)))
+        return self._cached(("sum", name, window), lambda: _window_sum(prefix, window))
+
+    def rolling_mean(self, name: str, window: int) -> np.ndarray:
+        return self._cached(("mean", name, window), lambda: self.rolling_sum(name, window) / window)
+
+    def rolling_std(self, name: str, window: int) -> np.ndarray:
+        # Sample standard deviation (ddof=1), like pandas' rolling().std().
+        squared = {"returns": "returns_squared", "filled_close": "filled_close_squared"}[name]
+
+        def build() -> np.ndarray:
+            total = self.rolling_sum(name, window)
+            variance = (self.rolling_sum(squared, window) - total**2 / window) / (window - 1)
+            return np.sqrt(np.maximum(variance, 0.0))
+
+        return self._cached(("std", name, window), build)
+
+    def rolling_max(self, name: str, window: int) -> np.ndarray:
+        return self._cached(("max", name, window), lambda: _rolling_extreme(self.series(name), window, np.maximum))
+
+    def ema(self, name: str, alpha: float) -> np.ndarray:
+        # adjust=False recursion seeded by each security's first value; gaps are forward-filled.
+        def build() -> np.ndarray:
+            values = self.series(name)
+            finite = np.isfinite(values)
+            first = finite.argmax(axis=0)
+            leading = np.arange(values.shape[0])[:, None] < first
+            if (~finite & ~leading).any():
+                values = _forward_fill(values)
+            # Leading gaps take the seed value, so the recursion needs no per-row masking.
+            values = np.where(leading, values[first, np.arange(values.shape[1])], values)
+            result = np.empty(values.shape)
+            previous = values[0].copy()
+            for row in range(values.shape[0]):
+                previous *= 1 - alpha
+                previous += alpha * values[row]
+                result[row] = previous
+            result[leading] = np.nan
+            return result
+
+        return self._cached(("ema", name, alpha), build)
+
+    def beta_moments(self, window: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Rolling covariance with the benchmark and both variances, over days where both exist.
+        def build() -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+            returns = self.series("returns")
+            market = np.broadcast_to(self.benchmark()[:, None], returns.shape)
+            valid = np.isfinite(returns) & np.isfinite(market)
+            x = np.where(valid, returns, np.nan)
+            y = np.where(valid, market, np.nan)
+            sums = {
+                key: _rolling_sum(values, window)
+                for key, values in (("x", x), ("y", y), ("xy", x * y), ("xx", x * x), ("yy", y * y))
+            }
+            covariance = (sums["xy"] - sums["x"] * sums["y"] / window) / (window - 1)
+            market_variance = (sums["yy"] - sums["y"] ** 2 / window) / (window - 1)
+            variance = (sums["xx"] - sums["x"] ** 2 / window) / (window - 1)
+            return covariance, market_variance, variance
+
+        return self._cached(("beta", window), build)
+
+
+def market_returns(close: np.ndarray) -> np.ndarray:
+    returns = _simple_returns(_forward_fill(np.asarray(close, dtype=np.float64)))
+    counts = np.isfinite(returns).sum(axis=1)
+    totals = np.nansum(returns, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, totals / np.maximum(counts, 1), np.nan)
+
+
+def _ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values = numerator / denominator
+    return np.where(np.isfinite(values), values, np.nan)
+
+
+@factor("close", 1, "Closing price.")
+def _close(ctx: FactorContext) -> np.ndarray:
+    return ctx.close
+
+
+for _window in (5, 20, 60, 120):
+    factor(f"ret_{_window}d", _window + 1, f"Sum of daily returns over {_window} days.")(
+        lambda ctx, window=_window: ctx.rolling_sum("returns", window)
+    )
+
+
+@factor("mom_120_20", 121, "120-day return excluding the most recent 20 days.")
+def _mom_120_20(ctx: FactorContext) -> np.ndarray:
+    return ctx.rolling_sum("returns", 120) - ctx.rolling_sum("returns", 20)
+
+
+@factor("vol_ratio_5_20", 20, "Average volume over 5 days relative to 20 days.")
+def _vol_ratio_5_20(ctx: FactorContext) -> np.ndarray:
+    return _ratio(ctx.rolling_mean("volume", 5), ctx.rolling_mean("volume", 20))
+
+
+@factor("turnover_mom_5_60", 60, "Average traded amount over 5 days relative to 60 days, minus one.")
+def _turnover_mom_5_60(ctx: FactorContext) -> np.ndarray:
+    return _ratio(ctx.rolling_mean("amount", 5), ctx.rolling_mean("amount", 60)) - 1
+
+
+@factor("amount_20d", 20, "Log of the average daily traded amount over 20 days.")
+def _amount_20d(ctx: FactorContext) -> np.ndarray:
+    mean = ctx.rolling_mean("amount", 20)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(mean > 0, np.log(mean), np.nan)
+
+
+@factor("amihud_20d", 21, "Average absolute return per unit of traded amount over 20 days.")
+def _amihud_20d(ctx: FactorContext) -> np.ndarray:
+    return ctx.rolling_mean("illiquidity", 20)
+
+
+@factor("awret_20d", 21, "Amount-weighted average daily return over 20 days.")
+def _awret_20d(ctx: FactorContext) -> np.ndarray:
+    return _ratio(ctx.rolling_sum("amount_returns", 20), ctx.rolling_sum("amount", 20))
+
+
+for _window in (20, 60):
+    factor(f"realized_vol_{_window}d", _window + 1, f"Annualized volatility of daily returns over {_window} days.")(
+        lambda ctx, window=_window: ctx.rolling_std("returns", window) * math.sqrt(TRADING_DAYS)
+    )
+
+
+@factor("downside_vol_20d", 21, "Annualized root mean square of negative daily returns over 20 days.")
+def _downside_vol_20d(ctx: FactorContext) -> np.ndarray:
+    return np.sqrt(ctx.rolling_mean("downside_squared", 20) * TRADING_DAYS)
+
+
+@factor("skew_20d", 21, "Sample skewness of daily returns over 20 days.")
+def _skew_20d(ctx: FactorContext) -> np.ndarray:
+    window = 20
+    mean = ctx.rolling_mean("returns", window)
+    squares = ctx.rolling_mean("returns_squared", window)
+    second = squares - mean**2
+    third = ctx.rolling_mean("returns_cubed", window) - 3 * mean * squares + 2 * mean**3
+    adjustment = math.sqrt(window * (window - 1)) / (window - 2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        second = np.where(second > 1e-14, second, np.nan)
+        return adjustment * third / (second * np.sqrt(second))
+
+
+@factor("drawdown_60d", 60, "Close relative to the highest close of the last 60 days, minus one.")
+def _drawdown_60d(ctx: FactorContext) -> np.ndarray:
+    return _ratio(ctx.series("filled_close"), ctx.rolling_max("filled_close", 60)) - 1
+
+
+@factor("price_to_high_250d", 250, "Close relative to the highest close of the last 250 days.")
+def _price_to_high_250d(ctx: FactorContext) -> np.ndarray:
+    return _ratio(ctx.series("filled_close"), ctx.rolling_max("filled_close", 250))
+
+
+@factor("max_drawdown_60d", 60, "Largest peak-to-trough decline within the last 60 days.")
+def _max_drawdown_60d(ctx: FactorContext) -> np.ndarray:
+    # Exact path-dependent drawdown, computed only for the requested output rows.
+    # Securities x time so each window is contiguous in memory.
+    window = 60
+    rows = ctx.close.shape[0]
+    result = np.full(ctx.close.shape, np.nan)
+    first = max(ctx.first_row, window - 1)
+    if first >= rows:
+        return result
+    close = np.ascontiguousarray(ctx.series("filled_close")[first - window + 1 :].T)
+    windows = np.lib.stride_tricks.sliding_window_view(close, window, axis=1)
+    for start in range(0, windows.shape[1], DRAWDOWN_BLOCK_ROWS):
+        block = windows[:, start : start + DRAWDOWN_BLOCK_ROWS]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            drawdown = (block / np.maximum.accumulate(block, axis=-1) - 1).min(axis=-1)
+        result[first + start : first + start + block.shape[1]] = drawdown.T
+    return result
+
+
+for _window in (20, 60):
+    factor(f"ma_gap_{_window}d", _window, f"Close relative to its {_window}-day moving average, minus one.")(
+        lambda ctx, window=_window: _ratio(ctx.series("filled_close"), ctx.rolling_mean("filled_close", window)) - 1
+    )
+
+
+@factor("bollinger_z_20d", 20, "Distance of the close from its 20-day mean in 20-day standard deviations.")
+def _bollinger_z_20d(ctx: FactorContext) -> np.ndarray:
+    deviation = ctx.series("filled_close") - ctx.rolling_mean("filled_close", 20)
+    return _ratio(deviation, ctx.rolling_std("filled_close", 20))
+
+
+@factor("rsi_14", 43, "Wilder's 14-day relative strength index.")
+def _rsi_14(ctx: FactorContext) -> np.ndarray:
+    gains = ctx.ema("gains", 1 / 14)
+    losses = ctx.ema("losses", 1 / 14)
+    return _ratio(100 * gains, gains + losses)
+
+
+@factor("macd", 78, "12/26-day EMA difference of the close, as a fraction of the close.")
+def _macd(ctx: FactorContext) -> np.ndarray:
+    return ctx.series("macd")
+
+
+@factor("macd_signal", 105, "9-day EMA of the MACD line.")
+def _macd_signal(ctx: FactorContext) -> np.ndarray:
+    return ctx.ema("macd", 2 / 10)
+
+
+@factor("macd_hist", 105, "MACD line minus its signal line.")
+def _macd_hist(ctx: FactorContext) -> np.ndarray:
+    return ctx.series("macd") - ctx.ema("macd", 2 / 10)
+
+
+@factor("beta_60d", 61, "Beta of daily returns to the benchmark over 60 days.")
+def _beta_60d(ctx: FactorContext) -> np.ndarray:
+    covariance, market_variance, _ = ctx.beta_moments(60)
+    return _ratio(covariance, market_variance)
+
+
+@factor("idio_vol_60d", 61, "Annualized volatility of returns not explained by the 60-day beta.")
+def _idio_vol_60d(ctx: FactorContext) -> np.ndarray:
+    covariance, market_variance, variance = ctx.beta_moments(60)
+    residual = variance - _ratio(covariance**2, market_variance)
+    return np.sqrt(np.maximum(residual, 0.0) * TRADING_DAYS)
+
+
+@factor("corr_price_volume_20d", 21, "Correlation of daily returns with volume over 20 days.")
+def _corr_price_volume_20d(ctx: FactorContext) -> np.ndarray:
+    window = 20
+    returns = ctx.series("returns")
+    volume = ctx.volume
+    valid = np.isfinite(returns) & np.isfinite(volume)
+    x = np.where(valid, returns, np.nan)
+    y = np.where(valid, volume, np.nan)
+    sx, sy, sxy, sxx, syy = (_rolling_sum(values, window) for values in (x, y, x * y, x * x, y * y))
+    covariance = sxy - sx * sy / window
+    spread = np.sqrt(np.maximum(sxx - sx**2 / window, 0.0) * np.maximum(syy - sy**2 / window, 0.0))
+    return _ratio(covariance, spread)
+
+
+def _compute(
+    close: np.ndarray,
+    volume: np.ndarray,
+    amount: Optional[np.ndarray],
+    benchmark: Optional[np.ndarray],
+    names: Sequence[str],
+    first_row: int,
+) -> Dict[str, np.ndarray]:
+    context = FactorContext(close, volume, amount, benchmark, first_row)
+    return {name: np.array(FACTORS[name].compute(context)[first_row:], dtype=np.float64) for name in names}
+
+
+def _compute_shard(arguments: Tuple) -> Dict[str, np.ndarray]:
+    return _compute(*arguments)
+
+
+def compute_panel(
+    close: np.ndarray,
+    volume: np.ndarray,
+    amount: Optional[np.ndarray] = None,
+    names: Optional[Iterable[str]] = None,
+    benchmark: Optional[np.ndarray] = None,
+    first_row: int = 0,
+    workers: int = 1,
+) -> Dict[str, np.ndarray]:
+    # date x security inputs in, one date x security array per factor out (rows from first_row).
+    # Every factor is a per-security time series, so securities are computed in column chunks,
+    # which bounds the memory held by shared intermediates and lets chunks run in processes.
+    # The benchmark is a cross-section and is fixed over the whole universe first.
+    names = resolve(names)
+    close = np.asarray(close, dtype=np.float64)
+    volume = np.asarray(volume, dtype=np.float64)
+    amount = np.asarray(amount, dtype=np.float64) if amount is not None else None
+    rows, securities = close.shape
+    if benchmark is None and any(name in BENCHMARK_FACTORS for name in names):
+        benchmark = market_returns(close)
+    chunks = max(1, -(-securities // CHUNK_SECURITIES), min(max(1, workers), securities // MIN_SHARD_SECURITIES))
+    bounds = np.linspace(0, securities, chunks + 1).astype(int)
+    tasks = [
+        (
+            close[:, low:high],
+            volume[:, low:high],
+            amount[:, low:high] if amount is not None else None,
+            benchmark,
+            names,
+            first_row,
+        )
+        for low, high in zip(bounds[:-1], bounds[1:])
+    ]
+    results = {name: np.empty((max(0, rows - first_row), securities)) for name in names}
+    if workers > 1 and chunks > 1:
+        logger.info(
+            "Computing %d factors for %d securities in %d chunks on %d processes.", len(names), securities, chunks, workers
+        )
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parts = executor.map(_compute_shard, tasks)
+            for low, high, part in zip(bounds[:-1], bounds[1:], parts):
+                for name in names:
+                    results[name][:, low:high] = part[name]
+    else:
+        for low, high, task in zip(bounds[:-1], bounds[1:], tasks):
+            part = _compute(*task)
+            for name in names:
+                results[name][:, low:high] = part[name]
+    return results
@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import logging
+from typing import Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from market.services.db import UpsertResult, bulk_upsert, read_frame
+from market.services.schema import relation_exists
+from market.services.storage import read_raw
+
+logger = logging.getLogger("services.fundamentals")
+
+METRIC_COLUMNS = [
+    "roe",
+    "roa",
+    "q_dtprofit",
+    "q_dtprofit_yoy",
+    "grossprofit_margin",
+    "netprofit_margin",
+    "asset_turn",
+]
+HISTORY_KEY_COLUMNS = ("security_id", "period_end", "ann_date")
+INTERVAL_KEY_COLUMNS = ("security_id", "valid_from")
+INTERVAL_COLUMNS = ["security_id", "valid_from", "valid_to", "period_end", "ann_date", *METRIC_COLUMNS]
+DATE_DTYPES = {column: "datetime64[ns]" for column in ("valid_from", "valid_to", "period_end", "ann_date")}
+# Interval reads are keyed by security; metrics stay float64 because they are stored as features verbatim.
+INTERVAL_DTYPES = {"security_id": "category", **DATE_DTYPES}
+# Latest statutory publication date per fiscal quarter end (CSRC rules), as (month, day, year offset).
+DISCLOSURE_DEADLINES = {3: (4, 30, 0), 6: (8, 31, 0), 9: (10, 31, 0), 12: (4, 30, 1)}
+
+
+def disclosure_deadline(period_end: pd.Series) -> pd.Series:
+    period_end = pd.to_datetime(period_end)
+    deadlines = pd.Series(pd.NaT, index=period_end.index, dtype="datetime64[ns]")
+    for month, (deadline_month, deadline_day, year_offset) in DISCLOSURE_DEADLINES.items():
+        mask = period_end.dt.month == month
+        if mask.any():
+            years = period_end[mask].dt.year + year_offset
+            deadlines[mask] = pd.to_datetime(
+                {"year": years, "month": deadline_month, "day": deadline_day}
+            )
+    return deadlines
+
+
+def known_from(df: pd.DataFrame) -> pd.Series:
+    # Rows loaded before ann_date was tracked fall back to the disclosure deadline, which is
+    # never earlier than the real announcement, so they cannot leak into earlier snapshots.
+    announced = pd.to_datetime(df["ann_date"], errors="coerce") if "ann_date" in df.columns else None
+    fallback = disclosure_deadline(df["period_end"])
+    return fallback if announced is None else announced.fillna(fallback)
+
+
+def build_intervals(history: pd.DataFrame) -> pd.DataFrame:
+    if history.empty:
+        return pd.DataFrame(columns=INTERVAL_COLUMNS)
+    df = history.copy()
+    df["period_end"] = pd.to_datetime(df["period_end"])
+    df["ann_date"] = known_from(df)
+    df = df.dropna(subset=["security_id", "period_end", "ann_date"])
+    df = df.sort_values(["security_id", "ann_date", "period_end"], kind="mergesort")
+    # The known state only changes when a filing is for the newest period seen so far (a new
+    # report or a restatement of it); late restatements of older periods do not replace it.
+    newest = df.groupby("security_id", sort=False)["period_end"].cummax()
+    df = df[df["period_end"] >= newest]
+    df = df.drop_duplicates(["security_id", "ann_date"], keep="last")
+    df = df.rename(columns={"ann_date": "valid_from"})
+    df["ann_date"] = df["valid_from"]
+    df["valid_to"] = df.groupby("security_id", sort=False)["valid_from"].shift(-1)
+    for column in INTERVAL_COLUMNS:
+        if column not in df.columns:
+            df[column] = np.nan
+    return df[INTERVAL_COLUMNS].reset_index(drop=True)
+
+
+def as_of_join(
+    grid: pd.DataFrame,
+    intervals: pd.DataFrame,
+    date_column: str = "snapshot_date",
+    columns: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    columns = columns or ["period_end", *METRIC_COLUMNS]
+    if grid.empty or intervals.empty:
+        result = grid.copy()
+        for column in columns:
+            if column not in result.columns:
+                result[column] = np.nan
+        return result
+    right = intervals[["security_id", "valid_from", *[c for c in columns if c in intervals.columns]]]
+    if right["security_id"].dtype != grid["security_id"].dtype:
+        # merge_asof needs identical key dtypes; intervals read from the database are categorical.
+        right = right.astype({"security_id": grid["security_id"].dtype})
+    right = right.sort_values("valid_from", kind="mergesort")
+    left = grid.copy()
+    left[date_column] = pd.to_datetime(left[date_column])
+    left["_order"] = np.arange(len(left))
+    merged = pd.merge_asof(
+        left.sort_values(date_column, kind="mergesort"),
+        right,
+        left_on=date_column,
+        right_on="valid_from",
+        by="security_id",
+        direction="backward",
+    )
+    return merged.sort_values("_order").drop(columns=["_order", "valid_from"]).reset_index(drop=True)
+
+
+def record_filings(df: pd.DataFrame, connection: Connection) -> UpsertResult:
+    if df.empty:
+        return UpsertResult()
+    if not relation_exists("financial_metrics_history"):
+        logger.warning("financial_metrics_history does not exist; run market-migrate to keep filing history.")
+        return UpsertResult()
+    history = df.copy()
+    history["ann_date"] = known_from(history)
+    history = history.dropna(subset=["ann_date"])
+    result = bulk_upsert(history, "financial_metrics_history", HISTORY_KEY_COLUMNS, connection=connection)
+    refresh_intervals(connection, history["security_id"].unique())
+    return result
+
+
+def refresh_intervals(connection: Connection, securities: Optional[Iterable[str]] = None) -> int:
+    securities = None if securities is None else list(securities)
+    if securities is not None and not securities:
+        return 0
+    if not relation_exists("financial_metrics_pit"):
+        logger.warning("financial_metrics_pit does not exist; run market-migrate to enable point-in-time intervals.")
+        return 0
+    where = "" if securities is None else "WHERE security_id = ANY(:securities)"
+    params = {} if securities is None else {"securities": securities}
+    result = connection.execute(
+        text(f"SELECT security_id, period_end, ann_date, {', '.join(METRIC_COLUMNS)} FROM financial_metrics_history {where}"),
+        params,
+    )
+    intervals = build_intervals(pd.DataFrame(result.fetchall(), columns=result.keys()))
+    connection.execute(text(f"DELETE FROM financial_metrics_pit {where}"), params)
+    bulk_upsert(intervals, "financial_metrics_pit", INTERVAL_KEY_COLUMNS, connection=connection)
+    logger.info(
+        "Rebuilt %d point-in-time intervals for %s securities.",
+        len(intervals),
+        "all" if securities is None else len(securities),
+    )
+    return len(intervals)
+
+
+def load_intervals(end_date: str, source: str = "db") -> pd.DataFrame:
+    end = pd.to_datetime(end_date)
+    if source == "raw":
+        history = read_raw("financials", columns=["security_id", "period_end", "ann_date", *METRIC_COLUMNS])
+        intervals = build_intervals(history)
+        intervals = intervals[intervals["valid_from"] <= end]
+    elif relation_exists("financial_metrics_pit"):
+        intervals = read_frame(
+            f"SELECT {', '.join(INTERVAL_COLUMNS)} FROM financial_metrics_pit WHERE valid_from <= :end",
+            {"end": end},
+            INTERVAL_DTYPES,
+        )
+    else:
+        # Schema without the interval table: derive intervals from the latest-version table.
+        history = read_frame("SELECT * FROM financial_metrics WHERE period_end <= :end", {"end": end}, DATE_DTYPES)
+        intervals = build_intervals(history)
+        intervals = intervals[intervals["valid_from"] <= end]
+    return _coerce(intervals)
+
+
+def financials_as_of(trade_date: str) -> pd.DataFrame:
+    day = pd.to_datetime(trade_date)
+    if not relation_exists("financial_metrics_pit"):
+        intervals = load_intervals(trade_date)
+        current = intervals[intervals["valid_to"].isna() | (intervals["valid_to"] > day)]
+        return current.drop(columns=["valid_from", "valid_to"]).reset_index(drop=True)
+    return _coerce(
+        read_frame(
+            f"""
+            SELECT security_id, period_end, ann_date, {', '.join(METRIC_COLUMNS)}
+            FROM financial_metrics_pit
+            WHERE valid_from <= :day AND (valid_to IS NULL OR valid_to > :day)
+            """,
+            {"day": day},
+            INTERVAL_DTYPES,
+        )
+    )
+
+
+def _coerce(df: pd.DataFrame) -> pd.DataFrame:
+    if df.empty:
+        return df
+    df = df.copy()
+    for column in ("valid_from", "valid_to", "period_end", "ann_date"):
+        if column in df.columns:
+            df[column] = pd.to_datetime(df[column])
+    for column in METRIC_COLUMNS:
+        if column in df.columns:
+            df[column] = pd.to_numeric(df[column], errors="coerce")
+    return df
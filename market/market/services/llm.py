@@ -1,56 +1,441 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import json
-from typing import Dict, List, Optional
+import logging
+import random
+import sqlite3
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 import httpx
 
 from market.config import get_settings
+from market.services import metrics
+from market.services.ratelimit import TokenBucket
+from market.services.tokens import count_message_tokens, count_tokens, pack, split_by_tokens
+
+logger = logging.getLogger("services.llm")
+
+MODEL = "deepseek-chat"
+SYSTEM_PROMPT = "你是证券研报分析助手，请返回JSON，字段包括summary(300字内)、sentiment(-1到1浮点)、risks(数组)、highlights(数组)。"
+TEMPERATURE = 0.2
+BATCH_SYSTEM_PROMPT = (
+    "你是证券研报分析助手。输入是多篇以[编号]开头的文章，请逐篇分析并返回JSON对象"
+    '{"items":[{"id":编号,"summary":"300字内摘要","sentiment":-1到1浮点,"risks":[],"highlights":[]}]}，'
+    "每篇文章恰好一项，id与输入编号一致。"
+)
+REDUCE_SYSTEM_PROMPT = (
+    "你是证券研报分析助手。输入是同一篇长研报各部分的分析结果，请综合全文返回JSON，"
+    "字段包括summary(300字内)、sentiment(-1到1浮点)、risks(数组)、highlights(数组)。"
+)
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+MAX_OUTPUT_TOKENS_ESTIMATE = 600
+# deepseek-chat: 64K context and 8K output tokens. Items up to PACK_ITEM_TOKENS are packed
+# into shared requests; reports above LONG_REPORT_TOKENS are summarized by map-reduce.
+CONTEXT_TOKENS = 64_000
+MAX_OUTPUT_TOKENS = 8_000
+PACK_ITEM_TOKENS = 1_500
+BATCH_INPUT_TOKENS = 6_000
+OUTPUT_TOKENS_PER_ITEM = 400
+BATCH_MAX_ITEMS = MAX_OUTPUT_TOKENS // OUTPUT_TOKENS_PER_ITEM
+LONG_REPORT_TOKENS = 40_000
+MAP_CHUNK_TOKENS = 12_000
+# Prompts behind each way of answering an item; cached answers are keyed by strategy.
+STRATEGY_PROMPTS = {
+    "single": (SYSTEM_PROMPT,),
+    "packed": (BATCH_SYSTEM_PROMPT,),
+    "map_reduce": (SYSTEM_PROMPT, REDUCE_SYSTEM_PROMPT),
+}
 
 
 class LLMUnavailable(RuntimeError):
     pass
 
 
-def summarize_report(content: str) -> Dict[str, Optional[str]]:
+class LLMCache:
+    def __init__(self, path: Path, max_entries: int, max_age_days: int) -> None:
+        self._max_entries = max_entries
+        self._max_age = max_age_days * 86400
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS llm_results (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_results_accessed_at ON llm_results (accessed_at)")
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Optional[str]]]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM llm_results WHERE key = ? AND created_at >= ?", (key, now - self._max_age)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE llm_results SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, key: str, result: Dict[str, Optional[str]]) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_results (key, result, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(result, ensure_ascii=False), now, now),
+            )
+
+    def evict(self) -> int:
+        with self._lock:
+            expired = self._conn.execute(
+                "DELETE FROM llm_results WHERE created_at < ?", (time.time() - self._max_age,)
+            ).rowcount
+            overflow = self._conn.execute(
+                """
+                DELETE FROM llm_results WHERE key IN (
+                    SELECT key FROM llm_results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+                )
+                """,
+                (self._max_entries,),
+            ).rowcount
+        return expired + overflow
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            (entries,) = self._conn.execute("SELECT COUNT(*) FROM llm_results").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+
+@lru_cache(maxsize=1)
+def get_cache() -> LLMCache:
+    settings = get_settings()
+    return LLMCache(
+        settings.data_root / "cache" / "llm_results.sqlite3",
+        max_entries=settings.llm_cache_max_entries,
+        max_age_days=settings.llm_cache_max_age_days,
+    )
+
+
+def cache_key(content: str, strategy: str = "single") -> str:
+    # Model, strategy, prompts and temperature are part of the key so any change to them
+    # naturally invalidates previously cached answers.
+    digest = hashlib.sha256()
+    for part in (MODEL, strategy, *STRATEGY_PROMPTS[strategy], repr(TEMPERATURE), " ".join(content.split())):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def cache_strategies(tokens: int) -> Tuple[str, ...]:
+    # Strategies that may have answered an item of this size, most specific first.
+    if tokens > LONG_REPORT_TOKENS:
+        return ("map_reduce",)
+    if tokens <= PACK_ITEM_TOKENS:
+        return ("single", "packed")
+    return ("single",)
+
+
+async def summarize_report(content: str, use_cache: bool = True) -> Dict[str, Optional[str]]:
+    async with AsyncSummarizer(concurrency=1, use_cache=use_cache) as summarizer:
+        return await summarizer.summarize(content)
+
+
+class AsyncSummarizer:
+    def __init__(
+        self,
+        concurrency: Optional[int] = None,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_retries: int = 5,
+        timeout: float = 60.0,
+        use_cache: bool = True,
+    ) -> None:
+        settings = get_settings()
+        if not settings.llm_endpoint or not settings.llm_api_key:
+            raise LLMUnavailable("LLM_ENDPOINT or LLM_API_KEY not configured.")
+        self._endpoint = settings.llm_endpoint
+        self._concurrency = concurrency or settings.llm_concurrency
+        rpm = requests_per_minute or settings.llm_requests_per_minute
+        tpm = tokens_per_minute or settings.llm_tokens_per_minute
+        self._request_bucket = TokenBucket(rpm) if rpm else None
+        self._token_bucket = TokenBucket(tpm) if tpm else None
+        self._max_retries = max_retries
+        self._timeout = timeout
+        self._cache = get_cache() if use_cache else None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def __aenter__(self) -> "AsyncSummarizer":
+        limits = httpx.Limits(max_connections=self._concurrency, max_keepalive_connections=self._concurrency)
+        self._client = httpx.AsyncClient(timeout=self._timeout, limits=limits)
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+        self._client = None
+
+    async def summarize(self, content: str) -> Dict[str, Optional[str]]:
+        cached = self._cached(content, count_tokens(content))
+        if cached is not None:
+            return cached
+        return await self._summarize_uncached(content)
+
+    def _cached(self, content: str, tokens: int) -> Optional[Dict[str, Optional[str]]]:
+        if self._cache is None:
+            return None
+        for strategy in cache_strategies(tokens):
+            cached = self._cache.get(cache_key(content, strategy))
+            if cached is not None:
+                return cached
+        return None
+
+    async def _summarize_uncached(self, content: str) -> Dict[str, Optional[str]]:
+        if count_tokens(content) > LONG_REPORT_TOKENS:
+            strategy = "map_reduce"
+            result = await self._map_reduce(content)
+        else:
+            strategy = "single"
+            result = _normalize(await self._complete(SYSTEM_PROMPT, content, MAX_OUTPUT_TOKENS_ESTIMATE))
+        if self._cache is not None:
+            self._cache.put(cache_key(content, strategy), result)
+        return result
+
+    async def summarize_packed(self, contents: Sequence[str]) -> List[Dict[str, Optional[str]]]:
+        # One request for several short items; any item the model drops or garbles is
+        # retried on its own, so callers always get one result per input.
+        results: List[Optional[Dict[str, Optional[str]]]] = [None] * len(contents)
+        try:
+            parsed = await self._complete(
+                BATCH_SYSTEM_PROMPT, _batch_prompt(contents), OUTPUT_TOKENS_PER_ITEM * len(contents)
+            )
+            for position, item in _batch_items(parsed, len(contents)).items():
+                results[position] = item
+        except (json.JSONDecodeError, httpx.HTTPError, ValueError) as exc:
+            logger.warning("Packed request for %d items failed (%s); retrying one by one.", len(contents), exc)
+        missing = [position for position, result in enumerate(results) if result is None]
+        if missing and len(missing) < len(contents):
+            logger.warning("Packed response missed %d of %d items; retrying them one by one.", len(missing), len(contents))
+        for position, result in enumerate(results):
+            if result is not None and self._cache is not None:
+                self._cache.put(cache_key(contents[position], "packed"), result)
+        retried = await asyncio.gather(*(self._summarize_uncached(contents[position]) for position in missing))
+        for position, result in zip(missing, retried):
+            results[position] = result
+        return results
+
+    async def summarize_many(self, contents: Sequence[str]) -> List[Optional[Dict[str, Optional[str]]]]:
+        output: List[Optional[Dict[str, Optional[str]]]] = [None] * len(contents)
+        pending: List[int] = []
+        tokens = {index: count_tokens(content) for index, content in enumerate(contents)}
+        for index, content in enumerate(contents):
+            cached = self._cached(content, tokens[index])
+            if cached is not None:
+                output[index] = cached
+            else:
+                pending.append(index)
+        short = [index for index in pending if tokens[index] <= PACK_ITEM_TOKENS]
+        single = [index for index in pending if tokens[index] > PACK_ITEM_TOKENS]
+        batches = [
+            [short[position] for position in batch]
+            for batch in pack([tokens[index] for index in short], BATCH_INPUT_TOKENS, BATCH_MAX_ITEMS)
+        ]
+        single.extend(batch[0] for batch in batches if len(batch) == 1)
+        batches = [batch for batch in batches if len(batch) > 1]
+        logger.info(
+            "LLM plan: %d cached, %d short items in %d packed requests, %d single (%d via map-reduce).",
+            len(contents) - len(pending),
+            sum(len(batch) for batch in batches),
+            len(batches),
+            len(single),
+            sum(1 for index in single if tokens[index] > LONG_REPORT_TOKENS),
+        )
+        groups: List[List[int]] = batches + [[index] for index in single]
+        results = await asyncio.gather(
+            *(
+                self.summarize_packed([contents[index] for index in group])
+                if len(group) > 1
+                else self._summarize_uncached(contents[group[0]])
+                for group in groups
+            ),
+            return_exceptions=True,
+        )
+        for group, result in zip(groups, results):
+            if isinstance(result, BaseException):
+                logger.error("LLM enrichment failed for items %s: %s", group, result)
+                continue
+            for index, item in zip(group, result if len(group) > 1 else [result]):
+                output[index] = item
+        if self._cache is not None:
+            evicted = self._cache.evict()
+            stats = self._cache.stats()
+            logger.info(
+                "LLM cache: %d hits, %d misses, %d entries, %d evicted.",
+                stats["hits"],
+                stats["misses"],
+                stats["entries"],
+                evicted,
+            )
+        return output
+
+    async def _map_reduce(self, content: str) -> Dict[str, Optional[str]]:
+        chunks = split_by_tokens(content, MAP_CHUNK_TOKENS)
+        logger.info("Summarizing a %d-token report in %d chunks.", count_tokens(content), len(chunks))
+        partials = await asyncio.gather(
+            *(self._complete(SYSTEM_PROMPT, chunk, MAX_OUTPUT_TOKENS_ESTIMATE) for chunk in chunks)
+        )
+        combined = "\n\n".join(
+            f"[第{index}部分]\n{json.dumps(_normalize(partial), ensure_ascii=False)}" for index, partial in enumerate(partials, 1)
+        )
+        if count_tokens(combined) > LONG_REPORT_TOKENS:
+            return await self._map_reduce(combined)
+        return _normalize(await self._complete(REDUCE_SYSTEM_PROMPT, combined, MAX_OUTPUT_TOKENS_ESTIMATE))
+
+    async def _complete(self, system_prompt: str, content: str, output_tokens: int) -> Dict[str, Any]:
+        headers, payload = _build_request(content, system_prompt, max_tokens=min(MAX_OUTPUT_TOKENS, output_tokens * 2))
+        async with self._semaphore:
+            if self._request_bucket is not None:
+                await self._request_bucket.acquire_async()
+            if self._token_bucket is not None:
+                await self._token_bucket.acquire_async(count_message_tokens(system_prompt, content) + output_tokens)
+            response = await self._post_with_retry(headers, payload)
+        return _message_json(response.json())
+
+    async def _post_with_retry(self, headers: Dict[str, str], payload: Dict) -> httpx.Response:
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                response = await self._client.post(self._endpoint, headers=headers, json=payload)
+            except httpx.TransportError:
+                metrics.observe("llm", "chat", time.perf_counter() - started, ok=False)
+                if attempt >= self._max_retries:
+                    raise
+                await asyncio.sleep(_backoff(attempt))
+                attempt += 1
+                continue
+            metrics.observe("llm", "chat", time.perf_counter() - started, ok=response.status_code < 400)
+            if response.status_code in RETRY_STATUS_CODES and attempt < self._max_retries:
+                await asyncio.sleep(_retry_after(response) or _backoff(attempt))
+                attempt += 1
+                continue
+            response.raise_for_status()
+            return response
+
+
+async def summarize_reports(
+    contents: Sequence[str], concurrency: Optional[int] = None, use_cache: bool = True
+) -> List[Optional[Dict[str, Optional[str]]]]:
+    # Coroutines only: callers that already run an event loop await these, and jobs drive them
+    # with asyncio.run.
+    async with AsyncSummarizer(concurrency=concurrency, use_cache=use_cache) as summarizer:
+        return await summarizer.summarize_many(contents)
+
+
+def _build_request(
+    content: str, system_prompt: str = SYSTEM_PROMPT, max_tokens: Optional[int] = None
+) -> Tuple[Dict[str, str], Dict]:
     settings = get_settings()
     if not settings.llm_endpoint or not settings.llm_api_key:
         raise LLMUnavailable("LLM_ENDPOINT or LLM_API_KEY not configured.")
     payload = {
-        "model": "deepseek-chat",
+        "model": MODEL,
         "messages": [
-            {
-                "role": "system",
-                "content": "你是证券研报分析助手，请返回JSON，字段包括summary(300字内)、sentiment(-1到1浮点)、risks(数组)、highlights(数组)。"
-            },
+            {"role": "system", "content": system_prompt},
             {"role": "user", "content": content},
         ],
-        "temperature": 0.2,
+        "temperature": TEMPERATURE,
         "response_format": {"type": "json_object"},
     }
+    if max_tokens:
+        payload["max_tokens"] = max_tokens
     headers = {
         "Authorization": f"Bearer {settings.llm_api_key}",
         "Content-Type": "application/json",
     }
-    with httpx.Client(timeout=60.0) as client:
-        response = client.post(settings.llm_endpoint, headers=headers, json=payload)
-        response.raise_for_status()
-    data = response.json()
+    return headers, payload
+
+
+def _batch_prompt(contents: Sequence[str]) -> str:
+    return "\n\n".join(f"[{index}]\n{content.strip()}" for index, content in enumerate(contents, 1))
+
+
+def _batch_items(parsed: Dict[str, Any], expected: int) -> Dict[int, Dict[str, Optional[str]]]:
+    items = parsed.get("items")
+    if not isinstance(items, list):
+        raise ValueError("packed response has no items array")
+    results: Dict[int, Dict[str, Optional[str]]] = {}
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get("summary"), str):
+            continue
+        try:
+            position = int(item.get("id")) - 1
+        except (TypeError, ValueError):
+            continue
+        if 0 <= position < expected and position not in results:
+            results[position] = _normalize(item)
+    return results
+
+
+def _message_json(data: Dict) -> Dict[str, Any]:
     message = data.get("choices", [{}])[0].get("message", {})
-    content_raw = message.get("content", "{}")
-    parsed = json.loads(content_raw)
+    parsed = json.loads(message.get("content") or "{}")
+    if not isinstance(parsed, dict):
+        raise ValueError("LLM response is not a JSON object")
+    return parsed
+
+
+def _normalize(parsed: Dict[str, Any]) -> Dict[str, Optional[str]]:
     return {
         "summary": parsed.get("summary"),
-        "sentiment": parsed.get("sentiment"),
+        "sentiment": _as_sentiment(parsed.get("sentiment")),
         "risks": _as_list(parsed.get("risks")),
         "highlights": _as_list(parsed.get("highlights")),
     }
 
 
+def _backoff(attempt: int, base: float = 1.0, cap: float = 30.0) -> float:
+    return min(cap, base * 2**attempt) * random.uniform(0.5, 1.5)
+
+
+def _retry_after(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _as_sentiment(value) -> Optional[float]:
+    try:
+        sentiment = float(value)
+    except (TypeError, ValueError):
+        return None
+    if sentiment != sentiment:
+        return None
+    return max(-1.0, min(1.0, sentiment))
+
+
 def _as_list(value) -> List[str]:
     if not value:
         return []
     if isinstance(value, list):
         return [str(item) for item in value]
     return [str(value)]
-
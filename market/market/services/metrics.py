@@ -0,0 +1,412 @@
+from __future__ import annotations
+
+import argparse
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from market.config import get_settings
+
+logger = logging.getLogger("services.metrics")
+
+LATENCY_BUCKETS_MS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+PROFILE_MODES = ("cprofile", "sample")
+PROFILE_WHOLE_RUN = "run"
+SAMPLE_INTERVAL_SECONDS = 0.005
+PROFILE_TOP_ENTRIES = 40
+RUN_LOG_HEADER = "| Date       | Script                     | Status  | Notes |\r\n|------------|---------------------------|---------|-------|\r\n"
+
+
+def peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux and bytes on macOS.
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+@dataclass
+class StageStats:
+    calls: int = 0
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    rows: int = 0
+    peak_rss_mb: Optional[float] = None
+    peak_rss_growth_mb: float = 0.0
+    errors: int = 0
+
+    def as_dict(self) -> Dict:
+        rows_per_second = self.rows / self.wall_seconds if self.rows and self.wall_seconds else None
+        return {
+            "calls": self.calls,
+            "wall_seconds": round(self.wall_seconds, 3),
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            "rows": self.rows,
+            "rows_per_second": round(rows_per_second, 1) if rows_per_second else None,
+            "peak_rss_mb": round(self.peak_rss_mb, 1) if self.peak_rss_mb is not None else None,
+            "peak_rss_growth_mb": round(self.peak_rss_growth_mb, 1),
+            "errors": self.errors,
+        }
+
+
+class LatencyHistogram:
+    def __init__(self) -> None:
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, milliseconds: float, ok: bool = True) -> None:
+        position = next((index for index, bound in enumerate(LATENCY_BUCKETS_MS) if milliseconds <= bound), len(LATENCY_BUCKETS_MS))
+        self.buckets[position] += 1
+        self.count += 1
+        self.total_ms += milliseconds
+        self.max_ms = max(self.max_ms, milliseconds)
+        if not ok:
+            self.errors += 1
+
+    def quantile(self, q: float) -> Optional[float]:
+        # Upper bound of the bucket holding the q-th observation; the overflow bucket reports max.
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for position, count in enumerate(self.buckets):
+            seen += count
+            if seen >= target and count:
+                return float(LATENCY_BUCKETS_MS[position]) if position < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def as_dict(self) -> Dict:
+        labels = [f"le_{bound}" for bound in LATENCY_BUCKETS_MS] + ["overflow"]
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_ms": round(self.total_ms / self.count, 1) if self.count else None,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "max_ms": round(self.max_ms, 1),
+            "buckets": dict(zip(labels, self.buckets)),
+        }
+
+
+class StageHandle:
+    def __init__(self, rows: Optional[int] = None) -> None:
+        self.rows = rows
+
+
+class Sampler:
+    # Wall-clock sampling profiler: snapshots thread stacks every interval, so it also sees
+    # worker threads and time spent blocked on I/O, which cProfile attributes poorly.
+
+    def __init__(self, thread_id: Optional[int] = None, interval: float = SAMPLE_INTERVAL_SECONDS) -> None:
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="metrics-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            names.update({thread.ident: thread.name for thread in threading.enumerate()})
+            for ident, frame in sys._current_frames().items():
+                if ident == own or (self.thread_id is not None and ident != self.thread_id):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{frame.f_code.co_name} ({Path(frame.f_code.co_filename).name}:{frame.f_code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join([names.get(ident, str(ident)), *reversed(stack)])] += 1
+            self.samples += 1
+
+    def write(self, base: Path) -> List[Path]:
+        folded = base.with_suffix(".folded")
+        folded.write_text("".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()), encoding="utf-8")
+        own: Counter = Counter()
+        inclusive: Counter = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")[1:]
+            if frames:
+                own[frames[-1]] += count
+            for frame in set(frames):
+                inclusive[frame] += count
+        lines = [f"{self.samples} samples every {self.interval * 1000:.0f} ms", "", "self samples:"]
+        lines += [f"{count:8d}  {frame}" for frame, count in own.most_common(PROFILE_TOP_ENTRIES)]
+        lines += ["", "inclusive samples:"]
+        lines += [f"{count:8d}  {frame}" for frame, count in inclusive.most_common(PROFILE_TOP_ENTRIES)]
+        report = base.with_suffix(".txt")
+        report.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        return [folded, report]
+
+
+class RunMetrics:
+    def __init__(self, job: str, profile: Optional[str] = None, profile_mode: str = "cprofile") -> None:
+        self.job = job
+        self.profile = profile
+        self.profile_mode = profile_mode
+        self.started_at = datetime.now()
+        self._started = time.perf_counter()
+        self._started_cpu = time.process_time()
+        self._lock = threading.Lock()
+        self._profile_lock = threading.Lock()
+        self.stages: Dict[str, StageStats] = {}
+        self.calls: Dict[str, LatencyHistogram] = {}
+        self._profiler: Optional[cProfile.Profile] = None
+        self._profile_stats: Optional[pstats.Stats] = None
+        self._sampler: Optional[Sampler] = None
+
+    @contextmanager
+    def stage(self, name: str, rows: Optional[int] = None) -> Iterator[StageHandle]:
+        # CPU time is process-wide, so stages running concurrently in other threads overlap.
+        handle = StageHandle(rows)
+        rss_before = peak_rss_mb()
+        profiling = self.profile == name and self._profile_lock.acquire(blocking=False)
+        if profiling:
+            self._start_profile(threading.get_ident())
+        started = time.perf_counter()
+        started_cpu = time.process_time()
+        failed = False
+        try:
+            yield handle
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            wall = time.perf_counter() - started
+            cpu = time.process_time() - started_cpu
+            if profiling:
+                self._stop_profile()
+                self._profile_lock.release()
+            rss_after = peak_rss_mb()
+            with self._lock:
+                stats = self.stages.setdefault(name, StageStats())
+                stats.calls += 1
+                stats.wall_seconds += wall
+                stats.cpu_seconds += cpu
+                stats.rows += int(handle.rows or 0)
+                stats.errors += int(failed)
+                if rss_after is not None:
+                    stats.peak_rss_mb = max(stats.peak_rss_mb or 0.0, rss_after)
+                    stats.peak_rss_growth_mb += rss_after - (rss_before or rss_after)
+
+    def observe(self, service: str, endpoint: str, seconds: float, ok: bool = True) -> None:
+        with self._lock:
+            self.calls.setdefault(f"{service}.{endpoint}", LatencyHistogram()).observe(seconds * 1000, ok)
+
+    def _start_profile(self, thread_id: Optional[int]) -> None:
+        if self.profile_mode == "sample":
+            sampler = Sampler(thread_id)
+            if self._sampler is not None:
+                # Repeated calls of the profiled stage add to the same stack counts.
+                sampler.stacks, sampler.samples = self._sampler.stacks, self._sampler.samples
+            self._sampler = sampler
+            sampler.start()
+            return
+        # cProfile only follows the thread that enables it.
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+
+    def _stop_profile(self) -> None:
+        if self._sampler is not None:
+            self._sampler.stop()
+            return
+        if self._profiler is None:
+            return
+        self._profiler.disable()
+        if self._profile_stats is None:
+            self._profile_stats = pstats.Stats(self._profiler)
+        else:
+            self._profile_stats.add(self._profiler)
+        self._profiler = None
+
+    def as_dict(self, status: str) -> Dict:
+        with self._lock:
+            stages = {name: stats.as_dict() for name, stats in sorted(self.stages.items(), key=lambda item: -item[1].wall_seconds)}
+            calls = {name: histogram.as_dict() for name, histogram in sorted(self.calls.items())}
+        return {
+            "job": self.job,
+            "status": status,
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "wall_seconds": round(time.perf_counter() - self._started, 3),
+            "cpu_seconds": round(time.process_time() - self._started_cpu, 3),
+            "peak_rss_mb": round(peak_rss_mb(), 1) if resource is not None else None,
+            "stages": stages,
+            "external_calls": calls,
+            "profile": {"target": self.profile, "mode": self.profile_mode} if self.profile else None,
+        }
+
+    def write_profile(self, base: Path) -> List[Path]:
+        if self._sampler is not None:
+            return self._sampler.write(base)
+        if self._profile_stats is None:
+            return []
+        path = base.with_suffix(".prof")
+        self._profile_stats.dump_stats(str(path))
+        report = io.StringIO()
+        pstats.Stats(str(path), stream=report).sort_stats("cumulative").print_stats(PROFILE_TOP_ENTRIES)
+        text_path = base.with_suffix(".txt")
+        text_path.write_text(report.getvalue(), encoding="utf-8")
+        return [path, text_path]
+
+
+_current = RunMetrics("process")
+
+
+def current() -> RunMetrics:
+    return _current
+
+
+def stage(name: str, rows: Optional[int] = None):
+    return _current.stage(name, rows)
+
+
+def observe(service: str, endpoint: str, seconds: float, ok: bool = True) -> None:
+    _current.observe(service, endpoint, seconds, ok)
+
+
+def metrics_dir() -> Path:
+    return get_settings().data_root / "metrics"
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=PROFILE_WHOLE_RUN,
+        metavar="STAGE",
+        help="Profile one stage by name (see the metrics summary), or the whole run when no stage is given.",
+    )
+    parser.add_argument(
+        "--profile-mode",
+        choices=PROFILE_MODES,
+        default="cprofile",
+        help="cProfile (deterministic, one thread) or a wall-clock stack sampler (all threads).",
+    )
+
+
+@contextmanager
+def track_run(job: str, profile: Optional[str] = None, profile_mode: str = "cprofile") -> Iterator[RunMetrics]:
+    global _current
+    run = RunMetrics(job, profile, profile_mode)
+    previous, _current = _current, run
+    whole_run = profile == PROFILE_WHOLE_RUN
+    if whole_run:
+        run._start_profile(None if profile_mode == "sample" else threading.get_ident())
+    status = "ok"
+    try:
+        yield run
+    except SystemExit as exc:
+        status = "ok" if exc.code in (None, 0) else "failed"
+        raise
+    except BaseException:
+        status = "failed"
+        raise
+    finally:
+        if whole_run:
+            run._stop_profile()
+        _current = previous
+        try:
+            finish(run, status)
+        except Exception as exc:  # noqa: BLE001
+            logger.warning("Could not write run metrics for %s: %s", job, exc)
+
+
+def finish(run: RunMetrics, status: str) -> Path:
+    report = run.as_dict(status)
+    directory = metrics_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    base = directory / f"{run.job}_{run.started_at.strftime('%Y%m%dT%H%M%S')}_{os.getpid()}"
+    profile_files = run.write_profile(base.with_name(base.name + "_profile"))
+    if profile_files:
+        report["profile"]["files"] = [str(path) for path in profile_files]
+    path = base.with_suffix(".json")
+    path.write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+    log_summary(report)
+    append_run_log(report, path)
+    return path
+
+
+def log_summary(report: Dict) -> None:
+    logger.info(
+        "%s %s in %.1fs wall, %.1fs CPU, peak RSS %s MB.",
+        report["job"],
+        report["status"],
+        report["wall_seconds"],
+        report["cpu_seconds"],
+        report["peak_rss_mb"],
+    )
+    for name, stats in report["stages"].items():
+        logger.info(
+            "  %-36s %5d calls %9.2fs wall %9.2fs cpu %10d rows %10s rows/s",
+            name,
+            stats["calls"],
+            stats["wall_seconds"],
+            stats["cpu_seconds"],
+            stats["rows"],
+            stats["rows_per_second"] or "-",
+        )
+    for name, histogram in report["external_calls"].items():
+        logger.info(
+            "  %-36s %5d calls %5d errors  p50<=%sms p95<=%sms max %.0fms",
+            name,
+            histogram["count"],
+            histogram["errors"],
+            histogram["p50_ms"],
+            histogram["p95_ms"],
+            histogram["max_ms"],
+        )
+
+
+def _run_log_notes(report: Dict, path: Path) -> str:
+    notes = [f"{report['wall_seconds']:.1f}s wall", f"{report['cpu_seconds']:.1f}s CPU"]
+    if report["peak_rss_mb"] is not None:
+        notes.append(f"peak RSS {report['peak_rss_mb']:.0f} MB")
+    slowest = list(report["stages"].items())[:3]
+    if slowest:
+        notes.append("slowest: " + ", ".join(f"{name} {stats['wall_seconds']:.1f}s" for name, stats in slowest))
+    for name, histogram in report["external_calls"].items():
+        notes.append(f"{name} {histogram['count']} calls p95<={histogram['p95_ms']}ms")
+    notes.append(f"metrics: {path.name}")
+    return "; ".join(notes).replace("|", "/")
+
+
+def append_run_log(report: Dict, path: Path) -> None:
+    run_log = get_settings().run_log_path
+    run_log.parent.mkdir(parents=True, exist_ok=True)
+    existing = ""
+    if run_log.exists():
+        with run_log.open(encoding="utf-8", newline="") as handle:
+            existing = handle.read()
+    # Trailing blank lines would end the Markdown table, so rows go straight after the last one.
+    content = existing.rstrip("\r\n") + "\r\n" if existing.strip() else RUN_LOG_HEADER
+    row = f"| {report['started_at'][:10]} | {report['job']} | {report['status']} | {_run_log_notes(report, path)} |\r\n"
+    with run_log.open("w", encoding="utf-8", newline="") as handle:
+        handle.write(content + row)
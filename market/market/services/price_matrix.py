@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import bisect
+import json
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from market.config import get_settings
+
+FIELDS = ("close", "volume", "amount")
+INITIAL_DATE_CAPACITY = 512
+INITIAL_SECURITY_CAPACITY = 6144
+
+
+def matrix_root() -> Path:
+    return get_settings().data_root / "matrix"
+
+
+class PriceMatrix:
+    # Dense float32 date x security matrices stored as raw memory-mapped files. Rows are
+    # trade dates in ascending order, columns follow the persisted security dictionary.
+
+    def __init__(self, root: Optional[Path] = None, writable: bool = False) -> None:
+        self.root = root or matrix_root()
+        self.writable = writable
+        meta_path = self.root / "meta.json"
+        if not meta_path.exists():
+            if not writable:
+                raise FileNotFoundError(f"No price matrix at {self.root}; run fetch_daily first.")
+            self.root.mkdir(parents=True, exist_ok=True)
+            self.dates: List[str] = []
+            self.securities: List[str] = []
+            self._date_capacity = INITIAL_DATE_CAPACITY
+            self._security_capacity = INITIAL_SECURITY_CAPACITY
+            self._arrays = {field: self._create(field, self._date_capacity, self._security_capacity) for field in FIELDS}
+            self._write_meta()
+        else:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+            self.dates = meta["dates"]
+            self.securities = meta["securities"]
+            self._date_capacity = meta["date_capacity"]
+            self._security_capacity = meta["security_capacity"]
+            self._arrays = {field: self._open(field) for field in FIELDS}
+        self._positions: Dict[str, int] = {security: index for index, security in enumerate(self.securities)}
+
+    @staticmethod
+    def exists(root: Optional[Path] = None) -> bool:
+        return ((root or matrix_root()) / "meta.json").exists()
+
+    def append(self, trade_date: str, df: pd.DataFrame) -> None:
+        if not self.writable:
+            raise PermissionError("PriceMatrix opened read-only.")
+        df = df.dropna(subset=["security_id"]).drop_duplicates("security_id", keep="last")
+        self._ensure_securities(df["security_id"])
+        row = self._row_for(trade_date)
+        columns = np.fromiter((self._positions[security] for security in df["security_id"]), dtype=np.int64, count=len(df))
+        for field in FIELDS:
+            values = np.full(self._security_capacity, np.nan, dtype=np.float32)
+            if field in df.columns:
+                values[columns] = pd.to_numeric(df[field], errors="coerce").to_numpy(dtype=np.float32)
+            self._arrays[field][row] = values
+            self._arrays[field].flush()
+        self._write_meta()
+
+    def date_range(self, start: Optional[str] = None, end: Optional[str] = None) -> Tuple[int, int]:
+        first = bisect.bisect_left(self.dates, start) if start else 0
+        last = bisect.bisect_right(self.dates, end) if end else len(self.dates)
+        return first, last
+
+    def slice(self, field: str, start: Optional[str] = None, end: Optional[str] = None) -> np.ndarray:
+        first, last = self.date_range(start, end)
+        return self._arrays[field][first:last, : len(self.securities)]
+
+    def window(self, field: str, end: str, length: int) -> np.ndarray:
+        _, last = self.date_range(None, end)
+        return self._arrays[field][max(0, last - length) : last, : len(self.securities)]
+
+    def frame(self, field: str, start: Optional[str] = None, end: Optional[str] = None) -> pd.DataFrame:
+        first, last = self.date_range(start, end)
+        index = pd.to_datetime(self.dates[first:last], format="%Y%m%d")
+        return pd.DataFrame(self.slice(field, start, end), index=index, columns=self.securities, copy=False)
+
+    def _path(self, field: str) -> Path:
+        return self.root / f"{field}.f32"
+
+    def _open(self, field: str) -> np.memmap:
+        mode = "r+" if self.writable else "r"
+        return np.memmap(self._path(field), dtype=np.float32, mode=mode, shape=(self._date_capacity, self._security_capacity))
+
+    def _create(self, field: str, date_capacity: int, security_capacity: int, source: Optional[np.ndarray] = None) -> np.memmap:
+        tmp_path = self._path(field).with_suffix(".f32.tmp")
+        array = np.memmap(tmp_path, dtype=np.float32, mode="w+", shape=(date_capacity, security_capacity))
+        array[:] = np.nan
+        if source is not None:
+            array[: source.shape[0], : source.shape[1]] = source
+        array.flush()
+        del array
+        os.replace(tmp_path, self._path(field))
+        return np.memmap(self._path(field), dtype=np.float32, mode="r+", shape=(date_capacity, security_capacity))
+
+    def _grow(self, date_capacity: int, security_capacity: int) -> None:
+        rows = len(self.dates)
+        for field in FIELDS:
+            existing = np.array(self._arrays[field][:rows, : self._security_capacity])
+            self._arrays[field] = self._create(field, date_capacity, security_capacity, existing)
+        self._date_capacity = date_capacity
+        self._security_capacity = security_capacity
+
+    def _ensure_securities(self, security_ids: Iterable[str]) -> None:
+        new_ids = [security for security in pd.unique(pd.Series(list(security_ids))) if security not in self._positions]
+        if not new_ids:
+            return
+        needed = len(self.securities) + len(new_ids)
+        if needed > self._security_capacity:
+            capacity = self._security_capacity
+            while capacity < needed:
+                capacity *= 2
+            self._grow(self._date_capacity, capacity)
+        for security in new_ids:
+            self._positions[security] = len(self.securities)
+            self.securities.append(security)
+
+    def _row_for(self, trade_date: str) -> int:
+        position = bisect.bisect_left(self.dates, trade_date)
+        if position < len(self.dates) and self.dates[position] == trade_date:
+            return position
+        if len(self.dates) + 1 > self._date_capacity:
+            self._grow(self._date_capacity * 2, self._security_capacity)
+        rows = len(self.dates)
+        if position < rows:
+            # Out-of-order dates (e.g. a late backfill) shift later rows down by one.
+            for field in FIELDS:
+                array = self._arrays[field]
+                array[position + 1 : rows + 1] = np.array(array[position:rows])
+        self.dates.insert(position, trade_date)
+        return position
+
+    def _write_meta(self) -> None:
+        meta = {
+            "dates": self.dates,
+            "securities": self.securities,
+            "date_capacity": self._date_capacity,
+            "security_capacity": self._security_capacity,
+        }
+        tmp_path = self.root / "meta.json.tmp"
+        tmp_path.write_text(json.dumps(meta), encoding="utf-8")
+        os.replace(tmp_path, self.root / "meta.json")
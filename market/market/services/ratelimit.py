@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None) -> None:
+        if rate_per_minute <= 0:
+            raise ValueError("rate_per_minute must be positive.")
+        self._rate = rate_per_minute / 60.0
+        self._capacity = float(capacity if capacity is not None else rate_per_minute)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, amount: float) -> float:
+        # Callers take tokens immediately and sleep off any debt outside the lock, so
+        # threads and coroutines sharing a bucket are served in arrival order.
+        amount = min(float(amount), self._capacity)
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+            self._updated = now
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self._rate
+
+    def acquire(self, amount: float = 1.0) -> None:
+        wait = self._reserve(amount)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, amount: float = 1.0) -> None:
+        wait = self._reserve(amount)
+        if wait > 0:
+            await asyncio.sleep(wait)
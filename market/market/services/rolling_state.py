@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+from market.config import get_settings
+
+HISTORY = 20
+WINDOWS = (5, 20)
+FEATURE_COLUMNS = ["close", "ret_5d", "ret_20d", "vol_ratio_5_20"]
+_ARRAY_FIELDS = (
+    "close",
+    "last_close",
+    "last_seen",
+    "returns",
+    "volumes",
+    "ret_sum",
+    "ret_valid",
+    "vol_sum",
+    "vol_valid",
+)
+
+
+def state_path() -> Path:
+    return get_settings().data_root / "state" / "price_features.npz"
+
+
+class RollingPriceState:
+    # Per-security ring buffers of the last HISTORY returns and volumes plus running
+    # window sums, mirroring the pivot/pct_change/rolling pipeline in calc_features.
+
+    def __init__(self, lookback_days: int) -> None:
+        self.lookback_days = lookback_days
+        self.last_date: Optional[pd.Timestamp] = None
+        self.position = 0
+        self.securities = pd.Index([], dtype="object")
+        self.close = np.empty(0)
+        self.last_close = np.empty(0)
+        self.last_seen = np.empty(0, dtype="datetime64[ns]")
+        self.returns = np.empty((0, HISTORY))
+        self.volumes = np.empty((0, HISTORY))
+        self.ret_sum = np.empty((len(WINDOWS), 0))
+        self.ret_valid = np.empty((len(WINDOWS), 0), dtype=np.int32)
+        self.vol_sum = np.empty((len(WINDOWS), 0))
+        self.vol_valid = np.empty((len(WINDOWS), 0), dtype=np.int32)
+
+    @classmethod
+    def from_history(cls, df: pd.DataFrame, until: pd.Timestamp, lookback_days: int) -> "RollingPriceState":
+        state = cls(lookback_days)
+        if df.empty:
+            return state
+        history = df[df["trade_date"] <= until]
+        if history.empty:
+            return state
+        close = history.pivot(index="trade_date", columns="security_id", values="close").astype("float64")
+        volume = history.pivot(index="trade_date", columns="security_id", values="volume").astype("float64")
+        volume = volume.reindex(index=close.index, columns=close.columns)
+        state._add_securities(close.columns)
+        close_values = close.to_numpy()
+        volume_values = volume.to_numpy()
+        for row, trade_date in enumerate(close.index):
+            state._apply(trade_date, close_values[row], volume_values[row], prune=False)
+        state._prune(state.last_date - pd.Timedelta(days=lookback_days))
+        return state
+
+    def update(self, trade_date: pd.Timestamp, day: pd.DataFrame) -> None:
+        day = day.dropna(subset=["security_id"]).drop_duplicates("security_id", keep="last")
+        self._add_securities(day["security_id"])
+        positions = self.securities.get_indexer(day["security_id"])
+        close = np.full(len(self.securities), np.nan)
+        volume = np.full(len(self.securities), np.nan)
+        close[positions] = pd.to_numeric(day["close"], errors="coerce").to_numpy(dtype="float64")
+        volume[positions] = pd.to_numeric(day["volume"], errors="coerce").to_numpy(dtype="float64")
+        self._apply(pd.Timestamp(trade_date), close, volume)
+
+    def features(self) -> pd.DataFrame:
+        columns = {
+            "security_id": self.securities.to_numpy(),
+            "close": self.close,
+        }
+        for k, window in enumerate(WINDOWS):
+            columns[f"ret_{window}d"] = np.where(self.ret_valid[k] == window, self.ret_sum[k], np.nan)
+        mean_short = np.where(self.vol_valid[0] == WINDOWS[0], self.vol_sum[0] / WINDOWS[0], np.nan)
+        mean_long = np.where(self.vol_valid[1] == WINDOWS[1], self.vol_sum[1] / WINDOWS[1], np.nan)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = mean_short / mean_long
+        columns["vol_ratio_5_20"] = np.where(np.isfinite(ratio), ratio, np.nan)
+        features = pd.DataFrame(columns)
+        return features.dropna(subset=FEATURE_COLUMNS, how="all").reset_index(drop=True)
+
+    def save(self, path: Optional[Path] = None) -> Path:
+        path = path or state_path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp.npz")
+        arrays = {name: getattr(self, name) for name in _ARRAY_FIELDS}
+        np.savez(
+            tmp_path,
+            securities=self.securities.to_numpy(dtype="str"),
+            last_date=np.array([self.last_date], dtype="datetime64[ns]"),
+            position=np.array([self.position]),
+            lookback_days=np.array([self.lookback_days]),
+            **arrays,
+        )
+        os.replace(tmp_path, path)
+        return path
+
+    @classmethod
+    def load(cls, path: Optional[Path] = None) -> Optional["RollingPriceState"]:
+        path = path or state_path()
+        if not path.exists():
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            state = cls(int(data["lookback_days"][0]))
+            state.securities = pd.Index(data["securities"].astype("object"))
+            state.last_date = pd.Timestamp(data["last_date"][0])
+            state.position = int(data["position"][0])
+            for name in _ARRAY_FIELDS:
+                setattr(state, name, data[name])
+        return state
+
+    def _add_securities(self, security_ids: Iterable[str]) -> None:
+        # Plain object ids even when the caller read security_id as a categorical.
+        new_ids = pd.Index(security_ids, dtype=object).difference(self.securities)
+        if new_ids.empty:
+            return
+        count = len(new_ids)
+        self.securities = self.securities.append(new_ids)
+        self.close = np.concatenate([self.close, np.full(count, np.nan)])
+        self.last_close = np.concatenate([self.last_close, np.full(count, np.nan)])
+        self.last_seen = np.concatenate([self.last_seen, np.full(count, np.datetime64("NaT"), dtype="datetime64[ns]")])
+        self.returns = np.vstack([self.returns, np.full((count, HISTORY), np.nan)])
+        self.volumes = np.vstack([self.volumes, np.full((count, HISTORY), np.nan)])
+        self.ret_sum = np.hstack([self.ret_sum, np.zeros((len(WINDOWS), count))])
+        self.ret_valid = np.hstack([self.ret_valid, np.zeros((len(WINDOWS), count), dtype=np.int32)])
+        self.vol_sum = np.hstack([self.vol_sum, np.zeros((len(WINDOWS), count))])
+        self.vol_valid = np.hstack([self.vol_valid, np.zeros((len(WINDOWS), count), dtype=np.int32)])
+
+    def _apply(self, trade_date: pd.Timestamp, close: np.ndarray, volume: np.ndarray, prune: bool = True) -> None:
+        present = ~np.isnan(close)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            # pct_change pads missing closes, so an absent security contributes a zero return.
+            returns = np.where(present, close / self.last_close - 1.0, np.where(np.isnan(self.last_close), np.nan, 0.0))
+        self._push(self.returns, self.ret_sum, self.ret_valid, returns)
+        self._push(self.volumes, self.vol_sum, self.vol_valid, volume)
+        self.position = (self.position + 1) % HISTORY
+        self.last_close = np.where(present, close, self.last_close)
+        self.close = close
+        self.last_seen[present] = np.datetime64(trade_date, "ns")
+        self.last_date = trade_date
+        if prune:
+            self._prune(trade_date - pd.Timedelta(days=self.lookback_days))
+
+    def _push(self, buffer: np.ndarray, sums: np.ndarray, valid: np.ndarray, values: np.ndarray) -> None:
+        incoming_valid = np.isfinite(values)
+        incoming = np.where(incoming_valid, values, 0.0)
+        for k, window in enumerate(WINDOWS):
+            leaving = buffer[:, (self.position - window) % HISTORY]
+            leaving_valid = np.isfinite(leaving)
+            sums[k] += incoming - np.where(leaving_valid, leaving, 0.0)
+            valid[k] += incoming_valid.astype(np.int32) - leaving_valid.astype(np.int32)
+        buffer[:, self.position] = values
+
+    def _prune(self, cutoff: pd.Timestamp) -> None:
+        keep = self.last_seen >= np.datetime64(cutoff, "ns")
+        if keep.all():
+            return
+        self.securities = self.securities[keep]
+        for name in ("close", "last_close", "last_seen", "returns", "volumes"):
+            setattr(self, name, getattr(self, name)[keep])
+        for name in ("ret_sum", "ret_valid", "vol_sum", "vol_valid"):
+            setattr(self, name, getattr(self, name)[:, keep])
+
+
+def max_feature_difference(expected: pd.DataFrame, actual: pd.DataFrame) -> float:
+    merged = expected.merge(actual, on="security_id", how="outer", suffixes=("_expected", "_actual"))
+    worst = 0.0
+    for column in FEATURE_COLUMNS:
+        left = merged[f"{column}_expected"].to_numpy(dtype="float64")
+        right = merged[f"{column}_actual"].to_numpy(dtype="float64")
+        if not np.array_equal(np.isnan(left), np.isnan(right)):
+            return float("inf")
+        both = ~np.isnan(left)
+        if both.any():
+            worst = max(worst, float(np.max(np.abs(left[both] - right[both]))))
+    return worst
@@ -0,0 +1,477 @@
+from __future__ import annotations
+
+import logging
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+from market.services.db import get_engine
+
+logger = logging.getLogger("services.schema")
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    statements: Tuple[str, ...]
+    requires_extension: Optional[str] = None
+
+
+MIGRATIONS: Tuple[Migration, ...] = (
+    Migration(
+        1,
+        "core tables",
+        (
+            """
+            CREATE TABLE IF NOT EXISTS daily_prices (
+                security_id TEXT NOT NULL,
+                trade_date DATE NOT NULL,
+                open DOUBLE PRECISION,
+                high DOUBLE PRECISION,
+                low DOUBLE PRECISION,
+                close DOUBLE PRECISION,
+                volume DOUBLE PRECISION,
+                amount DOUBLE PRECISION,
+                PRIMARY KEY (security_id, trade_date)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS daily_prices_trade_date_idx ON daily_prices (trade_date, security_id)",
+            """
+            CREATE TABLE IF NOT EXISTS financial_metrics (
+                security_id TEXT NOT NULL,
+                period_end DATE NOT NULL,
+                roe DOUBLE PRECISION,
+                roa DOUBLE PRECISION,
+                q_dtprofit DOUBLE PRECISION,
+                q_dtprofit_yoy DOUBLE PRECISION,
+                grossprofit_margin DOUBLE PRECISION,
+                netprofit_margin DOUBLE PRECISION,
+                asset_turn DOUBLE PRECISION,
+                PRIMARY KEY (security_id, period_end)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS financial_metrics_period_end_idx ON financial_metrics (period_end)",
+            """
+            CREATE TABLE IF NOT EXISTS news (
+                news_id TEXT NOT NULL,
+                publish_time TIMESTAMP NOT NULL,
+                title TEXT,
+                body TEXT,
+                source_url TEXT,
+                channels TEXT,
+                security_id TEXT,
+                summary TEXT,
+                sentiment DOUBLE PRECISION,
+                risk_tags TEXT,
+                highlights TEXT,
+                PRIMARY KEY (news_id, publish_time)
+            )
+            """,
+            "DROP INDEX IF EXISTS news_news_id_key",
+            "CREATE INDEX IF NOT EXISTS news_security_publish_idx ON news (security_id, publish_time DESC)",
+            """
+            CREATE TABLE IF NOT EXISTS feature_snapshots (
+                security_id TEXT NOT NULL,
+                snapshot_date DATE NOT NULL,
+                close DOUBLE PRECISION,
+                ret_5d DOUBLE PRECISION,
+                ret_20d DOUBLE PRECISION,
+                vol_ratio_5_20 DOUBLE PRECISION,
+                period_end DATE,
+                roe DOUBLE PRECISION,
+                netprofit_margin DOUBLE PRECISION,
+                grossprofit_margin DOUBLE PRECISION,
+                asset_turn DOUBLE PRECISION,
+                sentiment_30d DOUBLE PRECISION,
+                PRIMARY KEY (security_id, snapshot_date)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS feature_snapshots_date_idx ON feature_snapshots (snapshot_date)",
+            """
+            CREATE TABLE IF NOT EXISTS job_checkpoints (
+                job TEXT NOT NULL,
+                key TEXT NOT NULL,
+                rows BIGINT NOT NULL DEFAULT 0,
+                completed_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (job, key)
+            )
+            """,
+        ),
+    ),
+    Migration(
+        2,
+        "timescale hypertables and compression",
+        (
+            "CREATE EXTENSION IF NOT EXISTS timescaledb",
+            """
+            SELECT create_hypertable('daily_prices', 'trade_date',
+                chunk_time_interval => INTERVAL '1 year', if_not_exists => TRUE, migrate_data => TRUE)
+            """,
+            """
+            ALTER TABLE daily_prices SET (
+                timescaledb.compress,
+                timescaledb.compress_segmentby = 'security_id',
+                timescaledb.compress_orderby = 'trade_date DESC'
+            )
+            """,
+            "SELECT add_compression_policy('daily_prices', INTERVAL '180 days', if_not_exists => TRUE)",
+            """
+            SELECT create_hypertable('news', 'publish_time',
+                chunk_time_interval => INTERVAL '1 month', if_not_exists => TRUE, migrate_data => TRUE)
+            """,
+            """
+            ALTER TABLE news SET (
+                timescaledb.compress,
+                timescaledb.compress_segmentby = 'security_id',
+                timescaledb.compress_orderby = 'publish_time DESC'
+            )
+            """,
+            "SELECT add_compression_policy('news', INTERVAL '90 days', if_not_exists => TRUE)",
+        ),
+        requires_extension="timescaledb",
+    ),
+    Migration(
+        3,
+        "continuous aggregates",
+        (
+            """
+            CREATE MATERIALIZED VIEW IF NOT EXISTS daily_prices_weekly
+            WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+            SELECT security_id,
+                   time_bucket(INTERVAL '1 week', trade_date) AS bucket,
+                   first(open, trade_date) AS open,
+                   max(high) AS high,
+                   min(low) AS low,
+                   last(close, trade_date) AS close,
+                   sum(volume) AS volume,
+                   sum(amount) AS amount
+            FROM daily_prices
+            GROUP BY security_id, bucket
+            WITH NO DATA
+            """,
+            """
+            SELECT add_continuous_aggregate_policy('daily_prices_weekly',
+                start_offset => INTERVAL '1 month', end_offset => INTERVAL '1 day',
+                schedule_interval => INTERVAL '1 hour', if_not_exists => TRUE)
+            """,
+            """
+            CREATE MATERIALIZED VIEW IF NOT EXISTS daily_prices_monthly
+            WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+            SELECT security_id,
+                   time_bucket(INTERVAL '1 month', trade_date) AS bucket,
+                   first(open, trade_date) AS open,
+                   max(high) AS high,
+                   min(low) AS low,
+                   last(close, trade_date) AS close,
+                   sum(volume) AS volume,
+                   sum(amount) AS amount
+            FROM daily_prices
+            GROUP BY security_id, bucket
+            WITH NO DATA
+            """,
+            """
+            SELECT add_continuous_aggregate_policy('daily_prices_monthly',
+                start_offset => INTERVAL '3 months', end_offset => INTERVAL '1 day',
+                schedule_interval => INTERVAL '1 day', if_not_exists => TRUE)
+            """,
+            """
+            CREATE MATERIALIZED VIEW IF NOT EXISTS news_sentiment_daily
+            WITH (timescaledb.continuous, timescaledb.materialized_only = false) AS
+            SELECT security_id,
+                   time_bucket(INTERVAL '1 day', publish_time) AS day,
+                   count(*) AS news_count,
+                   count(sentiment) AS sentiment_count,
+                   sum(sentiment) AS sentiment_sum
+            FROM news
+            GROUP BY security_id, day
+            WITH NO DATA
+            """,
+            """
+            SELECT add_continuous_aggregate_policy('news_sentiment_daily',
+                start_offset => INTERVAL '7 days', end_offset => INTERVAL '1 hour',
+                schedule_interval => INTERVAL '30 minutes', if_not_exists => TRUE)
+            """,
+        ),
+        requires_extension="timescaledb",
+    ),
+    Migration(
+        4,
+        "financial announcement dates and checkpoint values",
+        (
+            "ALTER TABLE financial_metrics ADD COLUMN IF NOT EXISTS ann_date DATE",
+            "CREATE INDEX IF NOT EXISTS financial_metrics_ann_date_idx ON financial_metrics (ann_date)",
+            "ALTER TABLE job_checkpoints ADD COLUMN IF NOT EXISTS value TEXT",
+        ),
+    ),
+    Migration(
+        5,
+        "point-in-time financial metrics",
+        (
+            """
+            CREATE TABLE IF NOT EXISTS financial_metrics_history (
+                security_id TEXT NOT NULL,
+                period_end DATE NOT NULL,
+                ann_date DATE NOT NULL,
+                roe DOUBLE PRECISION,
+                roa DOUBLE PRECISION,
+                q_dtprofit DOUBLE PRECISION,
+                q_dtprofit_yoy DOUBLE PRECISION,
+                grossprofit_margin DOUBLE PRECISION,
+                netprofit_margin DOUBLE PRECISION,
+                asset_turn DOUBLE PRECISION,
+                PRIMARY KEY (security_id, period_end, ann_date)
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS financial_metrics_pit (
+                security_id TEXT NOT NULL,
+                valid_from DATE NOT NULL,
+                valid_to DATE,
+                period_end DATE NOT NULL,
+                ann_date DATE NOT NULL,
+                roe DOUBLE PRECISION,
+                roa DOUBLE PRECISION,
+                q_dtprofit DOUBLE PRECISION,
+                q_dtprofit_yoy DOUBLE PRECISION,
+                grossprofit_margin DOUBLE PRECISION,
+                netprofit_margin DOUBLE PRECISION,
+                asset_turn DOUBLE PRECISION,
+                PRIMARY KEY (security_id, valid_from)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS financial_metrics_pit_valid_idx ON financial_metrics_pit (valid_from, valid_to)",
+            # Rows without an announcement date are assumed known at the statutory deadline.
+            """
+            INSERT INTO financial_metrics_history
+            SELECT security_id, period_end,
+                   COALESCE(ann_date, CASE EXTRACT(MONTH FROM period_end)
+                       WHEN 3 THEN make_date(EXTRACT(YEAR FROM period_end)::int, 4, 30)
+                       WHEN 6 THEN make_date(EXTRACT(YEAR FROM period_end)::int, 8, 31)
+                       WHEN 9 THEN make_date(EXTRACT(YEAR FROM period_end)::int, 10, 31)
+                       ELSE make_date(EXTRACT(YEAR FROM period_end)::int + 1, 4, 30)
+                   END),
+                   roe, roa, q_dtprofit, q_dtprofit_yoy, grossprofit_margin, netprofit_margin, asset_turn
+            FROM financial_metrics
+            ON CONFLICT DO NOTHING
+            """,
+            # Same rules as fundamentals.build_intervals: only filings for the newest period seen so
+            # far change the known state, and the last of those announced on a day wins.
+            """
+            INSERT INTO financial_metrics_pit
+            SELECT security_id, ann_date, LEAD(ann_date) OVER (PARTITION BY security_id ORDER BY ann_date),
+                   period_end, ann_date,
+                   roe, roa, q_dtprofit, q_dtprofit_yoy, grossprofit_margin, netprofit_margin, asset_turn
+            FROM (
+                SELECT DISTINCT ON (security_id, ann_date) *
+                FROM (
+                    SELECT history.*, max(period_end) OVER (
+                        PARTITION BY security_id ORDER BY ann_date, period_end ROWS UNBOUNDED PRECEDING
+                    ) AS newest
+                    FROM financial_metrics_history history
+                ) ranked
+                WHERE period_end >= newest
+                ORDER BY security_id, ann_date, period_end DESC
+            ) known
+            ON CONFLICT DO NOTHING
+            """,
+        ),
+    ),
+    Migration(
+        6,
+        "news sentiment rollup",
+        (
+            """
+            CREATE TABLE IF NOT EXISTS news_sentiment_rollup (
+                security_id TEXT NOT NULL,
+                day DATE NOT NULL,
+                news_count INTEGER NOT NULL DEFAULT 0,
+                sentiment_count INTEGER NOT NULL DEFAULT 0,
+                sentiment_sum DOUBLE PRECISION,
+                decay_sum DOUBLE PRECISION,
+                PRIMARY KEY (security_id, day)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS news_sentiment_rollup_day_idx ON news_sentiment_rollup (day)",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS sentiment_7d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS sentiment_90d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS sentiment_decay DOUBLE PRECISION",
+        ),
+    ),
+    Migration(
+        7,
+        "news to security links",
+        (
+            """
+            CREATE TABLE IF NOT EXISTS news_securities (
+                news_id TEXT NOT NULL,
+                publish_time TIMESTAMP NOT NULL,
+                security_id TEXT NOT NULL,
+                relevance DOUBLE PRECISION NOT NULL,
+                mentions INTEGER NOT NULL DEFAULT 1,
+                PRIMARY KEY (news_id, security_id)
+            )
+            """,
+            "CREATE INDEX IF NOT EXISTS news_securities_security_idx ON news_securities (security_id, publish_time DESC)",
+        ),
+    ),
+    Migration(
+        8,
+        "news near-duplicate tracking",
+        (
+            "ALTER TABLE news ADD COLUMN IF NOT EXISTS minhash TEXT",
+            "ALTER TABLE news ADD COLUMN IF NOT EXISTS duplicate_of TEXT",
+            "CREATE INDEX IF NOT EXISTS news_publish_time_idx ON news (publish_time DESC)",
+            "CREATE INDEX IF NOT EXISTS news_duplicate_of_idx ON news (duplicate_of) WHERE duplicate_of IS NOT NULL",
+        ),
+    ),
+    Migration(
+        9,
+        "news embeddings",
+        (
+            "CREATE EXTENSION IF NOT EXISTS vector",
+            # vector(512) must match market.services.embeddings.DIMENSIONS.
+            """
+            CREATE TABLE IF NOT EXISTS news_embeddings (
+                news_id TEXT PRIMARY KEY,
+                publish_time TIMESTAMP NOT NULL,
+                security_id TEXT,
+                model TEXT NOT NULL,
+                embedding vector(512) NOT NULL
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS news_embeddings_hnsw_idx ON news_embeddings
+            USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64)
+            """,
+            "CREATE INDEX IF NOT EXISTS news_embeddings_publish_time_idx ON news_embeddings (publish_time)",
+        ),
+        requires_extension="vector",
+    ),
+    Migration(
+        10,
+        "extended price factors",
+        (
+            # One column per non-base factor in market.services.factors.FACTORS.
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS ret_60d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS ret_120d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS mom_120_20 DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS turnover_mom_5_60 DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS amount_20d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS amihud_20d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS awret_20d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS realized_vol_20d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS realized_vol_60d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS downside_vol_20d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS skew_20d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS drawdown_60d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS price_to_high_250d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS max_drawdown_60d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS ma_gap_20d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS ma_gap_60d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS bollinger_z_20d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS rsi_14 DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS macd DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS macd_signal DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS macd_hist DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS beta_60d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS idio_vol_60d DOUBLE PRECISION",
+            "ALTER TABLE feature_snapshots ADD COLUMN IF NOT EXISTS corr_price_volume_20d DOUBLE PRECISION",
+        ),
+    ),
+    Migration(
+        11,
+        "drop the news_sentiment_daily aggregate",
+        (
+            # news_sentiment_rollup (migration 6) is the one daily sentiment rollup; dropping the
+            # aggregate from migration 3 also removes its refresh policy.
+            "DROP MATERIALIZED VIEW IF EXISTS news_sentiment_daily",
+        ),
+    ),
+    Migration(
+        12,
+        "drop the weekly and monthly price aggregates",
+        (
+            # Nothing reads them: factors and evaluation work on the daily panel.
+            "DROP MATERIALIZED VIEW IF EXISTS daily_prices_weekly",
+            "DROP MATERIALIZED VIEW IF EXISTS daily_prices_monthly",
+        ),
+    ),
+)
+
+
+def _ensure_migrations_table(connection: Connection) -> None:
+    connection.execute(
+        text(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            )
+            """
+        )
+    )
+
+
+def applied_versions(engine: Optional[Engine] = None) -> List[int]:
+    engine = engine or get_engine()
+    with engine.begin() as connection:
+        _ensure_migrations_table(connection)
+        return [row.version for row in connection.execute(text("SELECT version FROM schema_migrations ORDER BY version"))]
+
+
+def pending_migrations(engine: Optional[Engine] = None) -> List[Migration]:
+    applied = set(applied_versions(engine))
+    return [migration for migration in MIGRATIONS if migration.version not in applied]
+
+
+def _extension_available(connection: Connection, name: str) -> bool:
+    return connection.execute(
+        text("SELECT 1 FROM pg_available_extensions WHERE name = :name"), {"name": name}
+    ).first() is not None
+
+
+def migrate(engine: Optional[Engine] = None) -> List[int]:
+    engine = engine or get_engine()
+    applied: List[int] = []
+    for migration in pending_migrations(engine):
+        with engine.begin() as connection:
+            if migration.requires_extension and not _extension_available(connection, migration.requires_extension):
+                # Optional migrations stay pending and are retried once the extension is installed.
+                logger.warning(
+                    "Skipping migration %d (%s): extension %s is not available.",
+                    migration.version,
+                    migration.name,
+                    migration.requires_extension,
+                )
+                continue
+            for statement in migration.statements:
+                connection.execute(text(statement))
+            connection.execute(
+                text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                {"version": migration.version, "name": migration.name},
+            )
+        logger.info("Applied migration %d (%s).", migration.version, migration.name)
+        applied.append(migration.version)
+    relation_exists.cache_clear()
+    column_exists.cache_clear()
+    return applied
+
+
+@lru_cache(maxsize=None)
+def relation_exists(name: str) -> bool:
+    with get_engine().connect() as connection:
+        return connection.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name}).scalar()
+
+
+@lru_cache(maxsize=None)
+def column_exists(table: str, column: str) -> bool:
+    with get_engine().connect() as connection:
+        return connection.execute(
+            text("SELECT 1 FROM information_schema.columns WHERE table_name = :table AND column_name = :column"),
+            {"table": table, "column": column},
+        ).first() is not None
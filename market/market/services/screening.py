@@ -0,0 +1,332 @@
+from __future__ import annotations
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from market.config import get_settings
+from market.services.db import get_engine
+
+logger = logging.getLogger("services.screening")
+
+NON_FACTOR_COLUMNS = ("security_id", "snapshot_date", "period_end")
+OPERATORS = (">", ">=", "<", "<=", "==", "!=", "between", "in", "notnull", "isnull")
+RANK_METHODS = ("zscore", "percentile")
+# Cross-sectional z-scores are clipped so one extreme print cannot dominate a weighted score.
+ZSCORE_CLIP = 3.0
+MAX_SNAPSHOTS = 8
+MAX_RESULTS = 512
+
+
+@dataclass(frozen=True)
+class Screen:
+    # filters: (column, operator, value); "between" takes a (low, high) pair and "in" a tuple.
+    # weights: (column, weight); negative weights favour low values.
+    filters: Tuple[Tuple[str, str, object], ...] = ()
+    weights: Tuple[Tuple[str, float], ...] = ()
+    method: str = "zscore"
+    sort_by: Optional[str] = None
+    ascending: bool = False
+    limit: Optional[int] = 50
+    columns: Optional[Tuple[str, ...]] = None
+
+
+@dataclass(frozen=True)
+class SnapshotFrame:
+    # One snapshot date held column by column; ranks are computed once at load, against the
+    # whole universe, so a screen only has to mask, combine and sort.
+    snapshot_date: pd.Timestamp
+    securities: np.ndarray
+    values: Dict[str, np.ndarray]
+    zscores: Dict[str, np.ndarray]
+    percentiles: Dict[str, np.ndarray]
+
+    @property
+    def factors(self) -> List[str]:
+        return list(self.values)
+
+    def __len__(self) -> int:
+        return len(self.securities)
+
+
+def version_path() -> Path:
+    return get_settings().data_root / "cache" / "feature_snapshots.version"
+
+
+def bump_version() -> str:
+    # Written after every feature_snapshots load; screeners in any process on this host compare
+    # it on each request and drop their caches when it changes.
+    token = f"{time.time_ns()}-{os.getpid()}"
+    path = version_path()
+    tmp_path = path.with_suffix(f".tmp{os.getpid()}")
+    tmp_path.write_text(token, encoding="utf-8")
+    tmp_path.replace(path)
+    return token
+
+
+def current_version() -> Optional[str]:
+    try:
+        return version_path().read_text(encoding="utf-8").strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _cross_section(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    zscores = np.full(values.shape, np.nan)
+    percentiles = np.full(values.shape, np.nan)
+    present = np.isfinite(values)
+    count = int(present.sum())
+    if count == 0:
+        return zscores, percentiles
+    sample = values[present]
+    std = sample.std()
+    zscores[present] = np.clip((sample - sample.mean()) / std, -ZSCORE_CLIP, ZSCORE_CLIP) if std > 0 else 0.0
+    # Average ranks for ties, scaled to (0, 1].
+    percentiles[present] = pd.Series(sample).rank(method="average").to_numpy() / count
+    return zscores, percentiles
+
+
+def build_snapshot(df: pd.DataFrame) -> SnapshotFrame:
+    factors = [
+        column
+        for column in df.columns
+        if column not in NON_FACTOR_COLUMNS and pd.api.types.is_numeric_dtype(df[column])
+    ]
+    values: Dict[str, np.ndarray] = {}
+    zscores: Dict[str, np.ndarray] = {}
+    percentiles: Dict[str, np.ndarray] = {}
+    for column in factors:
+        values[column] = pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=np.float64)
+        zscores[column], percentiles[column] = _cross_section(values[column])
+    snapshot_date = pd.Timestamp(df["snapshot_date"].iloc[0]) if not df.empty else pd.NaT
+    return SnapshotFrame(snapshot_date, df["security_id"].to_numpy(dtype=object), values, zscores, percentiles)
+
+
+def _filter_mask(snapshot: SnapshotFrame, filters: Tuple[Tuple[str, str, object], ...]) -> np.ndarray:
+    mask = np.ones(len(snapshot), dtype=bool)
+    for column, operator, value in filters:
+        if column == "security_id":
+            values = snapshot.securities
+        elif column in snapshot.values:
+            values = snapshot.values[column]
+        else:
+            raise KeyError(f"Unknown screening column {column!r}; available: {', '.join(snapshot.factors)}")
+        if operator == "notnull":
+            mask &= pd.notna(values)
+        elif operator == "isnull":
+            mask &= pd.isna(values)
+        elif operator == "in":
+            mask &= np.isin(values, list(value))
+        elif operator == "between":
+            low, high = value
+            mask &= (values >= low) & (values <= high)
+        elif operator == ">":
+            mask &= values > value
+        elif operator == ">=":
+            mask &= values >= value
+        elif operator == "<":
+            mask &= values < value
+        elif operator == "<=":
+            mask &= values <= value
+        elif operator == "==":
+            mask &= values == value
+        elif operator == "!=":
+            mask &= values != value
+        else:
+            raise ValueError(f"Unknown operator {operator!r}; use one of {', '.join(OPERATORS)}.")
+    return mask
+
+
+def score(snapshot: SnapshotFrame, weights: Tuple[Tuple[str, float], ...], method: str = "zscore") -> np.ndarray:
+    # Weighted mean of the per-factor ranks; a missing factor drops out of that security's
+    # denominator instead of counting as an average value.
+    if method not in RANK_METHODS:
+        raise ValueError(f"Unknown rank method {method!r}; use one of {', '.join(RANK_METHODS)}.")
+    ranks = snapshot.zscores if method == "zscore" else snapshot.percentiles
+    total = np.zeros(len(snapshot))
+    weight_sum = np.zeros(len(snapshot))
+    for column, weight in weights:
+        if column not in ranks:
+            raise KeyError(f"Unknown scoring column {column!r}; available: {', '.join(snapshot.factors)}")
+        rank = ranks[column] if method == "zscore" or weight >= 0 else 1.0 - ranks[column]
+        present = np.isfinite(rank)
+        total[present] += (weight if method == "zscore" else abs(weight)) * rank[present]
+        weight_sum[present] += abs(weight)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(weight_sum > 0, total / weight_sum, np.nan)
+
+
+def run_screen(snapshot: SnapshotFrame, screen: Screen) -> pd.DataFrame:
+    mask = _filter_mask(snapshot, screen.filters)
+    rows = np.flatnonzero(mask)
+    scores = score(snapshot, screen.weights, screen.method)[rows] if screen.weights else None
+    sort_by = screen.sort_by or ("score" if screen.weights else None)
+    if sort_by == "score":
+        if scores is None:
+            raise ValueError("Sorting by score needs at least one weighted column.")
+        keys = scores
+    elif sort_by is not None:
+        if sort_by not in snapshot.values:
+            raise KeyError(f"Unknown sort column {sort_by!r}; available: {', '.join(snapshot.factors)}")
+        keys = snapshot.values[sort_by][rows]
+    else:
+        keys = None
+    if keys is not None:
+        # NaNs sort last in either direction; mergesort keeps universe order for ties.
+        order = np.argsort(keys if screen.ascending else -keys, kind="mergesort")
+        rows = rows[order]
+        if scores is not None:
+            scores = scores[order]
+    ranked = len(rows)
+    if screen.limit is not None:
+        rows = rows[: screen.limit]
+        scores = scores[: screen.limit] if scores is not None else None
+    columns = list(screen.columns) if screen.columns else snapshot.factors
+    result = pd.DataFrame({"security_id": snapshot.securities[rows]})
+    for column in columns:
+        if column not in snapshot.values:
+            raise KeyError(f"Unknown output column {column!r}; available: {', '.join(snapshot.factors)}")
+        result[column] = snapshot.values[column][rows]
+    if screen.weights:
+        ranks = snapshot.zscores if screen.method == "zscore" else snapshot.percentiles
+        suffix = "z" if screen.method == "zscore" else "pct"
+        for column, _ in screen.weights:
+            result[f"{column}_{suffix}"] = ranks[column][rows]
+        result["score"] = scores
+    if keys is not None:
+        result["rank"] = np.arange(1, len(result) + 1)
+    result.attrs["matched"] = ranked
+    result.attrs["snapshot_date"] = snapshot.snapshot_date
+    return result
+
+
+class _LRU:
+    def __init__(self, max_entries: int) -> None:
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[Hashable, object]" = OrderedDict()
+
+    def get(self, key: Hashable):
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: Hashable, value) -> None:
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class Screener:
+    # Read-through caches for snapshots and screen results. Each request costs one read of the
+    # version file; SQL only runs when a date is first requested after a snapshot load.
+
+    def __init__(self, max_snapshots: int = MAX_SNAPSHOTS, max_results: int = MAX_RESULTS) -> None:
+        self._snapshots = _LRU(max_snapshots)
+        self._results = _LRU(max_results)
+        self._latest: Optional[pd.Timestamp] = None
+        self._version: Optional[str] = None
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+
+    def _check_version(self) -> None:
+        version = current_version()
+        if version != self._version:
+            if self._version is not None or len(self._snapshots):
+                logger.info("feature_snapshots changed (version %s); dropping cached screens.", version)
+            self._snapshots.clear()
+            self._results.clear()
+            self._latest = None
+            self._version = version
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._snapshots.clear()
+            self._results.clear()
+            self._latest = None
+
+    def latest_date(self) -> Optional[pd.Timestamp]:
+        with self._lock:
+            self._check_version()
+            if self._latest is None:
+                with get_engine().connect() as connection:
+                    latest = connection.execute(text("SELECT max(snapshot_date) FROM feature_snapshots")).scalar()
+                self._latest = pd.Timestamp(latest) if latest is not None else None
+            return self._latest
+
+    def snapshot(self, snapshot_date=None) -> SnapshotFrame:
+        with self._lock:
+            self._check_version()
+            snapshot_date = pd.Timestamp(snapshot_date).normalize() if snapshot_date is not None else self.latest_date()
+            if snapshot_date is None:
+                raise LookupError("feature_snapshots is empty; run market-calc-features first.")
+            cached = self._snapshots.get(snapshot_date)
+            if cached is not None:
+                return cached
+            started = time.perf_counter()
+            with get_engine().connect() as connection:
+                df = pd.read_sql(
+                    text("SELECT * FROM feature_snapshots WHERE snapshot_date = :date ORDER BY security_id"),
+                    connection,
+                    params={"date": snapshot_date.date()},
+                )
+            if df.empty:
+                raise LookupError(f"No feature snapshot for {snapshot_date:%Y-%m-%d}.")
+            snapshot = build_snapshot(df)
+            self._snapshots.put(snapshot_date, snapshot)
+            self.loads += 1
+            logger.info(
+                "Loaded snapshot %s: %d securities x %d factors in %.0f ms.",
+                f"{snapshot_date:%Y-%m-%d}",
+                len(snapshot),
+                len(snapshot.factors),
+                (time.perf_counter() - started) * 1000,
+            )
+            return snapshot
+
+    def screen(self, screen: Screen, snapshot_date=None) -> pd.DataFrame:
+        with self._lock:
+            snapshot = self.snapshot(snapshot_date)
+            key = (snapshot.snapshot_date, screen)
+            cached = self._results.get(key)
+            if cached is not None:
+                self.hits += 1
+                return cached.copy()
+            self.misses += 1
+            result = run_screen(snapshot, screen)
+            self._results.put(key, result)
+            return result.copy()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "loads": self.loads,
+                "snapshots": len(self._snapshots),
+                "results": len(self._results),
+            }
+
+
+@lru_cache(maxsize=1)
+def get_screener() -> Screener:
+    return Screener()
@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+import logging
+import math
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+from market.services.db import read_frame
+from market.services.schema import column_exists, relation_exists
+
+logger = logging.getLogger("services.sentiment")
+
+SENTIMENT_WINDOWS = (7, 30, 90)
+DECAY_HALF_LIFE_DAYS = 7.0
+DECAY_RATE = math.log(2) / DECAY_HALF_LIFE_DAYS
+ROLLUP_COLUMNS = ["security_id", "day", "news_count", "sentiment_count", "sentiment_sum", "decay_sum"]
+ROLLUP_DTYPES = {
+    "security_id": "category",
+    "day": "datetime64[ns]",
+    "news_count": "int32",
+    "sentiment_count": "int32",
+    "sentiment_sum": "float64",
+    "decay_sum": "float64",
+}
+FEATURE_COLUMNS = [*(f"sentiment_{window}d" for window in SENTIMENT_WINDOWS), "sentiment_decay"]
+
+
+def _canonical_filter() -> str:
+    # Near-duplicates carry a copy of their canonical article's sentiment; counting them again
+    # would weight a story by how often it was reposted. Before migration 8 nothing is marked.
+    return " AND duplicate_of IS NULL" if column_exists("news", "duplicate_of") else ""
+
+
+def daily_rollup(news: pd.DataFrame) -> pd.DataFrame:
+    if "duplicate_of" in news.columns:
+        news = news[news["duplicate_of"].isna()]
+    news = news.dropna(subset=["security_id", "publish_time"])
+    if news.empty:
+        return pd.DataFrame(columns=ROLLUP_COLUMNS)
+    publish_time = pd.to_datetime(news["publish_time"])
+    day = publish_time.dt.normalize()
+    sentiment = pd.to_numeric(news["sentiment"], errors="coerce")
+    # decay_sum is weighted to the end of its day, so days combine with one factor per day.
+    age_days = (day + pd.Timedelta(days=1) - publish_time) / pd.Timedelta(days=1)
+    frame = pd.DataFrame(
+        {
+            "security_id": news["security_id"],
+            "day": day,
+            "sentiment": sentiment,
+            "decayed": sentiment * np.exp(-DECAY_RATE * age_days),
+        }
+    )
+    grouped = frame.groupby(["security_id", "day"])
+    return pd.DataFrame(
+        {
+            "news_count": grouped.size(),
+            "sentiment_count": grouped["sentiment"].count(),
+            "sentiment_sum": grouped["sentiment"].sum(),
+            "decay_sum": grouped["decayed"].sum(),
+        }
+    ).reset_index()
+
+
+def refresh_rollup(connection: Connection, first_day: pd.Timestamp, last_day: pd.Timestamp) -> int:
+    # Recomputing whole touched days keeps the rollup exact when news rows are updated or
+    # replaced; a sync only ever touches a few days, so this reads a handful of chunks.
+    first_day = pd.Timestamp(first_day).normalize()
+    end = pd.Timestamp(last_day).normalize() + pd.Timedelta(days=1)
+    connection.execute(
+        text("DELETE FROM news_sentiment_rollup WHERE day >= :start AND day < :end"),
+        {"start": first_day, "end": end},
+    )
+    result = connection.execute(
+        text(
+            f"""
+            INSERT INTO news_sentiment_rollup (security_id, day, news_count, sentiment_count, sentiment_sum, decay_sum)
+            SELECT security_id,
+                   date_trunc('day', publish_time)::date AS day,
+                   count(*),
+                   count(sentiment),
+                   sum(sentiment),
+                   sum(sentiment * exp(-:rate * extract(epoch FROM
+                       date_trunc('day', publish_time) + INTERVAL '1 day' - publish_time) / 86400.0))
+            FROM news
+            WHERE publish_time >= :start AND publish_time < :end AND security_id IS NOT NULL{_canonical_filter()}
+            GROUP BY 1, 2
+            """
+        ),
+        {"start": first_day, "end": end, "rate": DECAY_RATE},
+    )
+    return result.rowcount
+
+
+def fetch_rollup(first_day: pd.Timestamp, last_day: pd.Timestamp) -> pd.DataFrame:
+    if relation_exists("news_sentiment_rollup"):
+        query = f"""
+            SELECT {', '.join(ROLLUP_COLUMNS)}
+            FROM news_sentiment_rollup
+            WHERE day >= :start AND day < :end
+        """
+        params = {"start": first_day, "end": last_day}
+    else:
+        query = f"""
+            SELECT security_id,
+                   date_trunc('day', publish_time) AS day,
+                   count(*) AS news_count,
+                   count(sentiment) AS sentiment_count,
+                   sum(sentiment) AS sentiment_sum,
+                   sum(sentiment * exp(-:rate * extract(epoch FROM
+                       date_trunc('day', publish_time) + INTERVAL '1 day' - publish_time) / 86400.0)) AS decay_sum
+            FROM news
+            WHERE publish_time >= :start AND publish_time < :end AND security_id IS NOT NULL{_canonical_filter()}
+            GROUP BY 1, 2
+        """
+        params = {"start": first_day, "end": last_day, "rate": DECAY_RATE}
+    return read_frame(query, params, ROLLUP_DTYPES)
+
+
+def rolling_features(daily: pd.DataFrame, start_date: str, end_date: str, windows: Sequence[int] = SENTIMENT_WINDOWS) -> pd.DataFrame:
+    columns = ["snapshot_date", "security_id", *(f"sentiment_{window}d" for window in windows), "sentiment_decay"]
+    daily = daily.dropna(subset=["security_id"])
+    if daily.empty:
+        return pd.DataFrame(columns=columns)
+    daily = daily.assign(day=pd.to_datetime(daily["day"]))
+    start = pd.to_datetime(start_date)
+    calendar = pd.date_range(start - pd.Timedelta(days=max(windows)), pd.to_datetime(end_date), freq="D")
+
+    def pivot(values: str) -> pd.DataFrame:
+        table = daily.pivot_table(index="day", columns="security_id", values=values, aggfunc="sum", observed=True)
+        return table.reindex(calendar).fillna(0.0).astype("float64")
+
+    sums = pivot("sentiment_sum")
+    counts = pivot("sentiment_count").reindex(columns=sums.columns, fill_value=0.0)
+    decayed = pivot("decay_sum").reindex(columns=sums.columns, fill_value=0.0)
+    # Values for day D cover [D - window, D): news published on D is not yet known at D.
+    features = {}
+    for window in windows:
+        window_sum = sums.rolling(window, min_periods=1).sum().shift(1)
+        window_count = counts.rolling(window, min_periods=1).sum().shift(1)
+        features[f"sentiment_{window}d"] = (window_sum / window_count.where(window_count > 0)).loc[start:]
+    # S(D) = S(D-1) * f + x(D-1) with f = exp(-rate), i.e. an adjust=False EWM scaled by 1 / (1 - f).
+    factor = math.exp(-DECAY_RATE)
+    score = decayed.ewm(alpha=1 - factor, adjust=False).mean() / (1 - factor)
+    features["sentiment_decay"] = score.shift(1).where(counts.cumsum().shift(1) > 0).loc[start:]
+    index = features["sentiment_decay"].index
+    panel = pd.DataFrame(
+        {
+            "snapshot_date": np.repeat(index.values, len(sums.columns)),
+            "security_id": np.tile(sums.columns.values, len(index)),
+            **{name: frame.to_numpy().ravel() for name, frame in features.items()},
+        }
+    )
+    return panel.dropna(subset=columns[2:], how="all").reset_index(drop=True)
@@ -1,12 +1,20 @@
 from __future__ import annotations
 
+import hashlib
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
 
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from pandas import DataFrame
 
 from market.config import get_settings
 
+PARTITION_FIELD = "date"
+COMPRESSION = "zstd"
+
 
 def _raw_root() -> Path:
     return get_settings().data_root / "raw"
@@ -18,17 +26,45 @@ def ensure_dir(path: Path) -> Path:
 
 
 def raw_dir(category: str, date_str: str) -> Path:
-    base = _raw_root() / category / date_str
+    base = _raw_root() / category / f"{PARTITION_FIELD}={date_str}"
     return ensure_dir(base)
 
 
-def save_dataframe(df: DataFrame, category: str, date_str: str, filename: str) -> Path:
+def save_dataframe(df: DataFrame, category: str, date_str: str, name: str = "part-0") -> Path:
     directory = raw_dir(category, date_str)
-    path = directory / filename
-    df.to_csv(path, index=False)
+    path = directory / f"{name}.parquet"
+    tmp_path = path.with_suffix(".parquet.tmp")
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_table(table, tmp_path, compression=COMPRESSION)
+    tmp_path.replace(path)
     return path
 
 
+def save_partitioned(df: DataFrame, category: str, date_column: str, name: str = "part-0") -> List[Path]:
+    if df.empty:
+        return []
+    dates = pd.to_datetime(df[date_column]).dt.strftime("%Y%m%d")
+    return [save_dataframe(part, category, date_str, name) for date_str, part in df.groupby(dates, sort=True)]
+
+
+def partition_fingerprint(category: str, date_strs: Iterable[str]) -> Tuple[str, int]:
+    # Content hash and row count of the Parquet files in the given partitions; used to tell
+    # whether a re-run actually changed anything downstream jobs read.
+    digest = hashlib.sha256()
+    rows = 0
+    for date_str in sorted(set(date_strs)):
+        directory = _raw_root() / category / f"{PARTITION_FIELD}={date_str}"
+        if not directory.is_dir():
+            continue
+        for path in sorted(directory.glob("*.parquet")):
+            digest.update(f"{date_str}/{path.name}".encode("utf-8"))
+            with path.open("rb") as handle:
+                for block in iter(lambda: handle.read(1 << 20), b""):
+                    digest.update(block)
+            rows += pq.ParquetFile(path).metadata.num_rows
+    return digest.hexdigest(), rows
+
+
 def save_lines(lines: Iterable[str], category: str, date_str: str, filename: str) -> Path:
     directory = raw_dir(category, date_str)
     path = directory / filename
@@ -37,3 +73,80 @@ def save_lines(lines: Iterable[str], category: str, date_str: str, filename: str
             file_obj.write(line)
     return path
 
+
+def _dataset(category: str) -> Optional[ds.Dataset]:
+    root = _raw_root() / category
+    if not root.exists():
+        return None
+    partitioning = ds.partitioning(pa.schema([(PARTITION_FIELD, pa.string())]), flavor="hive")
+    dataset = ds.dataset(root, format="parquet", partitioning=partitioning, exclude_invalid_files=True)
+    fragments = list(dataset.get_fragments())
+    if not fragments:
+        return None
+    # Partitions written on different days can disagree on all-null columns; unify once up front.
+    schema = pa.unify_schemas([fragment.physical_schema for fragment in fragments] + [partitioning.schema])
+    return ds.dataset(root, format="parquet", partitioning=partitioning, schema=schema, exclude_invalid_files=True)
+
+
+def _expression(start: Optional[str], end: Optional[str], filters: Optional[Sequence]) -> Optional[ds.Expression]:
+    expression = None
+    if start:
+        expression = ds.field(PARTITION_FIELD) >= start
+    if end:
+        upper = ds.field(PARTITION_FIELD) <= end
+        expression = upper if expression is None else expression & upper
+    if filters:
+        extra = pq.filters_to_expression(list(filters))
+        expression = extra if expression is None else expression & extra
+    return expression
+
+
+def read_raw(
+    category: str,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    columns: Optional[Sequence[str]] = None,
+    filters: Optional[Sequence] = None,
+) -> DataFrame:
+    dataset = _dataset(category)
+    if dataset is None:
+        return DataFrame(columns=list(columns) if columns else None)
+    table = dataset.to_table(columns=_present_columns(dataset, columns), filter=_expression(start, end, filters))
+    return _with_columns(table.to_pandas(), columns)
+
+
+def iter_raw_batches(
+    category: str,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    columns: Optional[Sequence[str]] = None,
+    filters: Optional[Sequence] = None,
+    batch_size: int = 65_536,
+) -> Iterator[DataFrame]:
+    dataset = _dataset(category)
+    if dataset is None:
+        return
+    scanner = dataset.scanner(
+        columns=_present_columns(dataset, columns),
+        filter=_expression(start, end, filters),
+        batch_size=batch_size,
+    )
+    for batch in scanner.to_batches():
+        if batch.num_rows:
+            yield _with_columns(batch.to_pandas(), columns)
+
+
+def _present_columns(dataset: ds.Dataset, columns: Optional[Sequence[str]]) -> Optional[List[str]]:
+    if not columns:
+        return None
+    return [column for column in columns if column in dataset.schema.names]
+
+
+def _with_columns(df: DataFrame, columns: Optional[Sequence[str]]) -> DataFrame:
+    # Columns added to a category later are read back as nulls for older partitions.
+    if not columns:
+        return df
+    for column in columns:
+        if column not in df.columns:
+            df[column] = None
+    return df[list(columns)]
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+import math
+import re
+from typing import List, Sequence
+
+# DeepSeek's published rule of thumb: ~0.6 tokens per Chinese character and ~0.3 per
+# English character. Close enough to plan request packing without calling the API.
+CJK_TOKENS_PER_CHAR = 0.6
+OTHER_TOKENS_PER_CHAR = 0.3
+MESSAGE_OVERHEAD_TOKENS = 4
+_CJK = re.compile(r"[　-〿㐀-䶿一-鿿豈-﫿＀-￯]")
+_PARAGRAPH = re.compile(r"\n\s*\n|\n")
+_SENTENCE = re.compile(r"(?<=[。！？；!?;])")
+
+
+def count_tokens(content: str) -> int:
+    if not content:
+        return 0
+    cjk = len(content) - len(_CJK.sub("", content))
+    return math.ceil(cjk * CJK_TOKENS_PER_CHAR + (len(content) - cjk) * OTHER_TOKENS_PER_CHAR)
+
+
+def count_message_tokens(*messages: str) -> int:
+    return sum(count_tokens(message) + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+def split_by_tokens(content: str, max_tokens: int) -> List[str]:
+    # Greedy chunking on paragraph, then sentence boundaries; a single oversized sentence is
+    # cut by characters as a last resort.
+    pieces: List[str] = []
+    for paragraph in _PARAGRAPH.split(content):
+        if not paragraph.strip():
+            continue
+        if count_tokens(paragraph) <= max_tokens:
+            pieces.append(paragraph)
+            continue
+        for sentence in _SENTENCE.split(paragraph):
+            if count_tokens(sentence) <= max_tokens:
+                pieces.append(sentence)
+                continue
+            step = max(1, int(max_tokens / CJK_TOKENS_PER_CHAR))
+            pieces.extend(sentence[offset : offset + step] for offset in range(0, len(sentence), step))
+    chunks: List[str] = []
+    current: List[str] = []
+    current_tokens = 0
+    for piece in pieces:
+        tokens = count_tokens(piece) + 1
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(piece)
+        current_tokens += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def pack(token_counts: Sequence[int], budget: int, max_items: int) -> List[List[int]]:
+    # First-fit decreasing bin packing; returns positions into token_counts per batch.
+    batches: List[List[int]] = []
+    loads: List[int] = []
+    for position in sorted(range(len(token_counts)), key=lambda index: -token_counts[index]):
+        tokens = token_counts[position]
+        for batch, load in enumerate(loads):
+            if load + tokens <= budget and len(batches[batch]) < max_items:
+                batches[batch].append(position)
+                loads[batch] += tokens
+                break
+        else:
+            batches.append([position])
+            loads.append(tokens)
+    return [sorted(batch) for batch in batches]
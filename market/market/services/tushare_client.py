@@ -1,55 +1,184 @@
 from __future__ import annotations
 
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import threading
 import time
-from typing import Optional
+from pathlib import Path
+from typing import Dict, List, Optional
 
 import pandas as pd
 import tushare as ts
 
 from market.config import get_settings
+from market.services import metrics
+from market.services.ratelimit import TokenBucket
+
+logger = logging.getLogger("services.tushare_client")
+
+# Per-minute call limits for a standard 2000-point account; override with TUSHARE_QUOTAS.
+# Every call also draws on one account-wide bucket of TUSHARE_CALLS_PER_MINUTE.
+DEFAULT_QUOTAS = {"daily": 500, "fina_indicator": 200, "news": 60, "trade_cal": 200}
+MINUTE_QUOTA_MARKERS = ("每分钟最多访问", "访问频率")
+FATAL_MARKERS = ("每天最多访问", "每小时最多访问", "权限", "token不对")
+# fina_indicator truncates silently at its per-call row cap, so it is always paged.
+FINA_PAGE_SIZE = 100
+FINA_FIELDS = "ts_code,ann_date,end_date,roe,roa,q_dtprofit,q_dtprofit_yoy,grossprofit_margin,netprofit_margin,asset_turn"
+
+
+class TushareAPIError(RuntimeError):
+    pass
+
+
+_limiters: Dict[str, TokenBucket] = {}
+_account_limiter: Optional[TokenBucket] = None
+_limiters_lock = threading.Lock()
+
+
+def _limiter_for(endpoint: str) -> TokenBucket:
+    # One bucket per endpoint per process so concurrent jobs and workers share the quota.
+    with _limiters_lock:
+        limiter = _limiters.get(endpoint)
+        if limiter is None:
+            settings = get_settings()
+            quota = settings.tushare_quotas.get(endpoint) or DEFAULT_QUOTAS.get(endpoint) or settings.tushare_calls_per_minute
+            limiter = TokenBucket(quota)
+            _limiters[endpoint] = limiter
+        return limiter
+
+
+def _limiter_for_account() -> TokenBucket:
+    # Endpoint quotas can add up to more than the account allows, so all endpoints share this one.
+    global _account_limiter
+    with _limiters_lock:
+        if _account_limiter is None:
+            _account_limiter = TokenBucket(get_settings().tushare_calls_per_minute)
+        return _account_limiter
+
+
+def _classify_error(exc: Exception) -> str:
+    message = str(exc)
+    if any(marker in message for marker in FATAL_MARKERS):
+        return "fatal"
+    if any(marker in message for marker in MINUTE_QUOTA_MARKERS):
+        return "quota"
+    return "transient"
 
 
 class TushareClient:
-    def __init__(self) -> None:
+    def __init__(self, cache_ttl: Optional[float] = None) -> None:
         settings = get_settings()
         self._client = ts.pro_api(settings.tushare_token)
+        self._cache_ttl = cache_ttl if cache_ttl is not None else settings.tushare_cache_ttl_seconds
+        self._cache_root = settings.data_root / "cache" / "tushare"
 
     def daily(self, trade_date: str) -> pd.DataFrame:
-        return self._call_with_retry(
-            lambda: self._client.daily(
-                trade_date=trade_date,
-                fields="ts_code,trade_date,open,high,low,close,vol,amount",
-            )
+        return self.query(
+            "daily",
+            trade_date=trade_date,
+            fields="ts_code,trade_date,open,high,low,close,vol,amount",
         )
 
-    def fina_indicator(self, period: str) -> pd.DataFrame:
-        return self._call_with_retry(
-            lambda: self._client.fina_indicator(
-                period=period,
-                fields="ts_code,end_date,roe,roa,q_dtprofit,q_dtprofit_yoy,grossprofit_margin,netprofit_margin,asset_turn"
-            )
-        )
+    def fina_indicator(self, period: str, page_size: int = FINA_PAGE_SIZE) -> pd.DataFrame:
+        return self.paginate("fina_indicator", page_size, period=period, fields=FINA_FIELDS)
+
+    def fina_indicator_announced(self, start_date: str, end_date: str, page_size: int = FINA_PAGE_SIZE) -> pd.DataFrame:
+        return self.paginate("fina_indicator", page_size, start_date=start_date, end_date=end_date, fields=FINA_FIELDS)
 
     def news(self, start_date: str, end_date: str) -> pd.DataFrame:
-        return self._call_with_retry(
-            lambda: self._client.news(
-                start_date=start_date,
-                end_date=end_date,
-                src="sina"
-            )
+        return self.query("news", start_date=start_date, end_date=end_date, src="sina")
+
+    def stock_basic(self) -> pd.DataFrame:
+        return self.query(
+            "stock_basic",
+            list_status="L",
+            fields="ts_code,symbol,name,fullname,enname,exchange",
+        )
+
+    def name_changes(self, page_size: int = 5000) -> pd.DataFrame:
+        return self.paginate("namechange", page_size, fields="ts_code,name,start_date,end_date")
+
+    def trade_dates(self, start_date: str, end_date: str) -> List[str]:
+        df = self.query(
+            "trade_cal",
+            exchange="SSE",
+            start_date=start_date,
+            end_date=end_date,
+            is_open="1",
+            fields="cal_date",
         )
+        if df.empty:
+            return []
+        return sorted(df["cal_date"].astype(str).tolist())
 
-    @staticmethod
-    def _call_with_retry(func, retry: int = 3, delay: float = 1.0) -> pd.DataFrame:
-        last_error: Optional[Exception] = None
-        for _ in range(retry):
+    def query(self, endpoint: str, **params) -> pd.DataFrame:
+        cache_path = self._cache_path(endpoint, params)
+        if cache_path is not None and self._cache_fresh(cache_path):
+            return pd.read_parquet(cache_path)
+        df = self._call_with_retry(endpoint, lambda: self._client.query(endpoint, **params))
+        if cache_path is not None:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix(".tmp")
+            df.to_parquet(tmp_path, index=False)
+            tmp_path.replace(cache_path)
+        return df
+
+    def paginate(self, endpoint: str, page_size: int, **params) -> pd.DataFrame:
+        pages: List[pd.DataFrame] = []
+        offset = 0
+        while True:
+            page = self.query(endpoint, limit=page_size, offset=offset, **params)
+            if not page.empty:
+                pages.append(page)
+            if len(page) < page_size:
+                break
+            offset += page_size
+        if not pages:
+            return pd.DataFrame()
+        return pd.concat(pages, ignore_index=True)
+
+    async def aquery(self, endpoint: str, **params) -> pd.DataFrame:
+        return await asyncio.to_thread(self.query, endpoint, **params)
+
+    def _cache_path(self, endpoint: str, params: Dict) -> Optional[Path]:
+        if not self._cache_ttl:
+            return None
+        key = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return self._cache_root / endpoint / f"{key}.parquet"
+
+    def _cache_fresh(self, path: Path) -> bool:
+        try:
+            return time.time() - path.stat().st_mtime < self._cache_ttl
+        except FileNotFoundError:
+            return False
+
+    def _call_with_retry(self, endpoint: str, func, retry: int = 5) -> pd.DataFrame:
+        limiter = _limiter_for(endpoint)
+        account = _limiter_for_account()
+        attempt = 0
+        while True:
+            limiter.acquire()
+            account.acquire()
+            started = time.perf_counter()
             try:
                 df = func()
+                metrics.observe("tushare", endpoint, time.perf_counter() - started)
                 return df if df is not None else pd.DataFrame()
             except Exception as exc:  # noqa: BLE001
-                last_error = exc
+                metrics.observe("tushare", endpoint, time.perf_counter() - started, ok=False)
+                kind = _classify_error(exc)
+                if kind == "fatal":
+                    raise TushareAPIError(f"{endpoint}: {exc}") from exc
+                if attempt >= retry - 1:
+                    raise
+                if kind == "quota":
+                    # Per-minute quotas reset on the minute; wait most of a window before retrying.
+                    delay = 30.0 + random.uniform(0, 30.0)
+                else:
+                    delay = min(30.0, 2.0**attempt) * random.uniform(0.5, 1.5)
+                logger.warning("Tushare %s %s error (attempt %d): %s; retrying in %.1fs.", endpoint, kind, attempt + 1, exc, delay)
                 time.sleep(delay)
-        if last_error:
-            raise last_error
-        return pd.DataFrame()
-
+                attempt += 1
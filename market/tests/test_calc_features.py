@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, text
+
+from market.jobs.calc_features import (
+    PRICE_DTYPES,
+    compute_price_feature_panel_from_pivots,
+    compute_price_features,
+    fetch_snapshot_closes,
+    with_exact_close,
+)
+from market.services.db import read_frame
+from market.services.price_matrix import PriceMatrix
+
+
+def _history(dates: int = 30) -> pd.DataFrame:
+    trade_dates = pd.bdate_range("2024-01-02", periods=dates)
+    rows = []
+    for security_id, base in (("600519.SH", 1234.56), ("000001.SZ", 10.07)):
+        for offset, trade_date in enumerate(trade_dates):
+            close = round(base + 0.01 * offset, 2)
+            rows.append((security_id, trade_date.strftime("%Y-%m-%d"), close, 12345.0 + offset, close * 1234.5))
+    return pd.DataFrame(rows, columns=["security_id", "trade_date", "close", "volume", "amount"])
+
+
+def _database(source: pd.DataFrame):
+    engine = create_engine("sqlite://")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE daily_prices (security_id, trade_date, close, volume, amount)"))
+        connection.execute(
+            text("INSERT INTO daily_prices VALUES (:security_id, :trade_date, :close, :volume, :amount)"),
+            source.to_dict("records"),
+        )
+    return engine
+
+
+def test_snapshot_close_keeps_exchange_prices_exact():
+    source = _history()
+    with _database(source).connect() as connection:
+        history = read_frame(
+            "SELECT security_id, trade_date, close, volume, amount FROM daily_prices ORDER BY security_id, trade_date",
+            connection=connection,
+            dtypes=PRICE_DTYPES,
+        )
+    assert history["close"].dtype == np.float64
+    assert history["volume"].dtype == np.float32
+
+    trade_date = history["trade_date"].max().strftime("%Y%m%d")
+    features = compute_price_features(history, trade_date).set_index("security_id")
+
+    expected = source.groupby("security_id")["close"].last()
+    assert features.loc["600519.SH", "close"] == expected["600519.SH"] == 1234.85
+    assert features.loc["000001.SZ", "close"] == expected["000001.SZ"]
+    # ret_20d sums daily returns of about 8e-6 each; float32 closes shift each by up to 1e-7.
+    closes = source[source["security_id"] == "600519.SH"]["close"]
+    expected_ret = closes.pct_change().iloc[-20:].sum()
+    assert features.loc["600519.SH", "ret_20d"] == pytest.approx(expected_ret, abs=1e-12)
+
+
+def test_matrix_snapshots_take_close_from_the_database(tmp_path, monkeypatch):
+    # psycopg2 binds Timestamps as dates; sqlite3 needs an adapter to match the ISO strings.
+    adapter = (pd.Timestamp, sqlite3.PrepareProtocol)
+    monkeypatch.setitem(sqlite3.adapters, adapter, lambda value: value.strftime("%Y-%m-%d"))
+    source = _history()
+    matrix = PriceMatrix(tmp_path, writable=True)
+    for trade_date, day in source.groupby("trade_date"):
+        matrix.append(trade_date.replace("-", ""), day)
+    start, end = "20240205", matrix.dates[-1]
+    close, volume, amount = (matrix.frame(field) for field in ("close", "volume", "amount"))
+    panel = compute_price_feature_panel_from_pivots(close, volume, start, end, amount)
+    # float32 cannot hold 1234.85 exactly.
+    assert not panel["close"].isin(source["close"]).all()
+
+    with _database(source).connect() as connection:
+        closes = fetch_snapshot_closes(start, end, connection)
+    exact = with_exact_close(panel, closes)
+
+    expected = source.assign(snapshot_date=pd.to_datetime(source["trade_date"]))
+    expected = expected.set_index(["snapshot_date", "security_id"])
+    keys = pd.MultiIndex.from_frame(exact[["snapshot_date", "security_id"]])
+    np.testing.assert_array_equal(exact["close"].to_numpy(), expected["close"].reindex(keys).to_numpy())
+    pd.testing.assert_frame_equal(exact.drop(columns="close"), panel.drop(columns="close"))
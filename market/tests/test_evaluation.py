@@ -0,0 +1,75 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from market.services.evaluation import FactorPanel, evaluate
+
+
+def test_suspended_holding_earns_move_on_resumption():
+    dates = pd.bdate_range("2024-01-01", periods=6)
+    securities = pd.Index([f"{code:06d}.SZ" for code in range(20)], dtype=object)
+    close = pd.DataFrame(10.0, index=dates, columns=securities)
+    # The top-ranked name is suspended for two days and resumes 50% higher.
+    close.iloc[2:4, -1] = np.nan
+    close.iloc[4:, -1] = 15.0
+    factor = np.tile(np.arange(20, dtype=np.float64), (5, 1))
+    panel = FactorPanel(dates[:5], securities, {"rank": factor})
+
+    result = evaluate(panel, close, horizons=(1,), quantiles=2, rebalance=10)
+
+    top = result.quantile_returns["rank"][2]
+    assert np.prod(1.0 + top.fillna(0.0)) == pytest.approx(1.05)
+    assert top.iloc[3] == pytest.approx(0.05)
+    assert (result.quantile_returns["rank"][1].fillna(0.0) == 0.0).all()
+
+
+def _market(dates: int = 40, names: int = 45, seed: int = 11):
+    rng = np.random.default_rng(seed)
+    index = pd.bdate_range("2024-01-01", periods=dates)
+    securities = pd.Index([f"{code:06d}.SH" for code in range(names)], dtype=object)
+    close = pd.DataFrame(10.0 * np.exp(np.cumsum(rng.normal(0, 0.02, (dates, names)), axis=0)), index, securities)
+    close.iloc[:8, 0] = np.nan
+    close.iloc[10:14, 3] = np.nan
+    close.iloc[25:, 4] = np.nan
+    # Rounded scores tie often, which exercises the average-rank paths.
+    factor = np.round(rng.normal(size=(dates, names)), 1)
+    factor[rng.random((dates, names)) < 0.05] = np.nan
+    return close, FactorPanel(index[:-5], securities, {"score": factor[:-5]})
+
+
+def test_rank_ic_matches_pandas_rank_correlation():
+    close, panel = _market()
+    result = evaluate(panel, close, horizons=(1, 5), quantiles=4, rebalance=5)
+    prices = close.to_numpy()
+    filled = close.ffill().to_numpy()
+    for horizon in (1, 5):
+        for row, day in enumerate(panel.dates):
+            forward = pd.Series(filled[row + horizon] / prices[row] - 1.0)
+            factor = pd.Series(panel.values["score"][row])
+            joint = factor.notna() & forward.notna()
+            # Spearman with ties: Pearson correlation of average ranks over the joint sample.
+            spearman = factor[joint].rank().corr(forward[joint].rank())
+            expected = spearman if joint.sum() >= 20 else np.nan
+            assert result.ic.loc[day, ("score", horizon)] == pytest.approx(expected, abs=1e-12, nan_ok=True)
+
+
+def test_bucket_returns_match_naive_portfolios():
+    close, panel = _market()
+    quantiles, rebalance = 4, 5
+    result = evaluate(panel, close, horizons=(1,), quantiles=quantiles, rebalance=rebalance)
+    prices = close.to_numpy()
+    filled = close.ffill().to_numpy()
+    expected = pd.DataFrame(np.nan, index=panel.dates, columns=range(1, quantiles + 1))
+    for row in range(len(panel.dates)):
+        picked = row - row % rebalance
+        factor = pd.Series(np.where(np.isfinite(prices[picked]), panel.values["score"][picked], np.nan))
+        ranks = factor.rank(method="average")
+        buckets = np.ceil(ranks * quantiles / factor.notna().sum())
+        daily = pd.Series(filled[row + 1] / filled[row] - 1.0)
+        for label in range(1, quantiles + 1):
+            members = daily[(buckets == label) & daily.notna()]
+            if len(members):
+                expected.loc[panel.dates[row], label] = members.mean()
+    pd.testing.assert_frame_equal(result.quantile_returns["score"], expected, check_names=False, rtol=1e-12)
@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from market.services.factors import FactorContext, _prefix_sums, _rolling_extreme, _window_sum
+
+
+def _values(rows: int = 300, columns: int = 12, seed: int = 3) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    values = rng.normal(0.0, 0.02, (rows, columns))
+    # Leading gaps (late listings), isolated suspensions and a long one.
+    values[:40, 0] = np.nan
+    values[rng.random((rows, columns)) < 0.03] = np.nan
+    values[100:160, 5] = np.nan
+    values[:, 7] = np.nan
+    return values
+
+
+@pytest.mark.parametrize("window", [1, 5, 20, 60])
+def test_window_sum_matches_pandas_rolling_sum(window):
+    values = _values()
+    expected = pd.DataFrame(values).rolling(window).sum().to_numpy()
+    actual = _window_sum(_prefix_sums(values), window)
+    np.testing.assert_array_equal(np.isnan(actual), np.isnan(expected))
+    # Running-total differences are not bit-identical to direct sums, only equal to rounding.
+    np.testing.assert_allclose(actual, expected, rtol=0, atol=1e-14)
+
+
+@pytest.mark.parametrize("window", [1, 3, 20, 250, 301])
+@pytest.mark.parametrize("function", [np.maximum, np.minimum])
+def test_rolling_extreme_matches_pandas(window, function):
+    values = 10.0 + np.cumsum(_values(), axis=0)
+    rolling = pd.DataFrame(values).rolling(window)
+    expected = (rolling.max() if function is np.maximum else rolling.min()).to_numpy()
+    np.testing.assert_array_equal(_rolling_extreme(values, window, function), expected)
+
+
+@pytest.mark.parametrize("alpha", [2 / 13, 2 / 27, 0.5])
+def test_ema_matches_pandas_ewm_on_filled_series(alpha):
+    values = 10.0 + np.cumsum(np.nan_to_num(_values()), axis=0)
+    values[np.isnan(_values(seed=4))] = np.nan
+    context = FactorContext(values, np.ones(values.shape))
+    expected = pd.DataFrame(values).ffill().ewm(alpha=alpha, adjust=False).mean().to_numpy()
+    np.testing.assert_allclose(context.ema("close", alpha), expected, rtol=1e-12, atol=0)